@@ -0,0 +1,37 @@
+import json
+import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_path(fpath):
+    """
+    atomic_path: the temporary path to write a file through: it is moved in
+    place of fpath once the block completes and removed if the block raises,
+    so a reader never sees a partial file
+
+        with atomic_path(fpath) as tmp_fpath:
+            write_to(tmp_fpath)
+    """
+    tmp_fpath = fpath + ".tmp"
+    if os.path.exists(tmp_fpath):
+        os.remove(tmp_fpath)
+    try:
+        yield tmp_fpath
+    except BaseException:
+        if os.path.exists(tmp_fpath):
+            os.remove(tmp_fpath)
+        raise
+    os.replace(tmp_fpath, fpath)
+
+
+def write_json_atomic(obj, fpath):
+    """
+    write_json_atomic: write obj as JSON to a temporary file and move it in
+    place, so a reader never sees a partial file
+    """
+    with atomic_path(fpath) as tmp_fpath:
+        with open(tmp_fpath, "w") as file_obj:
+            json.dump(obj, file_obj, indent=2, sort_keys=True)
+            file_obj.flush()
+            os.fsync(file_obj.fileno())
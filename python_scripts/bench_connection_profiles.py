@@ -0,0 +1,92 @@
+import argparse
+import json
+import multiprocessing
+import time
+
+import wom
+from db_connection import create_connection, current_pragmas, PRAGMA_PROFILES
+from retroRules import build_rule_query, execute_query_iter, ALL_DIAMETERS
+
+
+def benchmark_queries(rules_db=None, wom_db=None):
+    """
+    benchmark_queries: the RetroRules and WOM queries to time, per database
+    :return: a list of (query name, database file, query string)
+    """
+    qrys = []
+    if rules_db:
+        qrys.append(("rule_query_dia16", rules_db, build_rule_query(16, repo_prefix='rxn')))
+        qrys.append(("rule_query_all_diameters", rules_db, build_rule_query(list(ALL_DIAMETERS), repo_prefix='rxn')))
+    if wom_db:
+        qrys.append(("wom_column_query", wom_db, wom.column_attribute_query()))
+        qrys.append(("wom_matrix_query", wom_db, wom.matrix_query()))
+    return qrys
+
+
+def count_rows(conn, qry):
+    """
+    count_rows: run a query to its end, counting the rows
+    """
+    return sum(len(rows) for rows in execute_query_iter(conn, qry))
+
+
+def time_profile(profile, qrys, warm_up=False, repeat=3):
+    """
+    time_profile: time each query on a fresh connection with the given profile;
+    runs in a process of its own so the SQLite page cache starts empty
+    :param profile: a PRAGMA_PROFILES name
+    :param qrys: the benchmark_queries result
+    :param warm_up: warm the database files up when connecting (counted in connect_seconds)
+    :param repeat: the number of runs per query
+    :return: a dict of query name to timings
+    """
+    results = {}
+    for name, db_file, qry in qrys:
+        start = time.perf_counter()
+        conn = create_connection(db_file, read_only=True, profile=profile, warm_up=warm_up)
+        connect_seconds = time.perf_counter() - start
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            n_rows = count_rows(conn, qry)
+            times.append(time.perf_counter() - start)
+        results[name] = {"connect_seconds": round(connect_seconds, 4), "first_seconds": round(times[0], 4),
+                         "best_seconds": round(min(times), 4), "rows": n_rows,
+                         "pragmas": current_pragmas(conn)}
+        conn.close()
+    return results
+
+
+def main():
+    """
+    main: time the RetroRules and WOM queries under each connection profile
+    """
+    parser = argparse.ArgumentParser(description="Compare the SQLite connection profiles")
+    parser.add_argument("--rules-db", help="a RetroRules database (e.g., from synthetic_db.py)")
+    parser.add_argument("--wom-db", help="a WOM database")
+    parser.add_argument("--profiles", nargs="+", default=sorted(PRAGMA_PROFILES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    qrys = benchmark_queries(args.rules_db, args.wom_db)
+    if not qrys:
+        parser.error("give --rules-db and/or --wom-db")
+
+    results = {}
+    runs = [(profile, False) for profile in args.profiles] + [("fast_read", True)]
+    for profile, warm_up in runs:
+        label = profile + ("+warm_up" if warm_up else "")
+        with multiprocessing.Pool(1) as pool:
+            results[label] = pool.apply(time_profile, (profile, qrys, warm_up, args.repeat))
+        for name, m in results[label].items():
+            print("{:<18} {:<26} connect {:>7.3f}s  first {:>8.3f}s  best {:>8.3f}s  {:>9} rows".format(
+                label, name, m["connect_seconds"], m["first_seconds"], m["best_seconds"], m["rows"]))
+
+    if args.output:
+        with open(args.output, "w") as file_obj:
+            json.dump(results, file_obj, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
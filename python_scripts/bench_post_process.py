@@ -0,0 +1,154 @@
+import argparse
+import itertools
+import random
+import re
+import time
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:  # pyarrow is only needed for the columnar comparison
+    pa = None
+
+from retroRules import (create_connection, execute_query, build_rule_query, post_query_process,
+                        post_query_process_batch, repeat_any, FETCH_BATCH_SIZE, REPEAT_ANY_TABLE)
+
+
+def legacy_repeat_any(N):
+    """
+    legacy_repeat_any: repeat_any as it was, by repeated concatenation
+    """
+    rep_str = 'Any'
+    for _ in itertools.repeat(None, N-1):
+        rep_str += ';Any'
+    return rep_str
+
+
+def legacy_post_query_process(data_rows):
+    """
+    legacy_post_query_process: the original row-by-row loop, kept as the
+    reference both for the timings and for the output
+    """
+    out_data = []
+    pattern = r'>>\((.*)\)$'
+    for row in data_rows:
+        lst_row = list(row)
+        any_num = lst_row[17]
+        smt = lst_row[9]
+        if any_num > 1:
+            lst_row[9] = re.sub(pattern, r'>>\1', smt)
+        lst_row[17] = (legacy_repeat_any(any_num))
+        out_data.append(lst_row)
+    return out_data
+
+
+def synthetic_rows(n_rows, seed=0):
+    """
+    synthetic_rows: rows shaped like the rule query result, with a mix of
+    single and multi-product SMARTS and stoichiometries
+    :param n_rows: the number of rows
+    :return: a list of tuples
+    """
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(n_rows):
+        total = rnd.choice((1, 1, 2, 2, 3, 4, 6))
+        smarts = "([#6:1]-[#8:2]-[H])>>" + ("([#6:1]=[#8:2].[H])" if total > 1 else "[#6:1]=[#8:2]")
+        rows.append((i, "rxn{:05d}".format(i), "1.1.1.1", i, "cpd00001", 1, 16, 0, 1.0,
+                     smarts, "Any", "cpd00002", "1", "cpd00001", "IK1", "cpd00002", "IK2", total,
+                     "<{}>".format(i)))
+    return rows
+
+
+def time_it(func, rows, repeat=3):
+    """
+    time_it: the best wall time of func(rows) over a few runs
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(rows)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def batched(rows):
+    """
+    batched: the batch path as the streaming export drives it
+    """
+    out_data = []
+    for i in range(0, len(rows), FETCH_BATCH_SIZE):
+        out_data.extend(post_query_process_batch(rows[i:i + FETCH_BATCH_SIZE]))
+    return out_data
+
+
+def columnar(rows):
+    """
+    columnar: the batch transform as pyarrow compute kernels over the SMARTS
+    and 'total_stoichios' columns. The kernels themselves are fast, but the
+    rows have to be split into columns and the results put back into rows for
+    the csv writer, which costs more than the batch loop saves
+    """
+    out_data = []
+    for i in range(0, len(rows), FETCH_BATCH_SIZE):
+        batch = rows[i:i + FETCH_BATCH_SIZE]
+        smarts = pa.array([row[9] for row in batch], pa.string())
+        any_nums = np.array([row[17] for row in batch])
+        unwrapped = pc.replace_substring_regex(smarts, r'>>\((.*)\)$', r'>>\1')
+        smarts_out = pc.if_else(pa.array(any_nums > 1), unwrapped, smarts).to_pylist()
+        in_table = (any_nums >= 0) & (any_nums < len(REPEAT_ANY_TABLE))
+        products = np.array(REPEAT_ANY_TABLE, dtype=object)[np.where(in_table, any_nums, 0)]
+        for j in np.flatnonzero(~in_table).tolist():
+            products[j] = repeat_any(int(any_nums[j]))
+        for row, smt, prod in zip(batch, smarts_out, products.tolist()):
+            lst_row = list(row)
+            lst_row[9] = smt
+            lst_row[17] = prod
+            out_data.append(lst_row)
+    return out_data
+
+
+def main():
+    """
+    main: compare the row-by-row, the batch and (with pyarrow) the columnar
+    post-processing, on the rows of a database or on synthetic rows
+    """
+    parser = argparse.ArgumentParser(description="Compare the rule row post-processing paths")
+    parser.add_argument("database", nargs="?", help="a RetroRules database, default synthetic rows")
+    parser.add_argument("--diameter", type=int, default=16)
+    parser.add_argument("--rows", type=int, default=200000, help="the number of synthetic rows")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.database:
+        conn = create_connection(args.database, read_only=True)
+        if conn is None:
+            parser.error("unable to open database file {}".format(args.database))
+        rows = execute_query(conn, build_rule_query(args.diameter, repo_prefix='rxn'))
+        conn.close()
+        if rows is None:
+            parser.error("unable to query the rules of {}".format(args.database))
+    else:
+        rows = synthetic_rows(args.rows)
+
+    expected = legacy_post_query_process(rows)
+    assert expected == post_query_process(rows)
+    paths = [("row-by-row loop", legacy_post_query_process), ("batch transform", batched)]
+    if pa is not None:
+        assert expected == columnar(rows)
+        paths.append(("columnar (pyarrow)", columnar))
+
+    print("rows: {}".format(len(rows)))
+    t_legacy = None
+    for name, func in paths:
+        elapsed = time_it(func, rows, args.repeat)
+        t_legacy = t_legacy or elapsed
+        print("{}: {:.3f}s ({:.0f} rows/s, {:.2f}x)".format(name, elapsed, len(rows) / elapsed,
+                                                           t_legacy / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+
+import retroRules
+import wom
+from atomic_files import atomic_path, write_json_atomic
+from export_metrics import peak_rss_mb
+from synthetic_db import generate_retrorules_db, generate_wom_db
+from wom_matrix import build_dense_matrix, build_dense_matrix_parallel
+
+
+BENCHMARK_STAGES = ("rule_query", "rule_hash_join", "post_query_process", "csv_write", "wom_matrix",
+                    "wom_matrix_dense", "wom_matrix_parallel")
+
+DEFAULT_SCALES = (10000, 100000)
+
+# the allowed slowdown of a stage against its baseline rows/sec, e.g., 0.25 = 25% slower
+DEFAULT_THRESHOLD = 0.25
+
+# where the synthetic databases, the output files and the baseline go by
+# default, kept out of the source tree (build/ is git-ignored)
+DEFAULT_WORKDIR = os.path.join("build", "benchmark")
+DEFAULT_BASELINE = os.path.join(DEFAULT_WORKDIR, "benchmark_baseline.json")
+
+# the number of WOM environment-organism-project columns and the compounds per rule
+WOM_EOPS = 100
+RULES_PER_WOM_COMPOUND = 20
+
+
+def benchmark_databases(workdir, n_rules, seed=0):
+    """
+    benchmark_databases: the synthetic RetroRules and WOM databases of one
+    scale, generated on the first use and reused by the later runs
+    :param workdir: the directory holding the databases
+    :param n_rules: the number of rules
+    :param seed: the random seed
+    :return: a tuple of (rules db path, wom db path, the number of WOM compounds)
+    """
+    n_compounds = max(1000, n_rules // RULES_PER_WOM_COMPOUND)
+    rules_db = os.path.join(workdir, "synthetic_mvc_{}_s{}.db".format(n_rules, seed))
+    wom_db = os.path.join(workdir, "synthetic_wom_{}_s{}.sqlite3".format(n_compounds, seed))
+    os.makedirs(workdir, exist_ok=True)
+    if not os.path.exists(rules_db):
+        print("Generate {}...".format(rules_db))
+        with atomic_path(rules_db) as tmp_path:
+            generate_retrorules_db(tmp_path, n_rules, seed)
+    if not os.path.exists(wom_db):
+        print("Generate {}...".format(wom_db))
+        with atomic_path(wom_db) as tmp_path:
+            generate_wom_db(tmp_path, n_compounds, WOM_EOPS, seed=seed)
+    return (rules_db, wom_db, n_compounds)
+
+
+def rule_rows(rules_db):
+    """
+    rule_rows: the rows of the rule query over all the diameters
+    """
+    conn = retroRules.create_connection(rules_db)
+    try:
+        qry = retroRules.build_rule_query(list(retroRules.ALL_DIAMETERS), repo_prefix='rxn')
+        return retroRules.execute_query(conn, qry)
+    finally:
+        conn.close()
+
+
+def rule_rows_hash_join(rules_db):
+    """
+    rule_rows_hash_join: the rows of rule_rows, by the NumPy hash-join engine
+    """
+    from rule_join_engine import rule_rows_hash_join as hash_join
+    conn = retroRules.create_connection(rules_db)
+    try:
+        return hash_join(conn, list(retroRules.ALL_DIAMETERS), repo_prefix='rxn')
+    finally:
+        conn.close()
+
+
+def run_stage(stage, rules_db, wom_db, n_compounds, workdir, repeat=3):
+    """
+    run_stage: time one stage on its inputs, which are prepared untimed. It runs
+    in a fresh process (see benchmark_stage); peak_rss_mb is the peak of that
+    whole process, inputs included, and inputs_rss_mb the peak once the inputs
+    are prepared, so the stage itself added about the difference.
+    :param stage: one of BENCHMARK_STAGES
+    :param rules_db: the synthetic RetroRules database
+    :param wom_db: the synthetic WOM database
+    :param n_compounds: the number of compounds of the WOM database
+    :param workdir: the directory for the output files
+    :param repeat: the number of timed runs, the best one counts
+    :return: a dict of the stage metrics
+    """
+    bytes_written = None
+    conn = None
+    if stage == "rule_query":
+        def func():
+            return rule_rows(rules_db)
+    elif stage == "rule_hash_join":
+        def func():
+            return rule_rows_hash_join(rules_db)
+    elif stage == "post_query_process":
+        rows = rule_rows(rules_db)
+
+        def func():
+            return retroRules.post_query_process(rows)
+    elif stage == "csv_write":
+        data = retroRules.post_query_process(rule_rows(rules_db))
+        fpath = os.path.join(workdir, "benchmark_rules.tsv")
+
+        def func():
+            retroRules.csv_write(data, fpath)
+            return data
+    elif stage == "wom_matrix":
+        conn = wom.create_connection(wom_db)
+        n_obs = conn.execute("select count(*) from matchmaker_observation").fetchone()[0]
+
+        def func():
+            wom.build_matrix(conn, n_compounds)
+            return range(n_obs)
+    elif stage == "wom_matrix_dense":
+        conn = wom.create_connection(wom_db)
+        n_obs = conn.execute("select count(*) from matchmaker_observation").fetchone()[0]
+
+        def func():
+            build_dense_matrix(conn, n_compounds)
+            return range(n_obs)
+    elif stage == "wom_matrix_parallel":
+        conn = wom.create_connection(wom_db)
+        n_obs = conn.execute("select count(*) from matchmaker_observation").fetchone()[0]
+
+        def func():
+            build_dense_matrix_parallel(wom_db)
+            return range(n_obs)
+    else:
+        raise ValueError("unknown benchmark stage: {}".format(stage))
+
+    inputs_rss_mb = peak_rss_mb()
+    best = None
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            n_rows = len(func())
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        if conn is not None:
+            conn.close()
+    if stage == "csv_write":
+        bytes_written = os.path.getsize(fpath)
+        os.remove(fpath)
+    return {"seconds": round(best, 4), "rows": n_rows,
+            "rows_per_sec": round(n_rows / best, 1) if best > 0 else None,
+            "peak_rss_mb": round(peak_rss_mb(), 1), "inputs_rss_mb": round(inputs_rss_mb, 1),
+            "bytes_written": bytes_written}
+
+
+def benchmark_stage(stage, rules_db, wom_db, n_compounds, workdir, repeat=3):
+    """
+    benchmark_stage: run_stage in a child process of its own
+    """
+    with multiprocessing.Pool(1) as pool:
+        return pool.apply(run_stage, (stage, rules_db, wom_db, n_compounds, workdir, repeat))
+
+
+def run_benchmarks(scales=DEFAULT_SCALES, stages=BENCHMARK_STAGES, workdir=DEFAULT_WORKDIR,
+                   repeat=3, seed=0):
+    """
+    run_benchmarks: time the stages at each scale
+    :param scales: the numbers of rules
+    :param stages: the stages to run, see BENCHMARK_STAGES
+    :param workdir: the directory of the synthetic databases and the output files
+    :param repeat: the number of timed runs per stage
+    :param seed: the random seed of the synthetic databases
+    :return: a dict of scale (str) to stage to metrics
+    """
+    results = {}
+    for n_rules in scales:
+        rules_db, wom_db, n_compounds = benchmark_databases(workdir, n_rules, seed)
+        results[str(n_rules)] = scale_results = {}
+        for stage in stages:
+            scale_results[stage] = metrics = benchmark_stage(stage, rules_db, wom_db, n_compounds,
+                                                             workdir, repeat)
+            print("{:>9} rules  {:<20} {:>9.3f}s {:>12.0f} rows/s {:>9.1f} MB peak ({:.1f} MB inputs)".format(
+                n_rules, stage, metrics["seconds"], metrics["rows_per_sec"] or 0, metrics["peak_rss_mb"],
+                metrics["inputs_rss_mb"]))
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    compare_to_baseline: find the stages slower than their baseline beyond the threshold
+    :param results: the run_benchmarks result
+    :param baseline: a baseline file content, see write_baseline
+    :param threshold: the allowed slowdown, e.g., 0.25 for 25%
+    :return: a list of regression messages, empty if none
+    """
+    regressions = []
+    for scale, stages in sorted(results.items(), key=lambda kv: int(kv[0])):
+        for stage, metrics in stages.items():
+            base = baseline.get("results", {}).get(scale, {}).get(stage)
+            if not base or not base.get("rows_per_sec") or not metrics.get("rows_per_sec"):
+                continue
+            slowdown = base["rows_per_sec"] / metrics["rows_per_sec"] - 1.0
+            if slowdown > threshold:
+                regressions.append("{} rules, {}: {:.0f} rows/s vs baseline {:.0f} rows/s ({:.2f}x the time)".format(
+                    scale, stage, metrics["rows_per_sec"], base["rows_per_sec"], 1.0 + slowdown))
+    return regressions
+
+
+def read_baseline(fpath):
+    """
+    read_baseline: read a baseline file, None if there is none
+    """
+    if not os.path.exists(fpath):
+        return None
+    with open(fpath, "r") as file_obj:
+        return json.load(file_obj)
+
+
+def write_baseline(results, fpath):
+    """
+    write_baseline: write the results as the baseline JSON, merged into the
+    existing baseline so that a run of a few scales keeps the others
+    :param results: the run_benchmarks result
+    :param fpath: the baseline filename with path
+    """
+    baseline = read_baseline(fpath) or {}
+    merged = baseline.get("results", {})
+    for scale, stages in results.items():
+        merged.setdefault(scale, {}).update(stages)
+    baseline = {"created": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "python": platform.python_version(), "platform": platform.platform(),
+                "results": merged}
+    os.makedirs(os.path.dirname(fpath) or ".", exist_ok=True)
+    write_json_atomic(baseline, fpath)
+
+
+def main():
+    """
+    main: run the benchmarks on synthetic databases and compare them to the
+    baseline; exits with status 1 if a stage slowed down beyond the threshold
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the RetroRules and WOM export stages")
+    parser.add_argument("--scales", type=int, nargs="+", default=list(DEFAULT_SCALES),
+                        help="the numbers of rules, from 10000 up to 1000000")
+    parser.add_argument("--stages", nargs="+", choices=BENCHMARK_STAGES, default=list(BENCHMARK_STAGES))
+    parser.add_argument("--workdir", default=DEFAULT_WORKDIR)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="write the results as the new baseline instead of comparing")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.scales, args.stages, args.workdir, args.repeat)
+    if args.output:
+        write_json_atomic({"results": results}, args.output)
+
+    baseline = read_baseline(args.baseline)
+    if args.update_baseline or baseline is None:
+        write_baseline(results, args.baseline)
+        print("Wrote the baseline {}".format(args.baseline))
+        return
+
+    regressions = compare_to_baseline(results, baseline, args.threshold)
+    if regressions:
+        print("Regressions beyond {:.0%}:".format(args.threshold))
+        for msg in regressions:
+            print("  " + msg)
+        sys.exit(1)
+    print("No regression beyond {:.0%} against {}".format(args.threshold, args.baseline))
+
+
+if __name__ == '__main__':
+    main()
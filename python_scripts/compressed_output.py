@@ -0,0 +1,157 @@
+import collections
+import gzip
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:  # zstandard is only needed for the zstd outputs
+    zstandard = None
+
+
+# the supported output compressions and their file suffixes
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+# the default compression level per compression, favouring speed: the TSVs are
+# repetitive enough that gzip -3 is within 25% of the size of gzip -6 at half the time
+DEFAULT_LEVELS = {"gzip": 3, "zstd": 3}
+
+# the uncompressed size of the blocks compressed independently of each other
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def require_compression(compression):
+    """
+    require_compression: fail with a clear message if the compression is unknown
+    or its module is not installed
+    """
+    if compression not in COMPRESSION_SUFFIXES:
+        raise ValueError("unknown output compression: {}".format(compression))
+    if compression == "zstd" and zstandard is None:
+        raise ImportError("zstandard is required for the zstd outputs: pip install zstandard")
+
+
+def compressed_fpath(fpath, compression=None):
+    """
+    compressed_fpath: the output filename with the suffix of the compression, if any
+    """
+    return fpath + COMPRESSION_SUFFIXES[compression] if compression else fpath
+
+
+def compress_block(data, compression, level):
+    """
+    compress_block: compress one block as a complete gzip member or zstd frame.
+    Both formats allow members/frames to be concatenated, so the file of the
+    blocks decompresses (gunzip, zcat, zstd -d, gzip.open...) as a single stream.
+    zlib and zstd release the GIL, so the blocks compress in parallel threads.
+    :param data: the block bytes
+    :param compression: 'gzip' or 'zstd'
+    :param level: the compression level
+    :return: the compressed bytes
+    """
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+class BlockCompressedWriter(io.RawIOBase):
+    """
+    BlockCompressedWriter: a binary file writer compressing its output on a
+    thread pool. The bytes are cut into blocks of block_size, each block is
+    compressed independently in the background while the caller keeps fetching
+    and formatting rows, and the compressed blocks are written in order.
+    See open_text_output for the text (csv.writer) interface.
+    """
+
+    def __init__(self, fpath, compression="gzip", level=None, block_size=DEFAULT_BLOCK_SIZE, n_threads=None):
+        """
+        :param fpath: the output filename with path
+        :param compression: 'gzip' or 'zstd'
+        :param level: the compression level, default DEFAULT_LEVELS
+        :param block_size: the uncompressed block size
+        :param n_threads: the number of compressing threads, default the number of CPUs
+        """
+        super(BlockCompressedWriter, self).__init__()
+        require_compression(compression)
+        self.name = fpath
+        self.compression = compression
+        self.level = DEFAULT_LEVELS[compression] if level is None else level
+        self.block_size = block_size
+        self.n_threads = n_threads or os.cpu_count() or 1
+        self.max_pending = 2 * self.n_threads  # bounds the memory held by blocks in flight
+        self.file_obj = open(fpath, "wb")
+        self.executor = ThreadPoolExecutor(self.n_threads)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        """
+        write: buffer the bytes, handing blocks to the compressing threads once full
+        :return: the number of bytes written
+        """
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self.submit_block(block)
+        return len(data)
+
+    def submit_block(self, block):
+        self.pending.append(self.executor.submit(compress_block, block, self.compression, self.level))
+        self.write_done_blocks(wait=len(self.pending) > self.max_pending)
+
+    def write_done_blocks(self, wait=False):
+        """
+        write_done_blocks: write the compressed blocks finished so far, in order
+        :param wait: wait for the oldest block if it is not done yet
+        """
+        while self.pending and (wait or self.pending[0].done()):
+            self.file_obj.write(self.pending.popleft().result())
+            wait = False
+
+    def flush(self):
+        """
+        flush: write the blocks compressed so far; a partial block stays
+        buffered, as flushing it would only make the blocks smaller
+        """
+        if not self.closed:
+            self.write_done_blocks()
+            self.file_obj.flush()
+
+    def close(self):
+        """
+        close: compress the last block, write all the blocks and close the file
+        """
+        if self.closed:
+            return
+        try:
+            if self.buffer:
+                self.submit_block(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.write_done_blocks(wait=True)
+        finally:
+            self.executor.shutdown(wait=True)
+            super(BlockCompressedWriter, self).close()
+            self.file_obj.close()
+
+
+def open_text_output(fpath, compression=None, level=None, n_threads=None):
+    """
+    open_text_output: open an output text file, plain or compressed by a
+    BlockCompressedWriter; the text is encoded and buffered as by open(fpath, "w"),
+    so the compressed file decompresses to the bytes of the plain one
+    :param fpath: the output filename with path (see compressed_fpath for the suffix)
+    :param compression: None, 'gzip' or 'zstd'
+    :param level: the compression level
+    :param n_threads: the number of compressing threads
+    :return: a writable text file object
+    """
+    if not compression:
+        return open(fpath, "w")
+    raw = BlockCompressedWriter(fpath, compression, level, n_threads=n_threads)
+    return io.TextIOWrapper(io.BufferedWriter(raw, buffer_size=1 << 20))
@@ -0,0 +1,160 @@
+import os
+import sqlite3
+from sqlite3 import Error
+from urllib.parse import quote
+
+
+# the pragmas a profile may set
+PROFILE_PRAGMAS = ("cache_size", "mmap_size", "temp_store", "threads", "cache_spill")
+
+# the connection tuning profiles; cache_size < 0 is in KiB, mmap_size in bytes
+# (SQLite caps mmap_size at its compile-time SQLITE_MAX_MMAP_SIZE, 2 GB by default)
+PRAGMA_PROFILES = {
+    # the SQLite defaults: about 2 MB page cache, no mmap, temp B-trees in files
+    "default": {},
+    # small footprint, for running next to other jobs
+    "low_memory": {"cache_size": -16384, "mmap_size": 0, "temp_store": "FILE"},
+    # the large group_concat/group by queries: a 256 MB page cache, temp B-trees
+    # in memory, helper threads for the sorts and the file memory-mapped
+    "fast_read": {"cache_size": -262144, "mmap_size": 1 << 30, "temp_store": "MEMORY", "threads": 4},
+    # as much of the file as possible memory-mapped, a modest page cache
+    "mmap": {"cache_size": -65536, "mmap_size": 1 << 34, "temp_store": "MEMORY", "threads": 4},
+}
+
+# the chunk size used to read the database file through when warming it up
+WARM_UP_CHUNK_SIZE = 16 * 1024 * 1024
+
+# number of rows pulled from the cursor per fetchmany() call in streaming mode
+FETCH_BATCH_SIZE = 10000
+
+
+def database_uri(db_file, read_only=True, immutable=False):
+    """
+    database_uri: the SQLite URI of a database file, opened read-only or immutable
+    :param db_file: database file
+    :param read_only: open with mode=ro, so the connection can never write
+    :param immutable: also declare the file immutable: SQLite skips all the locking
+    and change detection, which is only safe when nothing writes to the file
+    while it is open (e.g., a RetroRules release dump)
+    :return: a 'file:' URI string
+    """
+    params = []
+    if read_only or immutable:
+        params.append("mode=ro")
+    if immutable:
+        params.append("immutable=1")
+    uri = "file:" + quote(os.path.abspath(db_file))
+    return uri + ("?" + "&".join(params) if params else "")
+
+
+def profile_pragmas(profile=None, pragmas=None):
+    """
+    profile_pragmas: the pragmas of a named profile, updated with explicit ones
+    :param profile: a PRAGMA_PROFILES name, or None for the defaults
+    :param pragmas: optional dict of pragma name to value overriding the profile
+    :return: a dict of pragma name to value
+    """
+    if profile is not None and profile not in PRAGMA_PROFILES:
+        raise ValueError("unknown connection profile: {}".format(profile))
+    settings = dict(PRAGMA_PROFILES.get(profile, {}))
+    settings.update(pragmas or {})
+    for name in settings:
+        if name not in PROFILE_PRAGMAS:
+            raise ValueError("unsupported pragma: {}".format(name))
+    return settings
+
+
+def apply_pragmas(conn, pragmas):
+    """
+    apply_pragmas: set the given pragmas on a connection
+    :param conn: the Connection object
+    :param pragmas: a dict of pragma name (one of PROFILE_PRAGMAS) to value
+    """
+    for name, value in pragmas.items():
+        if isinstance(value, str) and not value.isalnum():
+            raise ValueError("invalid value for pragma {}: {}".format(name, value))
+        conn.execute("pragma {}={}".format(name, value))
+
+
+def current_pragmas(conn):
+    """
+    current_pragmas: the values in effect of the PROFILE_PRAGMAS
+    :param conn: the Connection object
+    :return: a dict of pragma name to value
+    """
+    return dict((name, conn.execute("pragma " + name).fetchone()[0]) for name in PROFILE_PRAGMAS)
+
+
+def warm_up_database(db_file, chunk_size=WARM_UP_CHUNK_SIZE):
+    """
+    warm_up_database: read the database file once, sequentially, so that its
+    pages are in the OS page cache (and the mmap'ed pages fault in from memory)
+    before the queries hit them in random order
+    :param db_file: database file
+    :param chunk_size: the read size
+    :return: the number of bytes read
+    """
+    n_bytes = 0
+    with open(db_file, "rb", buffering=0) as file_obj:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(file_obj.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        buf = bytearray(chunk_size)
+        while True:
+            n_read = file_obj.readinto(buf)
+            if not n_read:
+                break
+            n_bytes += n_read
+    return n_bytes
+
+
+def create_connection(db_file, read_only=False, immutable=False, profile=None, pragmas=None,
+                      warm_up=False, check_same_thread=True):
+    """ create a database connection to the SQLite database
+        specified by the db_file
+    :param db_file: database file
+    :param read_only: open the database read-only (mode=ro URI)
+    :param immutable: open the database read-only and immutable, see database_uri
+    :param profile: a PRAGMA_PROFILES name to tune the connection with
+    :param pragmas: optional dict of pragmas overriding the profile
+    :param warm_up: read the database file into the page cache first
+    :param check_same_thread: see sqlite3.connect
+    :return: Connection object or None
+    """
+    try:
+        settings = profile_pragmas(profile, pragmas)
+        if warm_up:
+            warm_up_database(db_file)
+        if read_only or immutable:
+            conn = sqlite3.connect(database_uri(db_file, read_only, immutable), uri=True,
+                                   check_same_thread=check_same_thread)
+        else:
+            # uri=True only lets ATTACH take database_uri()s, a plain path opens as before
+            conn = sqlite3.connect(db_file, uri=True, check_same_thread=check_same_thread)
+        apply_pragmas(conn, settings)
+        return conn
+    except (Error, OSError, ValueError) as e:
+        print(e)
+
+    return None
+
+
+def execute_query_iter(conn, qry, batch_size=FETCH_BATCH_SIZE):
+    """
+    execute_query_iter: executes the given query qry against db connection conn
+    and yields the result in batches as they are fetched, instead of loading
+    the whole result set with fetchall()
+    :param conn: the Connection object
+    :param qry: SQL query smarts_string
+    :param batch_size: number of rows per cursor.fetchmany() call
+    :return: a generator of lists of rows (tuples); a failing query raises
+    sqlite3.Error, as the callers stream the rows to files and must not take
+    a truncated result for a complete one
+    """
+    cur = conn.cursor()
+    qry = qry.strip()
+    cur.execute(qry)
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        yield rows
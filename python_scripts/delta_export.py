@@ -0,0 +1,336 @@
+import csv
+import hashlib
+import json
+import sqlite3
+
+from retroRules import (create_connection, execute_query_iter, build_rule_query,
+                        post_query_process_batch, RULE_TABLE_HEADER)
+from table_watermark import table_watermark, is_appended
+
+
+# the number of reactions re-queried per export query
+DELTA_CHUNK_SIZE = 500
+
+REMOVED_HEADER = ["reaction_id", "rule_substrate_id", "diameter", "isStereo"]
+
+CPD_COLS = "cs.seed, cs.bigg, cs.kegg, cs.metacyc, cs.mnxm, cs.inchi_key"
+
+# the source tables of the rule fingerprints and their reaction id column; the
+# SMARTS and compounds are keyed by the rows that reference them
+WATCHED_TABLES = {
+    "rules": "reaction_id",
+    "rule_products": "reaction_id",
+    "reactions": "id",
+    "ec_reactions": "reaction_id",
+    "reaction_substrates": "reaction_id",
+    "reaction_products": "reaction_id",
+    "smarts": None,
+    "chemical_species": None,
+}
+
+# the manifest: the fingerprint of every rule of the last export, and the
+# watermarks of the source tables it was fingerprinted at
+MANIFEST_SCHEMA = """
+create table if not exists rule_fingerprints(reaction_id integer, substrate_id integer, diameter integer,
+    isStereo integer, fingerprint text, exported integer,
+    primary key (reaction_id, substrate_id, diameter, isStereo));
+create table if not exists watermarks(tbl text primary key, watermark text);
+"""
+
+
+def fingerprint_queries(diam=10, reaction_filter=None):
+    """
+    fingerprint_queries: the plain scans of the source rows that feed a rule of
+    the rule table; each yields rows starting with the key they belong to, in
+    the same order whatever the reaction filter
+    :param diam: reaction diameter
+    :param reaction_filter: optional condition on the reaction id with a {col}
+    placeholder, as in build_rule_query
+    :return: a tuple of (rule-keyed queries, reaction-keyed queries)
+    """
+    def cond(col, keyword="and"):
+        return " " + keyword + " " + reaction_filter.format(col=col) if reaction_filter else ""
+
+    rule_qrys = [
+        """
+        select r.reaction_id, r.substrate_id, r.diameter, r.isStereo,
+        r.direction, r.score, s.smarts_string, """ + CPD_COLS + """
+        from rules r
+        left join smarts s on s.id=r.smarts_id
+        left join chemical_species cs on cs.id=r.substrate_id
+        where r.diameter=""" + str(diam) + cond("r.reaction_id") + """
+        order by r.reaction_id, r.substrate_id, r.diameter, r.isStereo, r.rowid
+        """,
+        """
+        select rp.reaction_id, rp.substrate_id, rp.diameter, rp.isStereo,
+        rp.product_id, rp.stochiometry, """ + CPD_COLS + """
+        from rule_products rp
+        left join chemical_species cs on cs.id=rp.product_id
+        where rp.diameter=""" + str(diam) + cond("rp.reaction_id") + """
+        order by rp.reaction_id, rp.substrate_id, rp.diameter, rp.isStereo, rp.rowid
+        """,
+    ]
+    rxn_qrys = [
+        "select rxn.id, rxn.seed, rxn.bigg, rxn.kegg, rxn.metacyc, rxn.mnxr from reactions rxn" +
+        cond("rxn.id", "where"),
+        "select er.reaction_id, er.ec_number from ec_reactions er" + cond("er.reaction_id", "where") +
+        " order by er.reaction_id, er.rowid",
+        """
+        select rs.reaction_id, 's', rs.chemical_id, """ + CPD_COLS + """
+        from reaction_substrates rs
+        left join chemical_species cs on cs.id=rs.chemical_id""" + cond("rs.reaction_id", "where") + """
+        order by rs.reaction_id, rs.rowid
+        """,
+        """
+        select rp.reaction_id, 'p', rp.chemical_id, """ + CPD_COLS + """
+        from reaction_products rp
+        left join chemical_species cs on cs.id=rp.chemical_id""" + cond("rp.reaction_id", "where") + """
+        order by rp.reaction_id, rp.rowid
+        """,
+    ]
+    return (rule_qrys, rxn_qrys)
+
+
+def hash_rows(conn, qrys, key_len):
+    """
+    hash_rows: stream the rows of the queries into one md5 per key
+    :param conn: the Connection object
+    :param qrys: the queries, each row starting with its key_len key columns
+    :param key_len: the number of leading key columns
+    :return: a dict of key (tuple) to md5 object
+    """
+    hashes = {}
+    for k, qry in enumerate(qrys):
+        for rows in execute_query_iter(conn, qry):
+            for row in rows:
+                key = tuple(row[:key_len])
+                md5 = hashes.get(key)
+                if md5 is None:
+                    md5 = hashes[key] = hashlib.md5()
+                md5.update(repr((k, row[key_len:])).encode())
+    return hashes
+
+
+def reaction_chunks(rxn_ids, chunk_size=DELTA_CHUNK_SIZE):
+    """
+    reaction_chunks: the reaction filters (see build_rule_query) of the given
+    reactions, chunk_size reactions at a time
+    :return: a generator of condition strings with a {col} placeholder
+    """
+    rxn_ids = sorted(rxn_ids)
+    for i in range(0, len(rxn_ids), chunk_size):
+        yield "{col} in (" + ",".join(str(r) for r in rxn_ids[i:i + chunk_size]) + ")"
+
+
+def rule_fingerprints(conn, diam=10, rxn_ids=None, chunk_size=DELTA_CHUNK_SIZE):
+    """
+    rule_fingerprints: fingerprint the rules of the given diameter from their
+    source rows (rule, SMARTS, substrate, products and the reaction with its
+    EC numbers, substrates and products), without running the export join
+    :param conn: the Connection object
+    :param diam: reaction diameter
+    :param rxn_ids: only fingerprint the rules of these reactions, default all
+    :param chunk_size: the number of reactions per query
+    :return: a dict of (reaction_id, substrate_id, diameter, isStereo) to hex digest
+    """
+    rxn_filters = [None] if rxn_ids is None else reaction_chunks(rxn_ids, chunk_size)
+    fingerprints = {}
+    for rxn_filter in rxn_filters:
+        rule_qrys, rxn_qrys = fingerprint_queries(diam, rxn_filter)
+        rule_hashes = hash_rows(conn, rule_qrys, 4)
+        rxn_hashes = hash_rows(conn, rxn_qrys, 1)
+        for key, md5 in rule_hashes.items():
+            rxn_md5 = rxn_hashes.get(key[:1])
+            md5.update(rxn_md5.digest() if rxn_md5 is not None else b"")
+            fingerprints[key] = md5.hexdigest()
+    return fingerprints
+
+
+def appended_reactions(conn, watermarks):
+    """
+    appended_reactions: the reactions with source rows appended after the
+    watermarks; the SMARTS and compounds appended are only read through them
+    :param conn: the Connection object
+    :param watermarks: a dict of WATCHED_TABLES name to table_watermark
+    :return: a set of reaction ids
+    """
+    rxn_ids = set()
+    for table, col in WATCHED_TABLES.items():
+        max_rowid = watermarks[table]["max_rowid"]
+        if col is None:
+            continue
+        qry = "select distinct " + col + " from " + table
+        params = ()
+        if max_rowid is not None:
+            qry += " where rowid > ?"
+            params = (max_rowid,)
+        rxn_ids.update(row[0] for row in conn.execute(qry, params) if row[0] is not None)
+    return rxn_ids
+
+
+def open_manifest(fpath):
+    """
+    open_manifest: open (or create) the manifest database of the delta export
+    :param fpath: the manifest filename with path
+    :return: the Connection object
+    """
+    manifest = sqlite3.connect(fpath)
+    manifest.executescript(MANIFEST_SCHEMA)
+    return manifest
+
+
+def read_watermarks(manifest):
+    """
+    read_watermarks: the source table watermarks of the last export
+    :param manifest: the manifest Connection object
+    :return: a dict of table name to table_watermark
+    """
+    return dict((tbl, json.loads(watermark))
+                for tbl, watermark in manifest.execute("select tbl, watermark from watermarks"))
+
+
+def read_fingerprints(manifest, rxn_ids=None, chunk_size=DELTA_CHUNK_SIZE):
+    """
+    read_fingerprints: the fingerprints of the rules of the last export
+    :param manifest: the manifest Connection object
+    :param rxn_ids: only read the rules of these reactions, default all
+    :param chunk_size: the number of reactions per query
+    :return: a dict of rule key to (fingerprint, exported)
+    """
+    qry = "select reaction_id, substrate_id, diameter, isStereo, fingerprint, exported from rule_fingerprints"
+    rxn_filters = [None] if rxn_ids is None else reaction_chunks(rxn_ids, chunk_size)
+    fingerprints = {}
+    for rxn_filter in rxn_filters:
+        where = " where " + rxn_filter.format(col="reaction_id") if rxn_filter else ""
+        for row in manifest.execute(qry + where):
+            fingerprints[tuple(row[:4])] = (row[4], row[5] == 1)
+    return fingerprints
+
+
+def write_fingerprints(manifest, updated, deleted, watermarks):
+    """
+    write_fingerprints: update the manifest in one transaction, so that it
+    either stays at the last export or moves to this one
+    :param manifest: the manifest Connection object
+    :param updated: a dict of rule key to (fingerprint, exported) to (re)write
+    :param deleted: the rule keys to drop
+    :param watermarks: a dict of table name to table_watermark
+    """
+    with manifest:
+        manifest.executemany("delete from rule_fingerprints where reaction_id=? and substrate_id=? and "
+                             "diameter=? and isStereo=?", deleted)
+        manifest.executemany("insert or replace into rule_fingerprints values (?, ?, ?, ?, ?, ?)",
+                             (list(key) + [fp, 1 if exported else 0] for key, (fp, exported) in updated.items()))
+        manifest.executemany("insert or replace into watermarks values (?, ?)",
+                             ((tbl, json.dumps(watermark)) for tbl, watermark in watermarks.items()))
+
+
+def query_rules_for_reactions(conn, rxn_ids, diam=10, chunk_size=DELTA_CHUNK_SIZE):
+    """
+    query_rules_for_reactions: run the export query only for the given reactions
+    :param conn: the Connection object
+    :param rxn_ids: the reaction ids to re-query
+    :param diam: reaction diameter
+    :param chunk_size: the number of reactions per query
+    :return: a generator of processed rule rows
+    """
+    for rxn_filter in reaction_chunks(rxn_ids, chunk_size):
+        qry = build_rule_query(diam, reaction_filter=rxn_filter, repo_prefix='rxn')
+        for rows in execute_query_iter(conn, qry):
+            for row in post_query_process_batch(rows):
+                yield row
+
+
+def delta_export(conn, out_prefix, manifest_fpath, diam=10, chunk_size=DELTA_CHUNK_SIZE, full=False):
+    """
+    delta_export: incrementally export the rule table of the given diameter
+    against the manifest of the last export. Only the reactions with a new or
+    changed rule fingerprint are re-queried, and the added, changed and removed
+    rules are written to <out_prefix>_added.tsv, _changed.tsv and _removed.tsv.
+    When the source tables were only appended to since (see
+    table_watermark.is_appended), only the reactions of the appended rows are
+    fingerprinted; otherwise every rule is. Without a manifest every rule
+    comes out as added.
+    :param conn: the Connection object
+    :param out_prefix: output filename prefix with path
+    :param manifest_fpath: the manifest database filename with path, updated on success
+    :param diam: reaction diameter
+    :param chunk_size: the number of reactions per query
+    :param full: fingerprint every rule, e.g., after rows were edited in place
+    :return: a dict of the added/changed/removed/unchanged rule counts
+    """
+    manifest = open_manifest(manifest_fpath)
+    old_watermarks = read_watermarks(manifest)
+    # taken before the scans: a row appended meanwhile is fingerprinted again next time
+    watermarks = dict((table, table_watermark(conn, table)) for table in WATCHED_TABLES)
+    if not full and all(is_appended(conn, table, old_watermarks.get(table)) for table in WATCHED_TABLES):
+        rxn_ids = appended_reactions(conn, old_watermarks)
+        old_manifest = read_fingerprints(manifest, rxn_ids, chunk_size)
+        fingerprints = rule_fingerprints(conn, diam, rxn_ids, chunk_size)
+    else:
+        old_manifest = read_fingerprints(manifest)
+        fingerprints = rule_fingerprints(conn, diam)
+
+    stale = set(key for key, fp in fingerprints.items()
+                if key not in old_manifest or old_manifest[key][0] != fp)
+    dropped = [key for key in old_manifest if key not in fingerprints]
+    removed = [key for key in dropped if old_manifest[key][1]]
+
+    # until the re-query outputs them
+    updated = dict((key, (fingerprints[key], False)) for key in stale)
+
+    counts = {"added": 0, "changed": 0, "removed": 0, "unchanged": len(fingerprints) - len(stale)}
+    with open(out_prefix + "_added.tsv", "w") as added_file, \
+            open(out_prefix + "_changed.tsv", "w") as changed_file:
+        added = csv.writer(added_file, delimiter='\t')
+        changed = csv.writer(changed_file, delimiter='\t')
+        added.writerow(RULE_TABLE_HEADER)
+        changed.writerow(RULE_TABLE_HEADER)
+
+        rxn_ids = set(key[0] for key in stale)
+        for row in query_rules_for_reactions(conn, rxn_ids, diam, chunk_size):
+            key = (row[0], row[3], row[6], row[7])
+            if key not in stale:
+                continue
+            updated[key] = (fingerprints[key], True)
+            if key in old_manifest and old_manifest[key][1]:
+                changed.writerow(row)
+                counts["changed"] += 1
+            else:
+                added.writerow(row)
+                counts["added"] += 1
+
+    # rules exported last time that are gone, or no longer come out of the query
+    removed.extend(key for key in stale if key in old_manifest and old_manifest[key][1] and
+                   not updated[key][1])
+    with open(out_prefix + "_removed.tsv", "w") as removed_file:
+        writer = csv.writer(removed_file, delimiter='\t')
+        writer.writerow(REMOVED_HEADER)
+        writer.writerows(sorted(removed))
+    counts["removed"] = len(removed)
+
+    write_fingerprints(manifest, updated, dropped, watermarks)
+    manifest.close()
+    return counts
+
+
+def main():
+    """
+    main: incrementally refresh the rule table export
+    """
+    database = "/Users/qzhang/qzwk_dir/upload_RetroRules/retrorules_dump/mvc.db"
+    diam = 16
+    out_prefix = "../TSVs/retro_rules_dia{}_delta".format(str(diam))
+    manifest_nm = "../TSVs/retro_rules_dia{}_manifest.db".format(str(diam))
+
+    print("0. create a database connection...")
+    conn = create_connection(database, read_only=True, profile="fast_read")
+    with conn:
+        print("1. Fingerprint the new rules and re-query the changed ones...")
+        counts = delta_export(conn, out_prefix, manifest_nm, diam)
+        print("2. Wrote {added} added, {changed} changed and {removed} removed rules "
+              "({unchanged} unchanged)".format(**counts))
+
+
+if __name__ == '__main__':
+    main()
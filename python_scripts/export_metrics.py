@@ -0,0 +1,285 @@
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import resource
+import sqlite3
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from atomic_files import write_json_atomic
+
+
+# the number of functions listed in the metrics file when profiling
+PROFILE_TOP_N = 25
+
+
+def peak_rss_mb():
+    """
+    peak_rss_mb: the peak resident set size of this process so far, in MB
+    (ru_maxrss is in kilobytes on Linux and in bytes on macOS)
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+
+
+class StageMetrics(object):
+    """
+    StageMetrics: the accumulated measurements of one named stage (query,
+    fetch, transform, write...) over all the times it was entered
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.child_wall = 0.0
+        self.child_cpu = 0.0
+        self.rows = 0
+        self.bytes_written = 0
+        self.first_batch_seconds = None
+        self.peak_rss_mb = 0.0
+        self.traced_peak_mb = None
+
+    def add_rows(self, n_rows):
+        self.rows += n_rows
+
+    def add_bytes(self, n_bytes):
+        self.bytes_written += n_bytes
+
+    def as_dict(self):
+        """
+        as_dict: the metrics of the stage; 'self_seconds' excludes the time of
+        the stages nested in it, and rows_per_sec is based on it
+        """
+        self_wall = max(self.wall - self.child_wall, 0.0)
+        return {
+            "calls": self.calls,
+            "wall_seconds": round(self.wall, 4),
+            "self_seconds": round(self_wall, 4),
+            "cpu_seconds": round(max(self.cpu - self.child_cpu, 0.0), 4),
+            "rows": self.rows,
+            "rows_per_sec": round(self.rows / self_wall, 1) if self.rows and self_wall > 0 else None,
+            "bytes_written": self.bytes_written,
+            "first_batch_seconds": None if self.first_batch_seconds is None else round(self.first_batch_seconds, 4),
+            "peak_rss_mb": round(self.peak_rss_mb, 1),
+            "traced_peak_mb": None if self.traced_peak_mb is None else round(self.traced_peak_mb, 2),
+        }
+
+
+class ExportMetrics(object):
+    """
+    ExportMetrics: per-stage instrumentation of an export run. Stages can nest
+    (e.g., a write stage pulling rows through the fetch and transform stages)
+    and each reports its own time without the nested ones. The query plans of
+    the queries run are kept along, and the whole run can be profiled.
+
+        with ExportMetrics("retroRules", profile=True) as metrics:
+            metrics.explain(conn, "rule_query", qry)
+            batches = metrics.iter_stage("fetch", execute_query_iter(conn, qry))
+            with metrics.stage("write") as st:
+                st.add_rows(csv_write_stream(batches, fpath))
+        metrics.write("metrics.json")
+
+    A disabled ExportMetrics (NO_METRICS) passes everything through untimed.
+    """
+
+    def __init__(self, script="", enabled=True, trace_memory=False, profile=False):
+        """
+        :param script: the name of the instrumented script, recorded in the metrics file
+        :param enabled: False for a pass-through instance
+        :param trace_memory: also record the peak Python allocations per stage with
+        tracemalloc (precise, but slows the run down noticeably)
+        :param profile: capture a cProfile of the run
+        """
+        self.script = script
+        self.enabled = enabled
+        self.trace_memory = trace_memory and enabled
+        self.stages = {}
+        self.query_plans = {}
+        self.profiler = cProfile.Profile() if profile and enabled else None
+        self.started_at = None
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self._stack = []
+        self._clocks = None
+        self._null_stage = StageMetrics("")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+    def start(self):
+        """
+        start: start the run's clocks (and the profiler and tracemalloc, if requested)
+        """
+        if not self.enabled:
+            return
+        self.started_at = datetime.datetime.now()
+        self._clocks = (time.perf_counter(), time.process_time())
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def stop(self):
+        """
+        stop: stop the run's clocks
+        """
+        if not self.enabled or self._clocks is None:
+            return
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.trace_memory:
+            tracemalloc.stop()
+        self.wall_seconds = time.perf_counter() - self._clocks[0]
+        self.cpu_seconds = time.process_time() - self._clocks[1]
+        self._clocks = None
+
+    def get_stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = StageMetrics(name)
+        return stage
+
+    @contextmanager
+    def stage(self, name):
+        """
+        stage: time the enclosed block as (one more call of) the named stage
+        :param name: the stage name
+        :return: a context manager yielding the StageMetrics, to add rows/bytes to
+        """
+        if not self.enabled:
+            yield self._null_stage
+            return
+        stage = self.get_stage(name)
+        frame = [stage, 0.0]  # the stage and its traced peak before the last nested reset
+        if self.trace_memory:
+            if self._stack:  # keep the enclosing stage's peak so far before resetting it
+                self._stack[-1][1] = max(self._stack[-1][1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self._stack.append(frame)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield stage
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            self._stack.pop()
+            stage.calls += 1
+            stage.wall += wall
+            stage.cpu += cpu
+            stage.peak_rss_mb = max(stage.peak_rss_mb, peak_rss_mb())
+            parent = self._stack[-1] if self._stack else None
+            if parent is not None:
+                parent[0].child_wall += wall
+                parent[0].child_cpu += cpu
+            if self.trace_memory:
+                traced = max(tracemalloc.get_traced_memory()[1], frame[1]) / (1024.0 * 1024.0)
+                stage.traced_peak_mb = max(stage.traced_peak_mb or 0.0, traced)
+                if parent is not None:
+                    parent[1] = max(parent[1], traced * 1024.0 * 1024.0)
+
+    def iter_stage(self, name, batches):
+        """
+        iter_stage: time the production of each batch of an iterable of row
+        batches (e.g., execute_query_iter) as the named stage, and count the rows.
+        The first batch includes the execution of the query, and its time is
+        recorded as 'first_batch_seconds'.
+        :param name: the stage name
+        :param batches: an iterable of lists of rows
+        :return: a generator of the same batches
+        """
+        if not self.enabled:
+            return batches
+        return self._iter_stage(name, batches)
+
+    def _iter_stage(self, name, batches):
+        it = iter(batches)
+        while True:
+            with self.stage(name) as stage:
+                start = time.perf_counter()
+                rows = next(it, None)
+                if rows is not None:
+                    stage.add_rows(len(rows))
+                if stage.first_batch_seconds is None:
+                    stage.first_batch_seconds = time.perf_counter() - start
+            if rows is None:
+                return
+            yield rows
+
+    def explain(self, conn, name, qry):
+        """
+        explain: record the EXPLAIN QUERY PLAN of a query under the given name
+        :param conn: the Connection object
+        :param name: the query name
+        :param qry: SQL query string
+        """
+        if not self.enabled:
+            return
+        try:
+            plan = conn.execute("explain query plan " + qry.strip()).fetchall()
+            self.query_plans[name] = {"sql": qry.strip(), "plan": [row[-1] for row in plan]}
+        except sqlite3.Error as e:
+            self.query_plans[name] = {"sql": qry.strip(), "error": e.args[0]}
+
+    def profile_summary(self, top_n=PROFILE_TOP_N):
+        """
+        profile_summary: the hottest functions of the profile by own time
+        :return: a list of dicts, empty when not profiling
+        """
+        if self.profiler is None:
+            return []
+        stats = pstats.Stats(self.profiler, stream=io.StringIO())
+        hot = sorted(stats.stats.items(), key=lambda kv: kv[1][2], reverse=True)[:top_n]
+        return [{"function": "{}:{}({})".format(os.path.basename(func[0]), func[1], func[2]),
+                 "calls": stat[1], "self_seconds": round(stat[2], 4), "cumulative_seconds": round(stat[3], 4)}
+                for func, stat in hot]
+
+    def as_dict(self):
+        """
+        as_dict: all the metrics of the run
+        """
+        return {
+            "script": self.script,
+            "started": self.started_at.strftime("%Y-%m-%d %H:%M:%S") if self.started_at else None,
+            "wall_seconds": None if self.wall_seconds is None else round(self.wall_seconds, 4),
+            "cpu_seconds": None if self.cpu_seconds is None else round(self.cpu_seconds, 4),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "stages": dict((name, stage.as_dict()) for name, stage in self.stages.items()),
+            "query_plans": self.query_plans,
+            "profile": self.profile_summary(),
+        }
+
+    def write(self, fpath):
+        """
+        write: write the metrics as JSON, and the raw profile next to it as
+        <fpath without extension>.prof (for pstats/snakeviz) when profiling
+        :param fpath: the metrics filename with path
+        """
+        if not self.enabled:
+            return
+        write_json_atomic(self.as_dict(), fpath)
+        if self.profiler is not None:
+            self.profiler.dump_stats(os.path.splitext(fpath)[0] + ".prof")
+
+    def print_summary(self):
+        """
+        print_summary: print one line per stage
+        """
+        for name, stage in self.stages.items():
+            m = stage.as_dict()
+            print("  {:<22} {:>9.3f}s self {:>9.3f}s cpu {:>10} rows {:>12} rows/s {:>8.1f} MB".format(
+                name, m["self_seconds"], m["cpu_seconds"], m["rows"],
+                "{:.0f}".format(m["rows_per_sec"]) if m["rows_per_sec"] else "-", m["peak_rss_mb"]))
+
+
+# the pass-through instance used when no metrics are requested
+NO_METRICS = ExportMetrics(enabled=False)
@@ -0,0 +1,150 @@
+import csv
+import datetime
+import hashlib
+import os
+from sqlite3 import Error
+
+from db_connection import create_connection, database_uri
+
+# bump whenever the layout of the index tables or the parsing of the TSV changes
+INDEX_VERSION = "2"
+
+# the schema name the index is ATTACHed as
+INDEX_SCHEMA = "inchikey_index"
+
+# the index tables: the source signature, and one row per compound name,
+# looked up through its primary key by row_attribute_query
+INDEX_TABLES = """
+create table index_meta (key text primary key, value text);
+create table cpd_inchikeys (cpd_name text primary key, inchikey text) without rowid;
+"""
+
+# the number of TSV lines inserted at a time
+IMPORT_BATCH_SIZE = 50000
+
+
+def default_index_path(tsv_path):
+    """
+    default_index_path: the index file of an InChIKey TSV, next to it
+    """
+    return os.path.splitext(tsv_path)[0] + "_inchikeys.sqlite3"
+
+
+def file_sha256(fpath, chunk_size=1 << 20):
+    """
+    file_sha256: the hex SHA-256 digest of a file's content
+    """
+    sha = hashlib.sha256()
+    with open(fpath, "rb") as file_obj:
+        for chunk in iter(lambda: file_obj.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def read_index_meta(index_path):
+    """
+    read_index_meta: the index_meta of an index file, None if there is no readable index
+    """
+    if not os.path.exists(index_path):
+        return None
+    conn = create_connection(index_path, read_only=True)
+    if conn is None:
+        return None
+    try:
+        return dict(conn.execute("select key, value from index_meta").fetchall())
+    except Error:  # not an index file
+        return None
+    finally:
+        conn.close()
+
+
+def iter_tsv_inchikeys(tsv_path):
+    """
+    iter_tsv_inchikeys: the (compound name, InChIKey) pairs of the TSV, i.e.,
+    its first and third fields, in file order as wom.read_tsv_into_dict reads
+    them, read with csv.reader(delimiter='\t') so that a quoted field loses its
+    quotes and a name may hold a comma; rows with fewer fields are skipped
+    """
+    with open(tsv_path, "r", newline="") as file_obj:
+        for fields in csv.reader(file_obj, delimiter='\t'):
+            if len(fields) > 2:
+                yield (fields[0], fields[2])
+
+
+def build_inchikey_index(tsv_path, index_path, sha256=None):
+    """
+    build_inchikey_index: import the compound name to InChIKey TSV into an
+    indexed SQLite file, built as <index_path>.tmp and moved in place once
+    complete. A name repeated in the TSV keeps its last InChIKey, as in the
+    dict of wom.read_tsv_into_dict.
+    :param tsv_path: the formula_withoutNA_withInchiKeys.tsv file
+    :param index_path: the index filename with path
+    :param sha256: the TSV digest, if already computed
+    :return: the number of compound names in the index
+    """
+    st = os.stat(tsv_path)
+    tmp_path = index_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = create_connection(tmp_path)
+    conn.executescript(INDEX_TABLES)
+    pairs = iter_tsv_inchikeys(tsv_path)
+    while True:
+        batch = [pair for _, pair in zip(range(IMPORT_BATCH_SIZE), pairs)]
+        if not batch:
+            break
+        conn.executemany("insert or replace into cpd_inchikeys values (?,?)", batch)
+    n_names = conn.execute("select count(*) from cpd_inchikeys").fetchone()[0]
+    meta = {"index_version": INDEX_VERSION, "source": os.path.abspath(tsv_path),
+            "size": str(st.st_size), "mtime_ns": str(st.st_mtime_ns),
+            "sha256": sha256 or file_sha256(tsv_path),
+            "created": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+    conn.executemany("insert into index_meta values (?,?)", meta.items())
+    conn.commit()
+    conn.close()
+    os.replace(tmp_path, index_path)
+    return n_names
+
+
+def ensure_inchikey_index(tsv_path, index_path=None):
+    """
+    ensure_inchikey_index: build the index of the TSV unless it is up to date.
+    An index with the TSV's size and mtime is used as is; when the mtime
+    changed, the TSV is hashed and the index only rebuilt if the content did,
+    otherwise its recorded mtime is refreshed.
+    :param tsv_path: the formula_withoutNA_withInchiKeys.tsv file
+    :param index_path: the index filename with path, default default_index_path
+    :return: a tuple of (index path, True if the index was (re)built)
+    """
+    index_path = index_path or default_index_path(tsv_path)
+    st = os.stat(tsv_path)
+    meta = read_index_meta(index_path)
+    if meta is not None and meta.get("index_version") == INDEX_VERSION and meta.get("size") == str(st.st_size):
+        if meta.get("mtime_ns") == str(st.st_mtime_ns):
+            return (index_path, False)
+        sha256 = file_sha256(tsv_path)
+        if meta.get("sha256") == sha256:
+            conn = create_connection(index_path)
+            with conn:
+                conn.execute("update index_meta set value=? where key='mtime_ns'", (str(st.st_mtime_ns),))
+            conn.close()
+            return (index_path, False)
+        build_inchikey_index(tsv_path, index_path, sha256)
+    else:
+        build_inchikey_index(tsv_path, index_path)
+    return (index_path, True)
+
+
+def attach_inchikey_index(conn, tsv_path, index_path=None):
+    """
+    attach_inchikey_index: bring the InChIKey index of the TSV up to date and
+    ATTACH it read-only to the connection as INDEX_SCHEMA, for
+    wom.row_attribute_query(inchikeys=True)
+    :param conn: the Connection object of wom.sqlite3
+    :param tsv_path: the formula_withoutNA_withInchiKeys.tsv file
+    :param index_path: the index filename with path, default default_index_path
+    :return: True if the index was (re)built
+    """
+    index_path, rebuilt = ensure_inchikey_index(tsv_path, index_path)
+    conn.execute("attach database ? as {}".format(INDEX_SCHEMA), (database_uri(index_path),))
+    return rebuilt
@@ -0,0 +1,198 @@
+import sqlite3
+from sqlite3 import Error
+import os
+import time
+
+from retroRules import create_connection, execute_query, build_rule_query
+
+
+# covering indexes for the access pattern of build_rule_query,
+# as (index name, table, columns); the join keys lead, the selected columns follow
+COVERING_INDEXES = [
+    ("rr_rules_dia_key", "rules",
+     ["diameter", "reaction_id", "substrate_id", "isStereo", "smarts_id", "direction", "score"]),
+    ("rr_rule_products_key", "rule_products",
+     ["reaction_id", "substrate_id", "diameter", "isStereo", "product_id", "stochiometry"]),
+    ("rr_reaction_substrates_rxn", "reaction_substrates", ["reaction_id", "chemical_id"]),
+    ("rr_reaction_products_rxn", "reaction_products", ["reaction_id", "chemical_id"]),
+    ("rr_ec_reactions_rxn", "ec_reactions", ["reaction_id", "ec_number"]),
+]
+
+
+def explain_query_plan(conn, qry):
+    """
+    explain_query_plan: run EXPLAIN QUERY PLAN on the given query
+    :param conn: the Connection object
+    :param qry: SQL query string
+    :return: a list of (id, parent, notused, detail) rows, or None on error
+    """
+    return execute_query(conn, "explain query plan " + qry.strip())
+
+
+def plan_issues(plan_rows):
+    """
+    plan_issues: pick the full-table scans, automatic (transient) indexes and
+    temp B-tree sorts out of a query plan
+    :param plan_rows: the result of explain_query_plan
+    :return: a list of the offending plan detail strings
+    """
+    issues = []
+    for row in plan_rows or []:
+        detail = row[3]
+        if (detail.startswith("SCAN") and "INDEX" not in detail and
+                "SUBQUERY" not in detail and "CONSTANT ROW" not in detail):
+            issues.append(detail)
+        elif "AUTOMATIC" in detail or "TEMP B-TREE" in detail:
+            issues.append(detail)
+    return issues
+
+
+def copy_database(src_db, dst_db):
+    """
+    copy_database: copy the source database into a writable file with the
+    sqlite3 backup API, opening the source read-only so it is never modified
+    :param src_db: the source database file
+    :param dst_db: the destination database file, overwritten if it exists
+    :return: the destination database filename with path
+    """
+    if os.path.realpath(dst_db) == os.path.realpath(src_db):
+        raise ValueError("the copy of {} would overwrite it: {}".format(src_db, dst_db))
+    if os.path.exists(dst_db):
+        os.remove(dst_db)
+    src = create_connection(src_db, read_only=True)
+    dst = create_connection(dst_db)
+    with dst:
+        src.backup(dst)
+    dst.close()
+    src.close()
+    return dst_db
+
+
+def existing_index_columns(conn, table):
+    """
+    existing_index_columns: list the column lists of the indexes on a table
+    :param conn: the Connection object
+    :param table: the table name
+    :return: a list of lists of column names
+    """
+    cols = []
+    for idx in execute_query(conn, "pragma index_list({})".format(table)) or []:
+        info = execute_query(conn, "pragma index_info({})".format(idx[1])) or []
+        cols.append([c[2] for c in sorted(info)])
+    return cols
+
+
+def create_missing_indexes(conn, indexes=COVERING_INDEXES):
+    """
+    create_missing_indexes: create the covering indexes not already served by
+    an existing index with the same leading columns, then refresh the planner
+    statistics with ANALYZE
+    :param conn: the Connection object of the writable database copy
+    :param indexes: a list of (index name, table, columns)
+    :return: the list of the index names created
+    """
+    created = []
+    for name, table, columns in indexes:
+        existing = existing_index_columns(conn, table)
+        if any(cols[:len(columns)] == columns for cols in existing):
+            continue
+        try:
+            conn.execute("create index if not exists {} on {}({})".format(
+                name, table, ",".join(columns)))
+            created.append(name)
+        except Error as e:
+            print("An error occurred:", e.args[0])
+    conn.execute("analyze")
+    conn.commit()
+    return created
+
+
+def time_query(conn, qry):
+    """
+    time_query: run the query to completion with execute_query and time it
+    :param conn: the Connection object
+    :param qry: SQL query string
+    :return: a tuple of (seconds, number of rows)
+    """
+    start = time.perf_counter()
+    rows = execute_query(conn, qry)
+    return (time.perf_counter() - start, len(rows) if rows else 0)
+
+
+def advisor_queries(diam=10):
+    """
+    advisor_queries: the queries generated for the rule exports
+    :param diam: reaction diameter
+    :return: a dict of query name to query string
+    """
+    return {
+        "rule_per_row": build_rule_query(diam, repo_prefix='rxn'),
+        "rule_per_row_seed_cpds": build_rule_query(diam, seed_cpds=True),
+    }
+
+
+def advise(src_db, work_db, diam=10, run_queries=True):
+    """
+    advise: report the full-table scans and temp B-tree sorts of the generated
+    queries, create the missing covering indexes in a writable copy of the
+    database and report the query plans and times before and after
+    :param src_db: the source (mvc.db) database file, never modified
+    :param work_db: the writable copy to create the indexes in
+    :param diam: reaction diameter of the queries
+    :param run_queries: also time the queries before and after indexing
+    :return: a dict of the report
+    """
+    copy_database(src_db, work_db)
+    conn = create_connection(work_db)
+    queries = advisor_queries(diam)
+
+    report = {"database": work_db, "queries": {}}
+    for qname, qry in queries.items():
+        entry = {"issues_before": plan_issues(explain_query_plan(conn, qry))}
+        if run_queries:
+            entry["seconds_before"], entry["rows"] = time_query(conn, qry)
+        report["queries"][qname] = entry
+
+    report["created_indexes"] = create_missing_indexes(conn)
+
+    for qname, qry in queries.items():
+        entry = report["queries"][qname]
+        entry["issues_after"] = plan_issues(explain_query_plan(conn, qry))
+        if run_queries:
+            entry["seconds_after"] = time_query(conn, qry)[0]
+    conn.close()
+
+    return report
+
+
+def print_report(report):
+    """
+    print_report: print the advise() report in a readable form
+    """
+    print("Indexes created in {}: {}".format(
+        report["database"], ", ".join(report["created_indexes"]) or "none"))
+    for qname, entry in report["queries"].items():
+        print("Query {}:".format(qname))
+        for label in ("before", "after"):
+            print("  plan issues {} indexing:".format(label))
+            for detail in entry["issues_" + label]:
+                print("    " + detail)
+        if "seconds_before" in entry:
+            print("  time: {:.3f}s before, {:.3f}s after ({} rows)".format(
+                entry["seconds_before"], entry["seconds_after"], entry["rows"]))
+
+
+def main():
+    """
+    main: run the index advisor against a copy of mvc.db
+    """
+    database = "/Users/qzhang/qzwk_dir/upload_RetroRules/retrorules_dump/mvc.db"
+    work_database = "/Users/qzhang/qzwk_dir/upload_RetroRules/retrorules_dump/mvc_indexed.db"
+    diam = 16
+
+    print("0. copy {} to {} and analyze the rule queries...".format(database, work_database))
+    print_report(advise(database, work_database, diam))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+import itertools
+import json
+
+from atomic_files import atomic_path
+from retroRules import (create_connection, execute_query_iter, rule_query_filters, cpd_info_subquery,
+                        diameter_condition, and_conditions, rxn_id_expr, cpd_id_expr, unwrap_smarts,
+                        repeat_any_lookup, RULE_TABLE_HEADER, FETCH_BATCH_SIZE)
+from rule_arrow import pa, require_pyarrow
+from rule_join_engine import rule_name
+
+
+# the columns holding lists in the nested export (comma-joined strings in the TSVs)
+LIST_COLUMNS = ("ec_numbers", "rule_prod_ids", "rule_prod_stoichios", "rxn_substrate_ids",
+                "rxn_substrate_inchis", "rxn_product_ids", "rxn_product_inchis")
+
+# the reaction columns of the rules whose reaction is not in rxn_info
+NO_RXN_INFO = {"repo_rxn_id": None, "ec_numbers": None, "rxn_substrate_ids": None, "rxn_substrate_inchis": None,
+               "rxn_product_ids": None, "rxn_product_inchis": None}
+
+# the number of columns of the rule key (reaction_id, substrate_id, diameter, isStereo)
+RULE_KEY_LEN = 4
+
+
+def nested_rule_queries(diam=10, seed_cpds=False, repo_prefix=None, ec_prefix=None,
+                        min_score=None, is_stereo=None, substrate_cpds=None):
+    """
+    nested_rule_queries: the ungrouped, sorted queries the nested rule rows are
+    merged from. Unlike build_rule_query, nothing is aggregated in SQL: every
+    query streams one row per list element, sorted by the key it is grouped on.
+    :param diam: reaction diameter, or a list of diameters
+    :param seed_cpds: ONLY rules that have seed reactants/products
+    :param repo_prefix: keep the reactions whose repository id starts with it, e.g., 'rxn'
+    :param ec_prefix: keep the reactions with an EC number starting with it, e.g., '1.1.'
+    :param min_score: keep the rules scoring at least min_score
+    :param is_stereo: keep the stereo (1) or non-stereo (0) rules only
+    :param substrate_cpds: keep the rules whose substrate is one of these compound ids
+    :return: a dict of query name ('rules', 'rule_products', 'reactions',
+    'ec_numbers', 'substrates', 'products') to sqlite3 query string
+    """
+    filters = rule_query_filters(seed_cpds, None, repo_prefix, ec_prefix, min_score, is_stereo, substrate_cpds)
+    rxn_conds = ([] if seed_cpds else ["rxn1.seed not null"]) + filters["rxn"]
+    rxn_ids = "(select rxn1.id from reactions rxn1" + and_conditions(rxn_conds) + ")"
+    cs_cond = and_conditions(["cs.seed not null" if seed_cpds else ""])
+
+    qrys = {
+        "rules": """
+            select r.reaction_id,r.substrate_id,r.diameter,r.isStereo,cs_info.repo_cpd_id,
+            r.direction,r.score,s.smarts_string
+            from rules r, smarts s,
+            """ + cpd_info_subquery(seed_cpds, "cs_info") + """
+            where s.id=r.smarts_id and cs_info.id=r.substrate_id""" + and_conditions(
+            [diameter_condition(diam, "r.diameter")] + filters["rule"], "and") + """
+            order by r.reaction_id,r.substrate_id,r.diameter,r.isStereo,r.rowid""",
+        "rule_products": """
+            select rp.reaction_id,rp.substrate_id,rp.diameter,rp.isStereo,
+            cs_info1.repo_cpd_id,rp.stochiometry
+            from rule_products rp,
+            """ + cpd_info_subquery(seed_cpds, "cs_info1") + """
+            where rp.product_id=cs_info1.id""" + and_conditions(
+            [diameter_condition(diam, "rp.diameter")] + filters["rule_product"], "and") + """
+            order by rp.reaction_id,rp.substrate_id,rp.diameter,rp.isStereo,rp.rowid""",
+        "reactions": """
+            select rxn1.id, """ + rxn_id_expr(seed_cpds) + """ as repo_rxn_id
+            from reactions rxn1""" + and_conditions(rxn_conds) + """
+            order by rxn1.id""",
+        "ec_numbers": """
+            select er.reaction_id,er.ec_number
+            from ec_reactions er
+            where er.reaction_id in """ + rxn_ids + """
+            order by er.reaction_id,er.ec_number""",
+    }
+    for side, table in (("substrates", "reaction_substrates"), ("products", "reaction_products")):
+        qrys[side] = """
+            select x.reaction_id,cs_info.cpd_id,cs_info.inchi_key
+            from """ + table + """ x,
+            (
+                select cs.id as chem_sp_id, cs.inchi_key, """ + cpd_id_expr(seed_cpds) + """ as cpd_id
+                from chemical_species cs""" + cs_cond + """
+            ) as cs_info
+            where x.chemical_id=cs_info.chem_sp_id and x.reaction_id in """ + rxn_ids + """
+            order by x.reaction_id,cs_info.cpd_id,x.chemical_id"""
+    return qrys
+
+
+def iter_groups(row_batches, key_len):
+    """
+    iter_groups: group the rows of a stream sorted by its first key_len columns
+    :param row_batches: an iterable of lists of rows, e.g., execute_query_iter
+    :param key_len: the number of key columns
+    :return: a generator of (key tuple, list of rows); the groups with a NULL in
+    their key are skipped, as no join can match them
+    """
+    rows = itertools.chain.from_iterable(row_batches)
+    for key, group in itertools.groupby(rows, key=lambda row: row[:key_len]):
+        if None not in key:
+            yield (key, list(group))
+
+
+class GroupCursor(object):
+    """
+    GroupCursor: the merge-join side of a grouped stream. Probed with
+    increasing keys, it returns the rows of each key, skipping the groups of
+    the keys never probed.
+    """
+
+    def __init__(self, row_batches, key_len):
+        self.groups = iter_groups(row_batches, key_len)
+        self.current = next(self.groups, None)
+
+    def take(self, key):
+        """
+        take: the rows of the given key, an empty list if there are none
+        :param key: the key tuple, not less than the keys taken before
+        """
+        while self.current is not None and self.current[0] < key:
+            self.current = next(self.groups, None)
+        if self.current is not None and self.current[0] == key:
+            return self.current[1]
+        return []
+
+
+def distinct_list(values):
+    """
+    distinct_list: the non-NULL values without duplicates, in their order
+    """
+    seen = set()
+    return [v for v in values if v is not None and not (v in seen or seen.add(v))]
+
+
+def iter_nested_rule_rows(conn, diam=10, seed_cpds=False, repo_prefix='rxn', ec_prefix=None,
+                          min_score=None, is_stereo=None, substrate_cpds=None, row_count=0,
+                          batch_size=FETCH_BATCH_SIZE):
+    """
+    iter_nested_rule_rows: stream the post-processed rule table with its list
+    columns (LIST_COLUMNS) as Python lists, merged from the sorted queries of
+    nested_rule_queries without any string aggregation. The rules come in rule
+    key order (RULE_KEY_ORDER); the lists hold the same values in the same
+    order as the comma-joined strings of the TSV export, except the EC numbers,
+    which are always sorted. Where the TSV has an empty column, a reaction
+    without EC numbers or compounds gets empty lists, and a rule without
+    reaction info NULLs.
+    :param conn: the Connection object
+    :param diam: reaction diameter, or a list of diameters
+    :param seed_cpds: ONLY rules that have seed reactants/products
+    :param repo_prefix: keep the reactions whose repository id starts with it
+    :param ec_prefix: keep the reactions with an EC number starting with it
+    :param min_score: keep the rules scoring at least min_score
+    :param is_stereo: keep the stereo (1) or non-stereo (0) rules only
+    :param substrate_cpds: keep the rules whose substrate is one of these compound ids
+    :param row_count: number of rows to output, if 0 output all
+    :param batch_size: number of rows fetched and yielded at a time
+    :return: a generator of lists of dicts keyed by RULE_TABLE_HEADER
+    """
+    qrys = nested_rule_queries(diam, seed_cpds, repo_prefix, ec_prefix, min_score, is_stereo, substrate_cpds)
+    rules = iter_groups(execute_query_iter(conn, qrys["rules"], batch_size), RULE_KEY_LEN)
+    products = GroupCursor(execute_query_iter(conn, qrys["rule_products"], batch_size), RULE_KEY_LEN)
+    reactions = GroupCursor(execute_query_iter(conn, qrys["reactions"], batch_size), 1)
+    ec_numbers = GroupCursor(execute_query_iter(conn, qrys["ec_numbers"], batch_size), 1)
+    rxn_substrates = GroupCursor(execute_query_iter(conn, qrys["substrates"], batch_size), 1)
+    rxn_products = GroupCursor(execute_query_iter(conn, qrys["products"], batch_size), 1)
+    rxn_required = bool(repo_prefix or ec_prefix)
+
+    batch = []
+    n_rows = 0
+    rxn_key = None
+    rxn_info = None
+    for key, rule_rows in rules:
+        prod_rows = products.take(key)
+        if not prod_rows:
+            continue  # no products: dropped by the join with the grouped products
+        if key[:1] != rxn_key:
+            rxn_key = key[:1]
+            rxn = reactions.take(rxn_key)
+            subs = rxn_substrates.take(rxn_key)
+            prods = rxn_products.take(rxn_key)
+            rxn_info = None if not rxn else {
+                "repo_rxn_id": rxn[0][1],
+                "ec_numbers": distinct_list(row[1] for row in ec_numbers.take(rxn_key)),
+                "rxn_substrate_ids": distinct_list(row[1] for row in subs),
+                "rxn_substrate_inchis": distinct_list(row[2] for row in subs),
+                "rxn_product_ids": distinct_list(row[1] for row in prods),
+                "rxn_product_inchis": distinct_list(row[2] for row in prods),
+            }
+        if rxn_required and (rxn_info is None or key[0] <= 0):
+            continue  # as the 'ifnull(rxn_info.id, 0)>0' of build_rule_query
+
+        prod_ids = [row[4] for row in prod_rows if row[4] is not None]
+        stoichios = [row[5] for row in prod_rows if row[5] is not None]
+        total = sum(stoichios) if stoichios else None
+        info = rxn_info or NO_RXN_INFO
+        for rule in rule_rows:  # duplicated rule keys repeat the row, as in the SQL join
+            reaction_id, substrate_id, diameter, stereo, substrate_cpd, direction, score, smarts = rule
+            if total is not None and total > 1:
+                smarts = unwrap_smarts(smarts)
+            batch.append({
+                "reaction_id": reaction_id, "repo_rxn_id": info["repo_rxn_id"], "ec_numbers": info["ec_numbers"],
+                "rule_substrate_id": substrate_id, "rule_substrate_cpd": substrate_cpd,
+                "direction": direction, "diameter": diameter, "isStereo": stereo, "score": score,
+                "SMARTS": smarts, "Reactants": "Any", "rule_prod_ids": prod_ids, "rule_prod_stoichios": stoichios,
+                "rxn_substrate_ids": info["rxn_substrate_ids"], "rxn_substrate_inchis": info["rxn_substrate_inchis"],
+                "rxn_product_ids": info["rxn_product_ids"], "rxn_product_inchis": info["rxn_product_inchis"],
+                "Products": repeat_any_lookup(total) if total is not None else None,
+                "Name": rule_name(reaction_id, info["repo_rxn_id"], substrate_cpd, diameter, direction, stereo),
+            })
+            n_rows += 1
+            if row_count > 0 and n_rows >= row_count:
+                yield batch
+                return
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def write_rule_jsonl(record_batches, fpath):
+    """
+    write_rule_jsonl: write the nested rule rows as JSON Lines, one rule object
+    per line with its list columns as JSON arrays
+    :param record_batches: an iterable of lists of dicts, see iter_nested_rule_rows
+    :param fpath: the output filename with path
+    :return: the number of rows written
+    """
+    n_rows = 0
+    with open(fpath, "w") as file_obj:
+        for records in record_batches:
+            file_obj.writelines(json.dumps(rec) + "\n" for rec in records)
+            n_rows += len(records)
+    return n_rows
+
+
+def nested_arrow_schema():
+    """
+    nested_arrow_schema: the Arrow schema of the nested rule table, with
+    list<string> and list<int64> columns for LIST_COLUMNS
+    :return: a pyarrow.Schema with the RULE_TABLE_HEADER columns
+    """
+    require_pyarrow()
+    types = {
+        "reaction_id": pa.int64(), "rule_substrate_id": pa.int64(),
+        "direction": pa.int8(), "diameter": pa.int8(), "isStereo": pa.int8(),
+        "score": pa.float64(), "rule_prod_stoichios": pa.list_(pa.int64()),
+    }
+    for col in LIST_COLUMNS:
+        types.setdefault(col, pa.list_(pa.string()))
+    return pa.schema([pa.field(col, types.get(col, pa.string())) for col in RULE_TABLE_HEADER])
+
+
+def write_rule_arrow_nested(record_batches, fpath, compression="zstd"):
+    """
+    write_rule_arrow_nested: write the nested rule rows to an Arrow IPC file
+    with list columns, one record batch per input batch
+    :param record_batches: an iterable of lists of dicts, see iter_nested_rule_rows
+    :param fpath: the output filename with path
+    :param compression: the IPC buffer compression ('zstd', 'lz4' or None)
+    :return: the number of rows written
+    """
+    schema = nested_arrow_schema()
+    n_rows = 0
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    with atomic_path(fpath) as tmp_fpath:
+        with pa.OSFile(tmp_fpath, "wb") as sink, pa.ipc.new_file(sink, schema, options=options) as writer:
+            for records in record_batches:
+                writer.write_batch(pa.RecordBatch.from_pylist(records, schema=schema))
+                n_rows += len(records)
+    return n_rows
+
+
+def generate_rule_table_nested(conn, fpath, diam=10, fmt="jsonl", row_count=0,
+                               batch_size=FETCH_BATCH_SIZE, filters=None):
+    """
+    generate_rule_table_nested: stream the rule table with real list columns to
+    a JSON Lines or an Arrow IPC file
+    :param conn: the Connection object
+    :param fpath: the output filename with path
+    :param diam: reaction diameter, or a list of diameters
+    :param fmt: 'jsonl' or 'arrow'
+    :param row_count: number of rows to output, if 0 output all
+    :param batch_size: number of rows fetched and written at a time
+    :param filters: optional dict of extra iter_nested_rule_rows filters, e.g., {'ec_prefix': '1.1.'}
+    :return: the number of rows written
+    """
+    record_batches = iter_nested_rule_rows(conn, diam, row_count=row_count, batch_size=batch_size,
+                                           **(filters or {}))
+    if fmt == "jsonl":
+        return write_rule_jsonl(record_batches, fpath)
+    elif fmt == "arrow":
+        return write_rule_arrow_nested(record_batches, fpath)
+    raise ValueError("unknown nested format: {}".format(fmt))
+
+
+def main():
+    """
+    main: export the rules of one diameter as JSON Lines with list columns
+    """
+    database = "/Users/qzhang/qzwk_dir/upload_RetroRules/retrorules_dump/mvc.db"
+    diam = 16
+    outfile_nm = "../TSVs/retro_rules_dia{}_all.jsonl".format(diam)
+
+    print("0. create a database connection...")
+    conn = create_connection(database, read_only=True, profile="fast_read")
+    with conn:
+        print("1. Query tables and stream the nested rules to {}".format(outfile_nm))
+        n_rows = generate_rule_table_nested(conn, outfile_nm, diam, "jsonl")
+        print("2. Wrote {} rows to {}".format(n_rows, outfile_nm))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+import sqlite3
+import csv
+import heapq
+import multiprocessing
+import os
+import shutil
+
+from db_connection import create_connection
+from retroRules import execute_query, generate_rule_per_row_table_stream, FETCH_BATCH_SIZE
+
+
+def open_read_only(db_file, profile=None):
+    """
+    open_read_only: open a read-only connection to the SQLite database, as used
+    by each worker process
+    :param db_file: database file
+    :param profile: a db_connection.PRAGMA_PROFILES name to tune the connection with
+    :return: Connection object
+    """
+    conn = create_connection(db_file, read_only=True, profile=profile)
+    if conn is None:
+        raise sqlite3.OperationalError("unable to open database file {}".format(db_file))
+    return conn
+
+
+def range_shard_filters(conn, n_shards, diam=10):
+    """
+    range_shard_filters: split the rule space into contiguous reaction_id ranges
+    holding about the same number of rules each
+    :param conn: the Connection object
+    :param n_shards: the number of shards
+    :param diam: reaction diameter
+    :return: a list of reaction id filters (see build_rule_query), in key order
+    """
+    rxn_ids = [row[0] for row in execute_query(
+        conn, "select reaction_id from rules where diameter={} order by reaction_id".format(diam)) or []]
+    if not rxn_ids:
+        return []
+
+    # shard boundaries at the rule count quantiles, never splitting a reaction
+    bounds = []
+    for k in range(1, n_shards):
+        bound = rxn_ids[len(rxn_ids) * k // n_shards]
+        if (not bounds or bound > bounds[-1]) and bound > rxn_ids[0]:
+            bounds.append(bound)
+
+    filters = []
+    lower = None
+    for bound in bounds:
+        if lower is None:
+            filters.append("{{col}} < {}".format(bound))
+        else:
+            filters.append("{{col}} >= {} and {{col}} < {}".format(lower, bound))
+        lower = bound
+    filters.append("{{col}} >= {}".format(lower) if lower is not None else "1=1")
+    return filters
+
+
+def hash_shard_filters(n_shards):
+    """
+    hash_shard_filters: split the rule space by reaction_id modulo n_shards
+    :param n_shards: the number of shards
+    :return: a list of reaction id filters (see build_rule_query)
+    """
+    return ["{{col}} % {} = {}".format(n_shards, k) for k in range(n_shards)]
+
+
+def export_shard(args):
+    """
+    export_shard: the worker task, exporting one shard in rule key order on
+    its own read-only connection
+    :param args: a tuple of (db_file, shard_fpath, diam, reaction_filter, batch_size)
+    :return: a tuple of (shard_fpath, number of rows written)
+    """
+    db_file, shard_fpath, diam, reaction_filter, batch_size = args
+    conn = open_read_only(db_file)
+    try:
+        n_rows = generate_rule_per_row_table_stream(
+            conn, shard_fpath, 0, diam, batch_size, ordered=True, reaction_filter=reaction_filter)
+    finally:
+        conn.close()
+    return (shard_fpath, n_rows)
+
+
+def rule_key(row):
+    """
+    rule_key: the sort key (reaction_id, rule_substrate_id, diameter, isStereo)
+    of a row read back from a shard file
+    """
+    return (int(row[0]), int(row[3]), int(row[6]), int(row[7]))
+
+
+def merge_shards(shard_fpaths, fpath, sorted_merge):
+    """
+    merge_shards: merge the shard files into a single TSV with one header
+    :param shard_fpaths: the shard files, in shard order
+    :param fpath: filename with path to write to
+    :param sorted_merge: k-way merge by rule key (hash shards), instead of
+    concatenating the shards in order (range shards)
+    """
+    if not sorted_merge:
+        with open(fpath, "wb") as out_file:
+            for k, shard_fpath in enumerate(shard_fpaths):
+                with open(shard_fpath, "rb") as shard_file:
+                    header = shard_file.readline()
+                    if k == 0:
+                        out_file.write(header)
+                    shutil.copyfileobj(shard_file, out_file)
+        return
+
+    with open(fpath, "w", newline="") as out_file:
+        shard_files = [open(shard_fpath, "r", newline="") for shard_fpath in shard_fpaths]
+        try:
+            readers = [csv.reader(f, delimiter='\t') for f in shard_files]
+            writer = csv.writer(out_file, delimiter='\t')
+            for k, reader in enumerate(readers):
+                header = next(reader, None)
+                if k == 0 and header is not None:
+                    writer.writerow(header)
+            writer.writerows(heapq.merge(*readers, key=rule_key))
+        finally:
+            for f in shard_files:
+                f.close()
+
+
+def parallel_rule_export(db_file, fpath, diam=10, n_workers=None, n_shards=None,
+                         shard_mode="range", merge=True, batch_size=FETCH_BATCH_SIZE):
+    """
+    parallel_rule_export: export the rule table of the given diameter with a
+    process pool, one shard of the reaction_id space per task. The merged
+    output has the same rows, in the same order, as the serial
+    generate_rule_per_row_table_stream(..., ordered=True) export.
+    :param db_file: database file
+    :param fpath: filename with path to write to; shards are written next to it
+    :param diam: reaction diameter
+    :param n_workers: number of worker processes, default the number of CPUs
+    :param n_shards: number of shards, default n_workers
+    :param shard_mode: 'range' (contiguous reaction_id ranges) or 'hash' (reaction_id modulo)
+    :param merge: merge the shards into fpath, otherwise leave them as a partitioned dataset
+    :param batch_size: number of rows fetched and written at a time per worker
+    :return: a tuple of (list of shard files or [fpath] if merged, total number of rows)
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    n_shards = n_shards or n_workers
+
+    if shard_mode == "range":
+        conn = open_read_only(db_file)
+        filters = range_shard_filters(conn, n_shards, diam)
+        conn.close()
+    elif shard_mode == "hash":
+        filters = hash_shard_filters(n_shards)
+    else:
+        raise ValueError("unknown shard_mode: {}".format(shard_mode))
+
+    base, ext = os.path.splitext(fpath)
+    tasks = [(db_file, "{}.shard{:03d}{}".format(base, k, ext), diam, f, batch_size)
+             for k, f in enumerate(filters)]
+
+    with multiprocessing.Pool(min(n_workers, len(tasks) or 1)) as pool:
+        results = pool.map(export_shard, tasks)
+
+    shard_fpaths = [r[0] for r in results]
+    n_rows = sum(r[1] for r in results)
+    if not merge:
+        return (shard_fpaths, n_rows)
+
+    merge_shards(shard_fpaths, fpath, sorted_merge=(shard_mode == "hash"))
+    for shard_fpath in shard_fpaths:
+        os.remove(shard_fpath)
+    return ([fpath], n_rows)
+
+
+def main():
+    """
+    main: export the rule table in parallel shards
+    """
+    database = "/Users/qzhang/qzwk_dir/upload_RetroRules/retrorules_dump/mvc.db"
+    diam = 16
+    outfile_nm = "../TSVs/retro_rules_dia{}_all".format(str(diam)) + ".tsv"
+
+    print("1. Query tables in parallel shards...")
+    fpaths, n_rows = parallel_rule_export(database, outfile_nm, diam)
+    print("2. Wrote {} rows to output file(s) {}".format(n_rows, ", ".join(fpaths)))
+
+
+if __name__ == '__main__':
+    main()
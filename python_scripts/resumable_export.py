@@ -0,0 +1,151 @@
+import json
+import os
+
+from atomic_files import atomic_path, write_json_atomic
+from parallel_export import open_read_only, range_shard_filters, merge_shards
+from retroRules import generate_rule_per_row_table_stream, FETCH_BATCH_SIZE
+
+# bump whenever the manifest layout or the part files change
+MANIFEST_VERSION = "1"
+
+# the default number of key ranges (and part files) of an export
+DEFAULT_RANGES = 64
+
+
+def manifest_path(fpath):
+    """
+    manifest_path: the checkpoint manifest file of an export
+    """
+    return fpath + ".manifest.json"
+
+
+def part_path(fpath, k):
+    """
+    part_path: the part file of the k-th key range of an export
+    """
+    base, ext = os.path.splitext(fpath)
+    return "{}.part{:04d}{}".format(base, k, ext)
+
+
+def source_signature(db_file):
+    """
+    source_signature: identify the state of the source database by its size and
+    modification time, so a checkpoint of another release is never resumed
+    """
+    st = os.stat(db_file)
+    return {"path": os.path.abspath(db_file), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def read_manifest(fpath):
+    """
+    read_manifest: the checkpoint manifest of an export, None if there is none
+    """
+    mpath = manifest_path(fpath)
+    if not os.path.exists(mpath):
+        return None
+    with open(mpath, "r") as file_obj:
+        return json.load(file_obj)
+
+
+def new_manifest(db_file, diam, n_ranges):
+    """
+    new_manifest: plan an export as contiguous reaction_id ranges holding about
+    the same number of rules each (see parallel_export.range_shard_filters)
+    :return: the manifest dict, with no part done
+    """
+    conn = open_read_only(db_file)
+    try:
+        ranges = range_shard_filters(conn, n_ranges, diam) or ["1=1"]  # no rules: one empty part
+    finally:
+        conn.close()
+    return {"version": MANIFEST_VERSION, "source": source_signature(db_file), "diameter": diam,
+            "ranges": ranges, "parts": {}}
+
+
+def part_done(fpath, manifest, k):
+    """
+    part_done: whether the k-th part was completed, i.e., it is in the manifest
+    and its file is there with the recorded size
+    """
+    part = manifest["parts"].get(str(k))
+    pfpath = part_path(fpath, k)
+    return part is not None and os.path.exists(pfpath) and os.path.getsize(pfpath) == part["bytes"]
+
+
+def resumable_rule_export(db_file, fpath, diam=10, n_ranges=DEFAULT_RANGES, batch_size=FETCH_BATCH_SIZE,
+                          max_parts=None):
+    """
+    resumable_rule_export: export the rule table of the given diameter range by
+    range, checkpointing each finished range in a manifest next to the output.
+    Each range is written to a part file under a temporary name and moved in
+    place once complete; a rerun after a crash (or a full disk) skips the parts
+    recorded in the manifest and continues with the next one. The parts are
+    concatenated into fpath at the end, with the same bytes as the
+    uninterrupted export, i.e., generate_rule_per_row_table_stream(..., ordered=True).
+    :param db_file: database file
+    :param fpath: filename with path to write to; the parts and the manifest are written next to it
+    :param diam: reaction diameter
+    :param n_ranges: the number of reaction_id ranges the export is split in
+    :param batch_size: number of rows fetched and written at a time
+    :param max_parts: stop after exporting this many parts, e.g., to fit a time window
+    :return: a tuple of (number of rows in the finished parts, True if fpath was written)
+    """
+    manifest = read_manifest(fpath)
+    if (manifest is None or manifest.get("version") != MANIFEST_VERSION or
+            manifest.get("source") != source_signature(db_file) or manifest.get("diameter") != diam):
+        manifest = new_manifest(db_file, diam, n_ranges)
+        write_json_atomic(manifest, manifest_path(fpath))
+
+    n_exported = 0
+    conn = open_read_only(db_file)
+    try:
+        for k, reaction_filter in enumerate(manifest["ranges"]):
+            if part_done(fpath, manifest, k):
+                continue
+            if max_parts is not None and n_exported >= max_parts:
+                break
+            pfpath = part_path(fpath, k)
+            with atomic_path(pfpath) as tmp_fpath:
+                n_rows = generate_rule_per_row_table_stream(conn, tmp_fpath, 0, diam, batch_size,
+                                                            ordered=True, reaction_filter=reaction_filter)
+            manifest["parts"][str(k)] = {"rows": n_rows, "bytes": os.path.getsize(pfpath)}
+            write_json_atomic(manifest, manifest_path(fpath))
+            n_exported += 1
+    finally:
+        conn.close()
+
+    n_rows = sum(part["rows"] for part in manifest["parts"].values())
+    pfpaths = [part_path(fpath, k) for k in range(len(manifest["ranges"]))]
+    if not all(part_done(fpath, manifest, k) for k in range(len(pfpaths))):
+        return (n_rows, False)
+
+    with atomic_path(fpath) as tmp_fpath:
+        merge_shards(pfpaths, tmp_fpath, sorted_merge=False)
+    for pfpath in pfpaths:
+        os.remove(pfpath)
+    os.remove(manifest_path(fpath))
+    return (n_rows, True)
+
+
+def main():
+    """
+    main: export the rule table with checkpoints; rerun it to resume an interrupted export
+    """
+    database = "/Users/qzhang/qzwk_dir/upload_RetroRules/retrorules_dump/mvc.db"
+    diam = 16
+    outfile_nm = "../TSVs/retro_rules_dia{}_all".format(str(diam)) + ".tsv"
+
+    manifest = read_manifest(outfile_nm)
+    if manifest is not None:
+        print("0. Resume the export from {} ({} of {} parts done)".format(
+            manifest_path(outfile_nm), len(manifest["parts"]), len(manifest["ranges"])))
+    print("1. Query tables range by range...")
+    n_rows, done = resumable_rule_export(database, outfile_nm, diam)
+    if done:
+        print("2. Wrote {} rows to output file {}".format(n_rows, outfile_nm))
+    else:
+        print("2. Exported {} rows so far, rerun to continue".format(n_rows))
+
+
+if __name__ == '__main__':
+    main()
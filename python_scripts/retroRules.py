@@ -1,193 +1,191 @@
-
 import sqlite3
 from sqlite3 import Error
 import itertools
 import csv
+import os
 import re
+import datetime
+
+from db_connection import create_connection, execute_query_iter, FETCH_BATCH_SIZE
+from export_metrics import ExportMetrics, NO_METRICS
+from compressed_output import open_text_output, compressed_fpath
+
+
+# the key that uniquely identifies a rule, used to give exports a deterministic order
+RULE_KEY_ORDER = "rl_info1.reaction_id,rl_info1.rule_substrate_id,rl_info1.diameter,rl_info1.isStereo"
+
+# the rule diameters available in RetroRules
+ALL_DIAMETERS = (2, 4, 6, 8, 10, 12, 14, 16)
+
+# the ways to compute the rule rows: the nested SQL query or the NumPy hash joins
+RULE_JOIN_ENGINES = ("sql", "hash_join")
+
+RULE_TABLE_HEADER = [
+    "reaction_id", "repo_rxn_id", "ec_numbers", "rule_substrate_id", "rule_substrate_cpd",
+    "direction", "diameter", "isStereo", "score", "SMARTS", "Reactants", "rule_prod_ids",
+    "rule_prod_stoichios", "rxn_substrate_ids", "rxn_substrate_inchis", "rxn_product_ids",
+    "rxn_product_inchis", "Products", "Name"]
 
+# the rule table header when the SMARTS are written to a separate dictionary file
+RULE_TABLE_HEADER_SMARTS_KEY = ["smarts_key" if col == "SMARTS" else col for col in RULE_TABLE_HEADER]
 
-def create_connection(db_file):
-    """ create a database connection to the SQLite database
-        specified by the db_file
-    :param db_file: database file
-    :return: Connection object or None
+SMARTS_DICT_HEADER = ["smarts_key", "smarts_id", "SMARTS"]
+
+# the multi-product SMARTS wrapping '>>(...)' removed by the post-processing
+SMARTS_UNWRAP_PATTERN = re.compile(r'>>\((.*)\)$')
+
+# the repository compound/reaction id resolution: seed, then bigg, kegg, metacyc, mnx
+CPD_ID_EXPR = "ifnull(cs.seed, ifnull(cs.bigg, ifnull(cs.kegg, ifnull(cs.metacyc, cs.mnxm))))"
+RXN_ID_EXPR = "ifnull(rxn1.seed, ifnull(rxn1.bigg, ifnull(rxn1.kegg, ifnull(rxn1.metacyc, rxn1.mnxr))))"
+
+
+def diameter_condition(diam, col="rl_info.diameter"):
     """
-    try:
-        conn = sqlite3.connect(db_file)
-        return conn
-    except Error as e:
-        print(e)
- 
-    return None
+    diameter_condition: build the diameter filter of the rule queries
+    :param diam: a single reaction diameter or a list/tuple of diameters
+    :param col: the (qualified) diameter column name to filter on
+    :return: an sqlite3 where condition string
+    """
+    if isinstance(diam, (list, tuple, set)):
+        return col + " in (" + ",".join(str(d) for d in sorted(diam)) + ")"
+    return col + "=" + str(diam)
 
 
-def build_query(diam=10):
+def sql_literal(value):
     """
-    build_query: construct a query across tables rules, rule_products, reaction, smarts,
-    reaction_substrates, reaction_products, chemical_species and ec_numbers
-    :param diam: reaction diameter
-    :return: an sqlite3 query string
+    sql_literal: render a Python value as an sqlite3 literal
+    :param value: a str, int or float
+    :return: the literal string, with single quotes escaped for strings
     """
-    rl_info = """
-                select rl.reaction_id,rl.substrate_id,rl.rule_substrate_cpd,rl.diameter,rl.direction,rl.isStereo,rl.score,rl.SMARTS,
-                product_per_rxn_sub_dia_isStereo.rule_prod_ids,product_per_rxn_sub_dia_isStereo.rule_prod_stoichios,
-                product_per_rxn_sub_dia_isStereo.total_stoichios
-                from
-                (
-                    select r.reaction_id,r.substrate_id,r.score,r.isStereo,s.smarts_string as SMARTS,r.diameter,r.direction,
-                    cs_info.repo_cpd_id as rule_substrate_cpd
-                    from rules r, smarts s,
-                    (
-                        select cs.id, ifnull(cs.seed, ifnull(cs.bigg, ifnull(cs.kegg, ifnull(cs.metacyc, cs.mnxm)))) as repo_cpd_id
-                        from chemical_species cs
-                    ) as cs_info
-                    where s.id=r.smarts_id and cs_info.id=r.substrate_id
-                ) as rl,
-                (
-                    select reaction_id,substrate_id,diameter,isStereo,
-                    group_concat(repo_prod_id) as rule_prod_ids,
-                    group_concat(prod_stoichio) as rule_prod_stoichios,
-                    sum(prod_stoichio) as total_stoichios
-                    from
-                    (
-                        select rp.reaction_id, rp.substrate_id, rp.diameter,rp.isStereo,
-                        cs_info1.repo_cpd_id as repo_prod_id, rp.stochiometry as prod_stoichio
-                        from rule_products rp,
-                        (
-                            select cs.id, ifnull(cs.seed, ifnull(cs.bigg, ifnull(cs.kegg, ifnull(cs.metacyc, cs.mnxm)))) as repo_cpd_id
-                            from chemical_species cs
-                        ) as cs_info1
-                        where rp.product_id=cs_info1.id
-                    )
-                    group by reaction_id,substrate_id,diameter,isStereo
-                ) as product_per_rxn_sub_dia_isStereo
-                where (rl.reaction_id=product_per_rxn_sub_dia_isStereo.reaction_id and
-                rl.substrate_id=product_per_rxn_sub_dia_isStereo.substrate_id and
-                rl.diameter=product_per_rxn_sub_dia_isStereo.diameter and
-                rl.isStereo=product_per_rxn_sub_dia_isStereo.isStereo)
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    return str(value)
+
+
+def prefix_condition(expr, prefix):
     """
-    rl_info1 = """(
-        select rl_info.reaction_id,rl_info.substrate_id as rule_substrate_id,rl_info.rule_substrate_cpd,rl_info.direction,
-        rl_info.diameter,rl_info.isStereo,rl_info.score,rl_info.SMARTS,rl_info.rule_prod_ids,
-        rl_info.rule_prod_stoichios,rl_info.total_stoichios
-        from (""" + rl_info + ") as rl_info where rl_info.diameter=" + str(diam) + ") as rl_info1"
+    prefix_condition: a 'starts with' condition as LIKE 'prefix%', i.e., case
+    insensitive for ASCII letters like the original "like 'rxn%'" filter, with
+    the '%' and '_' of the prefix escaped
+    :param expr: the sqlite3 expression to test
+    :param prefix: the prefix string
+    :return: an sqlite3 condition string
+    """
+    pattern = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    return expr + " like " + sql_literal(pattern) + " escape '\\'"
 
-    rxn_info = """(
-        select rxn_substrates_tab.id,rxn_substrates_tab.repo_rxn_id,rxn_substrates_tab.ec_numbers,
-        rxn_substrates_tab.substrate_ids as rxn_substrate_ids,rxn_substrates_tab.substrate_inchi_keys as rxn_substrate_inchis,
-        rxn_products_tab.product_ids as rxn_product_ids,rxn_products_tab.product_inchi_keys as rxn_product_inchis
-        from
-        (
-            select rxn.id, rxn.repo_rxn_id,group_concat(distinct rxn.ec_number) as ec_numbers,
-            group_concat(distinct rxn_substrates.substrate_cpd) as substrate_ids,
-            group_concat(distinct rxn_substrates.inchi_key) as substrate_inchi_keys
-            from
-            (
-                select rxn2.id, rxn2.repo_rxn_id,er.ec_number
-                from
-                (
-                    select rxn1.id, rxn1.seed as repo_rxn_id
-                    from reactions rxn1
-                    where rxn1.seed not null
-                ) as rxn2
-                left join ec_reactions er
-                on er.reaction_id=rxn2.id
-            ) as rxn
-            left join
-            (
-                select rs.reaction_id, cs_info.cpd_id as substrate_cpd, rs.chemical_id, cs_info.inchi_key
-                from
-                (
-                    select distinct cs.id as chem_sp_id, cs.inchi_key,ifnull(cs.seed, ifnull(cs.bigg, ifnull(cs.kegg, ifnull(cs.metacyc, cs.mnxm)))) as cpd_id
-                    from chemical_species cs
-                ) as cs_info, reaction_substrates rs
-                where rs.chemical_id=cs_info.chem_sp_id
-            ) as rxn_substrates
-            on rxn.id=rxn_substrates.reaction_id
-            group by rxn.id
-        ) as rxn_substrates_tab,
-        (
-            select rxn.id, rxn.repo_rxn_id,group_concat(distinct rxn.ec_number) as ec_numbers,
-            group_concat(distinct rxn_products.product_cpd) as product_ids,
-            group_concat(distinct rxn_products.inchi_key) as product_inchi_keys
-            from
-            (
-                select rxn2.id, rxn2.repo_rxn_id,er.ec_number
-                from
-                (
-                    select rxn1.id, rxn1.seed as repo_rxn_id
-                    from reactions rxn1
-                    where rxn1.seed not null
-                ) as rxn2
-                left join ec_reactions er
-                on er.reaction_id=rxn2.id
-            ) as rxn
-            left join
-            (
-                select rp.reaction_id, cs_info.cpd_id as product_cpd,rp.chemical_id,cs_info.inchi_key
-                from
-                (
-                    select distinct cs.id as chem_sp_id, cs.inchi_key,ifnull(cs.seed, ifnull(cs.bigg, ifnull(cs.kegg, ifnull(cs.metacyc, cs.mnxm)))) as cpd_id
-                    from chemical_species cs
-                ) as cs_info, reaction_products rp
-                where rp.chemical_id=cs_info.chem_sp_id
-            ) as rxn_products
-            on rxn.id=rxn_products.reaction_id
-            group by rxn.id
-        ) as rxn_products_tab
-        where rxn_substrates_tab.id=rxn_products_tab.id
-    ) as rxn_info
+
+def cpd_id_expr(seed_cpds):
+    """
+    cpd_id_expr: the repository compound id of chemical_species cs, i.e., seed
+    for seed-only queries, otherwise the first of seed/bigg/kegg/metacyc/mnxm
     """
+    return "cs.seed" if seed_cpds else CPD_ID_EXPR
 
-    qry = rl_info1 + " left join " + rxn_info + " on rxn_info.id=rl_info1.reaction_id "
 
-    qry = """
-    select rl_info1.reaction_id,rxn_info.repo_rxn_id,rxn_info.ec_numbers,
-        rl_info1.rule_substrate_id,rl_info1.rule_substrate_cpd,
-        rl_info1.direction,rl_info1.diameter,rl_info1.isStereo,rl_info1.score,
-        rl_info1.SMARTS, 'Any' as Reactants, rl_info1.rule_prod_ids,
-        rl_info1.rule_prod_stoichios,rxn_info.rxn_substrate_ids,rxn_info.rxn_substrate_inchis,
-        rxn_info.rxn_product_ids,rxn_info.rxn_product_inchis,rl_info1.total_stoichios,
-        (select '<'||rl_info1.reaction_id||'|'||rxn_info.repo_rxn_id||'|'||
-            rl_info1.rule_substrate_cpd||'|'||rl_info1.diameter||'|'||
-            (SELECT
-            CASE
-                WHEN rl_info1.direction=-1 THEN 'reverse'
-                ELSE 'forward'
-            END) ||
-            (SELECT
-            CASE
-                WHEN rl_info1.isStereo=1 THEN '|'||'isStereo'||'>'
-                ELSE ''||'>'
-            END) as Name)
-    from """ + qry
+def rxn_id_expr(seed_cpds):
+    """
+    rxn_id_expr: the repository reaction id of reactions rxn1, i.e., the first
+    of seed/bigg/kegg/metacyc/mnxr for seed-only queries, otherwise seed
+    """
+    return RXN_ID_EXPR if seed_cpds else "rxn1.seed"
 
-    return qry
+
+def and_conditions(conds, keyword="where"):
+    """
+    and_conditions: join the non-empty conditions into a where clause
+    :param conds: a list of sqlite3 conditions
+    :param keyword: the clause keyword, e.g., 'where' or 'and'
+    :return: the clause string, empty if there are no conditions
+    """
+    conds = [c for c in conds if c]
+    if not conds:
+        return ""
+    return "\n" + keyword + " " + " and ".join(conds)
 
 
-def build_query_seed_cpds(diam=10):
+def rule_query_filters(seed_cpds=False, reaction_filter=None, repo_prefix=None, ec_prefix=None,
+                       min_score=None, is_stereo=None, substrate_cpds=None):
     """
-    build_query_seed_cpds: construct a query across tables rules, rule_products, reaction, smarts,
-    reaction_substrates, reaction_products, chemical_species and ec_numbers ONLY for rules that
-    have seed reactants/products
-    :param diam: reaction diameter
-    :return: an sqlite3 query string
+    rule_query_filters: turn the export filters into the conditions pushed into
+    the innermost subqueries of the rule query
+    :param seed_cpds: the seed-only variant of the query
+    :param reaction_filter: condition on the reaction id with a {col} placeholder
+    :param repo_prefix: keep the reactions whose repository id starts with it, e.g., 'rxn'
+    :param ec_prefix: keep the reactions with an EC number starting with it, e.g., '1.1.'
+    :param min_score: keep the rules scoring at least min_score
+    :param is_stereo: keep the stereo (1) or non-stereo (0) rules only
+    :param substrate_cpds: keep the rules whose substrate is one of these compound ids
+    :return: a dict of templated conditions per subquery: 'rxn' (reactions rxn1),
+    'rule' (rules r, with cs_info) and 'rule_product' (rule_products rp)
+    """
+    rxn_conds = []  # conditions on a reaction id column {col}
+    if reaction_filter:
+        rxn_conds.append(reaction_filter)
+    if ec_prefix:
+        rxn_conds.append("{col} in (select er.reaction_id from ec_reactions er where " +
+                         prefix_condition("er.ec_number", ec_prefix) + ")")
+
+    filters = {"rxn": [c.format(col="rxn1.id") for c in rxn_conds],
+               "rule": [c.format(col="r.reaction_id") for c in rxn_conds],
+               "rule_product": [c.format(col="rp.reaction_id") for c in rxn_conds]}
+
+    if repo_prefix:
+        repo_cond = prefix_condition(rxn_id_expr(seed_cpds), repo_prefix)
+        filters["rxn"].append(repo_cond)
+        rxn_ids = "(select rxn1.id from reactions rxn1 where " + repo_cond + ")"
+        filters["rule"].append("r.reaction_id in " + rxn_ids)
+        filters["rule_product"].append("rp.reaction_id in " + rxn_ids)
+    if min_score is not None:
+        filters["rule"].append("r.score>=" + sql_literal(min_score))
+    if is_stereo is not None:
+        filters["rule"].append("r.isStereo=" + sql_literal(int(is_stereo)))
+        filters["rule_product"].append("rp.isStereo=" + sql_literal(int(is_stereo)))
+    if substrate_cpds:
+        cpd_list = "(" + ",".join(sql_literal(c) for c in substrate_cpds) + ")"
+        filters["rule"].append("cs_info.repo_cpd_id in " + cpd_list)
+        filters["rule_product"].append("rp.substrate_id in (select cs.id from chemical_species cs where " +
+                                       cpd_id_expr(seed_cpds) + " in " + cpd_list + ")")
+    return filters
+
+
+def cpd_info_subquery(seed_cpds, alias):
+    """
+    cpd_info_subquery: the compound id resolution over chemical_species
+    :param seed_cpds: the seed-only variant
+    :param alias: the subquery alias
+    :return: an sqlite3 subquery string
+    """
+    return """(
+                        select cs.id, """ + cpd_id_expr(seed_cpds) + """ as repo_cpd_id
+                        from chemical_species cs""" + and_conditions(
+        ["cs.seed not null" if seed_cpds else ""]) + """
+                    ) as """ + alias
+
+
+def rule_info_subquery(diam, seed_cpds, filters, smarts_ids=False):
     """
+    rule_info_subquery: the rules with their SMARTS, substrate compound and
+    aggregated products (rl_info1)
+    :param diam: reaction diameter, or a list of diameters
+    :param seed_cpds: the seed-only variant
+    :param filters: the result of rule_query_filters
+    :param smarts_ids: select the SMARTS id (smarts.id) instead of the SMARTS string
+    :return: an sqlite3 subquery string
+    """
+    smarts_col = "s.id" if smarts_ids else "s.smarts_string"
     rl_info = """
                 select rl.reaction_id,rl.substrate_id,rl.rule_substrate_cpd,rl.diameter,rl.direction,rl.isStereo,rl.score,rl.SMARTS,
                 product_per_rxn_sub_dia_isStereo.rule_prod_ids,product_per_rxn_sub_dia_isStereo.rule_prod_stoichios,
                 product_per_rxn_sub_dia_isStereo.total_stoichios
                 from
                 (
-                    select r.reaction_id,r.substrate_id,r.score,r.isStereo,s.smarts_string as SMARTS,r.diameter,r.direction,
+                    select r.reaction_id,r.substrate_id,r.score,r.isStereo,""" + smarts_col + """ as SMARTS,r.diameter,r.direction,
                     cs_info.repo_cpd_id as rule_substrate_cpd
                     from rules r, smarts s,
-                    (
-                        select cs.id, cs.seed as repo_cpd_id
-                        from chemical_species cs
-                        where cs.seed not null
-                    ) as cs_info
-                    where s.id=r.smarts_id and cs_info.id=r.substrate_id
+                    """ + cpd_info_subquery(seed_cpds, "cs_info") + """
+                    where s.id=r.smarts_id and cs_info.id=r.substrate_id""" + and_conditions(
+        [diameter_condition(diam, "r.diameter")] + filters["rule"], "and") + """
                 ) as rl,
                 (
                     select reaction_id,substrate_id,diameter,isStereo,
@@ -199,12 +197,9 @@ def build_query_seed_cpds(diam=10):
                         select rp.reaction_id, rp.substrate_id, rp.diameter,rp.isStereo,
                         cs_info1.repo_cpd_id as repo_prod_id, rp.stochiometry as prod_stoichio
                         from rule_products rp,
-                        (
-                            select cs.id, cs.seed as repo_cpd_id
-                            from chemical_species cs
-                            where cs.seed not null
-                        ) as cs_info1
-                        where rp.product_id=cs_info1.id
+                        """ + cpd_info_subquery(seed_cpds, "cs_info1") + """
+                        where rp.product_id=cs_info1.id""" + and_conditions(
+        [diameter_condition(diam, "rp.diameter")] + filters["rule_product"], "and") + """
                     )
                     group by reaction_id,substrate_id,diameter,isStereo
                 ) as product_per_rxn_sub_dia_isStereo
@@ -213,80 +208,116 @@ def build_query_seed_cpds(diam=10):
                 rl.diameter=product_per_rxn_sub_dia_isStereo.diameter and
                 rl.isStereo=product_per_rxn_sub_dia_isStereo.isStereo)
     """
-    rl_info1 = """(
+    return """(
         select rl_info.reaction_id,rl_info.substrate_id as rule_substrate_id,rl_info.rule_substrate_cpd,rl_info.direction,
         rl_info.diameter,rl_info.isStereo,rl_info.score,rl_info.SMARTS,rl_info.rule_prod_ids,
         rl_info.rule_prod_stoichios,rl_info.total_stoichios
-        from (""" + rl_info + ") as rl_info where rl_info.diameter=" + str(diam) + ") as rl_info1"
+        from (""" + rl_info + ") as rl_info) as rl_info1"
 
-    rxn_info = """(
-        select rxn_substrates_tab.id,rxn_substrates_tab.repo_rxn_id,rxn_substrates_tab.ec_numbers,
-        rxn_substrates_tab.substrate_ids as rxn_substrate_ids,rxn_substrates_tab.substrate_inchi_keys as rxn_substrate_inchis,
-        rxn_products_tab.product_ids as rxn_product_ids,rxn_products_tab.product_inchi_keys as rxn_product_inchis
-        from
-        (
-            select rxn.id, rxn.repo_rxn_id,group_concat(distinct rxn.ec_number) as ec_numbers,
-            group_concat(distinct rxn_substrates.substrate_cpd) as substrate_ids,
-            group_concat(distinct rxn_substrates.inchi_key) as substrate_inchi_keys
-            from
-            (
-                select rxn2.id, rxn2.repo_rxn_id,er.ec_number
-                from
-                (
-                    select rxn1.id,  ifnull(rxn1.seed, ifnull(rxn1.bigg, ifnull(rxn1.kegg, ifnull(rxn1.metacyc, rxn1.mnxr)))) as repo_rxn_id
-                    from reactions rxn1
-                ) as rxn2
-                left join ec_reactions er
-                on er.reaction_id=rxn2.id
-            ) as rxn
-            left join
-            (
-                select rs.reaction_id, cs_info.cpd_id as substrate_cpd, rs.chemical_id, cs_info.inchi_key
-                from
-                (
-                    select distinct cs.id as chem_sp_id, cs.inchi_key, cs.seed as cpd_id
-                    from chemical_species cs
-                    where cs.seed not null
-                ) as cs_info, reaction_substrates rs
-                where rs.chemical_id=cs_info.chem_sp_id
-            ) as rxn_substrates
-            on rxn.id=rxn_substrates.reaction_id
-            group by rxn.id
-        ) as rxn_substrates_tab,
+
+def ec_numbers_subquery(table="ec_reactions"):
+    """
+    ec_numbers_subquery: the EC numbers of each reaction (ec), distinct and
+    sorted. They are fed to group_concat in order, so that they do not come out
+    in whichever order the join plan visits them (SQLite before 3.44 has no
+    order by inside an aggregate).
+    :param table: the ec_reactions table, e.g., 'src.ec_reactions'
+    :return: an sqlite3 subquery string
+    """
+    return """(
+                    select reaction_id, group_concat(ec_number) as ec_numbers
+                    from (select distinct reaction_id, ec_number from """ + table + """
+                          order by reaction_id, ec_number)
+                    group by reaction_id
+                ) as ec"""
+
+
+def rxn_side_subquery(side, seed_cpds, filters):
+    """
+    rxn_side_subquery: the reactions with their EC numbers and their aggregated
+    substrates or products
+    :param side: 'substrate' (reaction_substrates) or 'product' (reaction_products)
+    :param seed_cpds: the seed-only variant
+    :param filters: the result of rule_query_filters
+    :return: an sqlite3 subquery string
+    """
+    table = "reaction_substrates rs" if side == "substrate" else "reaction_products rp"
+    alias = table.split()[1]
+    rxn_conds = ([] if seed_cpds else ["rxn1.seed not null"]) + filters["rxn"]
+    return """
         (
-            select rxn.id, rxn.repo_rxn_id,group_concat(distinct rxn.ec_number) as ec_numbers,
-            group_concat(distinct rxn_products.product_cpd) as product_ids,
-            group_concat(distinct rxn_products.inchi_key) as product_inchi_keys
+            select rxn.id, rxn.repo_rxn_id,rxn.ec_numbers,
+            group_concat(distinct rxn_{side}s.{side}_cpd) as {side}_ids,
+            group_concat(distinct rxn_{side}s.inchi_key) as {side}_inchi_keys
             from
             (
-                select rxn2.id, rxn2.repo_rxn_id,er.ec_number
+                select rxn2.id, rxn2.repo_rxn_id,ec.ec_numbers
                 from
                 (
-                    select rxn1.id, ifnull(rxn1.seed, ifnull(rxn1.bigg, ifnull(rxn1.kegg, ifnull(rxn1.metacyc, rxn1.mnxr)))) as repo_rxn_id
-                    from reactions rxn1
+                    select rxn1.id, """.format(side=side) + rxn_id_expr(seed_cpds) + """ as repo_rxn_id
+                    from reactions rxn1""" + and_conditions(rxn_conds) + """
                 ) as rxn2
-                left join ec_reactions er
-                on er.reaction_id=rxn2.id
+                left join """ + ec_numbers_subquery() + """
+                on ec.reaction_id=rxn2.id
             ) as rxn
             left join
             (
-                select rp.reaction_id, cs_info.cpd_id as product_cpd, rp.chemical_id, cs_info.inchi_key
+                select {alias}.reaction_id, cs_info.cpd_id as {side}_cpd, {alias}.chemical_id, cs_info.inchi_key
                 from
                 (
-                    select distinct cs.id as chem_sp_id, cs.inchi_key, cs.seed as cpd_id
-                    from chemical_species cs
-                    where cs.seed not null
-                ) as cs_info, reaction_products rp
-                where rp.chemical_id=cs_info.chem_sp_id
-            ) as rxn_products
-            on rxn.id=rxn_products.reaction_id
+                    select distinct cs.id as chem_sp_id, cs.inchi_key, """.format(side=side, alias=alias) + \
+        cpd_id_expr(seed_cpds) + """ as cpd_id
+                    from chemical_species cs""" + and_conditions(["cs.seed not null" if seed_cpds else ""]) + """
+                ) as cs_info, """ + table + """
+                where {alias}.chemical_id=cs_info.chem_sp_id
+            ) as rxn_{side}s
+            on rxn.id=rxn_{side}s.reaction_id
             group by rxn.id
-        ) as rxn_products_tab
+        ) as rxn_{side}s_tab""".format(side=side, alias=alias)
+
+
+def rxn_info_subquery(seed_cpds, filters):
+    """
+    rxn_info_subquery: the reactions with their EC numbers, substrates and products (rxn_info)
+    :param seed_cpds: the seed-only variant
+    :param filters: the result of rule_query_filters
+    :return: an sqlite3 subquery string
+    """
+    return """(
+        select rxn_substrates_tab.id,rxn_substrates_tab.repo_rxn_id,rxn_substrates_tab.ec_numbers,
+        rxn_substrates_tab.substrate_ids as rxn_substrate_ids,rxn_substrates_tab.substrate_inchi_keys as rxn_substrate_inchis,
+        rxn_products_tab.product_ids as rxn_product_ids,rxn_products_tab.product_inchi_keys as rxn_product_inchis
+        from""" + rxn_side_subquery("substrate", seed_cpds, filters) + "," + \
+        rxn_side_subquery("product", seed_cpds, filters) + """
         where rxn_substrates_tab.id=rxn_products_tab.id
     ) as rxn_info
     """
 
-    qry = rl_info1 + " left join " + rxn_info + " on rxn_info.id=rl_info1.reaction_id "
+
+def build_rule_query(diam=10, seed_cpds=False, reaction_filter=None, repo_prefix=None, ec_prefix=None,
+                     min_score=None, is_stereo=None, substrate_cpds=None, limit=0, ordered=False,
+                     smarts_ids=False):
+    """
+    build_rule_query: compose the rule query across tables rules, rule_products,
+    reactions, smarts, reaction_substrates, reaction_products, chemical_species
+    and ec_reactions, with every filter pushed into the innermost subqueries and
+    the row count applied as an SQL LIMIT
+    :param diam: reaction diameter, or a list of diameters to query in one pass
+    :param seed_cpds: ONLY rules that have seed reactants/products
+    :param reaction_filter: condition on the reaction id with a {col} placeholder,
+    e.g., "{col} between 1 and 500"
+    :param repo_prefix: keep the reactions whose repository id starts with it, e.g., 'rxn'
+    :param ec_prefix: keep the reactions with an EC number starting with it, e.g., '1.1.'
+    :param min_score: keep the rules scoring at least min_score
+    :param is_stereo: keep the stereo (1) or non-stereo (0) rules only
+    :param substrate_cpds: keep the rules whose substrate is one of these compound ids
+    :param limit: the maximum number of rows, if 0 return all
+    :param ordered: sort the rows by the rule key (RULE_KEY_ORDER)
+    :param smarts_ids: return the SMARTS id in place of the SMARTS string (column 9)
+    :return: an sqlite3 query string
+    """
+    filters = rule_query_filters(seed_cpds, reaction_filter, repo_prefix, ec_prefix,
+                                 min_score, is_stereo, substrate_cpds)
 
     qry = """
     select rl_info1.reaction_id,rxn_info.repo_rxn_id,rxn_info.ec_numbers,
@@ -307,11 +338,54 @@ def build_query_seed_cpds(diam=10):
                 WHEN rl_info1.isStereo=1 THEN '|'||'isStereo'||'>'
                 ELSE ''||'>'
             END) as Name)
-    from """ + qry
-
+    from """ + rule_info_subquery(diam, seed_cpds, filters, smarts_ids) + " left join " + \
+        rxn_info_subquery(seed_cpds, filters) + " on rxn_info.id=rl_info1.reaction_id "
+
+    if repo_prefix or ec_prefix:
+        # the reactions filtered out of rxn_info must drop their rules as well,
+        # i.e., an inner join, but the join stays a LEFT JOIN (the rules the outer
+        # loop, rxn_info probed through an automatic index) with the unmatched rows
+        # removed by this condition. SQLite turns a LEFT JOIN into an inner join
+        # when the where clause rejects NULLs of rxn_info in a way it recognizes
+        # ('rxn_info.id not null', 'rxn_info.id>0'), and is then free to drive the
+        # join from rxn_info and rescan the rules once per reaction; it does not
+        # look through ifnull(). A CROSS JOIN keeps the order but loses the
+        # automatic index, about 100x slower on a 100k-rule database.
+        qry += " where ifnull(rxn_info.id, 0)>0"
+    if ordered:
+        qry += " order by " + RULE_KEY_ORDER
+    if limit > 0:
+        qry += " limit " + str(limit)
     return qry
 
 
+def build_query(diam=10, reaction_filter=None):
+    """
+    build_query: construct a query across tables rules, rule_products, reaction, smarts,
+    reaction_substrates, reaction_products, chemical_species and ec_numbers
+    :param diam: reaction diameter, or a list of diameters to query in one pass
+    :param reaction_filter: optional condition on the reaction id, with a {col}
+    placeholder for the column, pushed into the rule, rule product and reaction
+    subqueries, e.g., "{col} between 1 and 500"
+    :return: an sqlite3 query string
+    """
+    return build_rule_query(diam, reaction_filter=reaction_filter)
+
+
+def build_query_seed_cpds(diam=10, reaction_filter=None):
+    """
+    build_query_seed_cpds: construct a query across tables rules, rule_products, reaction, smarts,
+    reaction_substrates, reaction_products, chemical_species and ec_numbers ONLY for rules that
+    have seed reactants/products
+    :param diam: reaction diameter, or a list of diameters to query in one pass
+    :param reaction_filter: optional condition on the reaction id, with a {col}
+    placeholder for the column, pushed into the rule, rule product and reaction
+    subqueries, e.g., "{col} between 1 and 500"
+    :return: an sqlite3 query string
+    """
+    return build_rule_query(diam, seed_cpds=True, reaction_filter=reaction_filter)
+
+
 def execute_query(conn, qry):
     """
     execute_query: executes the given query qry against db connection conn
@@ -344,6 +418,20 @@ def repeat_any(N):
     return rep_str
 
 
+# repeat_any(N) precomputed for the common product stoichiometries
+REPEAT_ANY_TABLE = [repeat_any(n) for n in range(64)]
+
+
+def repeat_any_lookup(N):
+    """
+    repeat_any_lookup: repeat_any(N) from the precomputed REPEAT_ANY_TABLE,
+    falling back to repeat_any for stoichiometries beyond the table
+    """
+    if 0 <= N < len(REPEAT_ANY_TABLE):
+        return REPEAT_ANY_TABLE[N]
+    return repeat_any(N)
+
+
 def post_query_process(data_rows, row_count=0):
     """
     postQueryProcess: Further massage the data to meet with
@@ -352,26 +440,83 @@ def post_query_process(data_rows, row_count=0):
     :param row_count : The number of rows out of in_data to be processed
     """
     in_data = []
-    out_data = []
     if row_count > 0:
         in_data = data_rows[:row_count]
     else:
         in_data = data_rows
 
-    pattern = r'>>\((.*)\)$'
-    for row in in_data:
+    out_data = []
+    for i in range(0, len(in_data), FETCH_BATCH_SIZE):
+        out_data.extend(post_query_process_batch(in_data[i:i + FETCH_BATCH_SIZE]))
+
+    return out_data
+
+
+def unwrap_smarts(smt):
+    """
+    unwrap_smarts: turn a multi-product SMARTS 'A>>(B.C)' into 'A>>B.C', i.e.,
+    SMARTS_UNWRAP_PATTERN.sub(r'>>\1', smt) done with plain string operations
+    for the common case
+    :param smt : the SMARTS string
+    :return: the unwrapped SMARTS string
+    """
+    i = smt.find('>>(')
+    if i >= 0 and smt.endswith(')') and '\n' not in smt:
+        return smt[:i + 2] + smt[i + 3:-1]
+    return SMARTS_UNWRAP_PATTERN.sub(r'>>\1', smt)
+
+
+def post_query_process_batch(rows, smarts_cache=None):
+    """
+    post_query_process_batch: massage a whole batch of rule rows at once, with
+    the lookups hoisted out of the loop: the multi-product SMARTS are unwrapped
+    by unwrap_smarts and the 'total_stoichios' column is mapped to the
+    'Any;Any;...' Products strings through REPEAT_ANY_TABLE
+    :param rows : a list of rows (tuples) of the SQL query result
+    :param smarts_cache : optional dict of raw to unwrapped SMARTS, shared across
+    batches so that each distinct SMARTS is unwrapped only once
+    :return: a list of the processed rows as lists
+    """
+    out_data = []
+    append = out_data.append
+    for row in rows:
         lst_row = list(row)
         any_num = lst_row[17]  # 'total_stoichios'
-        smt = lst_row[9]  # 'SMARTS'
         if any_num > 1:
-            lst_row[9] = re.sub(pattern, r'>>\1', smt)
-        lst_row[17] = (repeat_any(any_num))
-        out_data.append(lst_row)
-
+            smt = lst_row[9]  # 'SMARTS'
+            if smarts_cache is None:
+                lst_row[9] = unwrap_smarts(smt)
+            else:
+                unwrapped = smarts_cache.get(smt)
+                if unwrapped is None:
+                    unwrapped = smarts_cache[smt] = unwrap_smarts(smt)
+                lst_row[9] = unwrapped
+        lst_row[17] = repeat_any_lookup(any_num)
+        append(lst_row)
     return out_data
 
 
-def generate_rule_per_row_table(conn, row_count=0, diam=10):
+def post_query_process_iter(row_batches, row_count=0, smarts_cache=None):
+    """
+    post_query_process_iter: the streaming counterpart of post_query_process,
+    massaging each batch of rows as it arrives from execute_query_iter
+    :param row_batches : an iterable of lists of rows (tuples)
+    :param row_count : The number of rows to be processed, if 0 process all
+    :param smarts_cache : optional dict memoizing the unwrapped SMARTS, see post_query_process_batch
+    :return: a generator of lists of processed rows
+    """
+    remaining = row_count
+    for rows in row_batches:
+        if row_count > 0:
+            rows = rows[:remaining]
+            remaining -= len(rows)
+        yield post_query_process_batch(rows, smarts_cache)
+        if row_count > 0 and remaining <= 0:
+            break
+
+
+def generate_rule_per_row_table(conn, row_count=0, diam=10, filters=None, metrics=NO_METRICS,
+                                engine="sql"):
     """
     generate_rule_per_row_table: Query the tables rules, rule_products,
     reactions, reaction_substrates, reaction_products, smarts,
@@ -379,16 +524,39 @@ def generate_rule_per_row_table(conn, row_count=0, diam=10):
     :param conn: the Connection object
     :param row_count: number of rows to output, if 0 return all
     :param diam: reaction diameter
+    :param filters: optional dict of extra build_rule_query filters,
+    e.g., {'ec_prefix': '1.1.', 'substrate_cpds': ['cpd17740']}; repo_prefix
+    defaults to 'rxn'
+    :param metrics: an ExportMetrics to record the query and transform stages in
+    :param engine: one of RULE_JOIN_ENGINES: 'sql' runs the nested rule query,
+    'hash_join' joins the base tables in Python (see rule_join_engine), with
+    the same rows in the same order
     :return: a list of rows (tuples) if no error, otherwise None
     """
-    qry = build_query(diam)
-    # qry_seed = (qry + " where rxn_info.repo_rxn_id='rxn14222'" +
-    #           " and rl_info1.rule_substrate_cpd='cpd17740'")
-    qry_seed = qry + " where rxn_info.repo_rxn_id like 'rxn%'"
+    if engine not in RULE_JOIN_ENGINES:
+        raise ValueError("unknown rule join engine: {}".format(engine))
+    filters = dict({'repo_prefix': 'rxn'}, **(filters or {}))
+    if engine == "hash_join":
+        from rule_join_engine import rule_rows_hash_join
+        with metrics.stage("query") as stage:
+            try:
+                qry_result = rule_rows_hash_join(conn, diam, limit=row_count, **filters)
+            except Error as e:
+                print("An error occurred:", e.args[0])
+                qry_result = None
+            stage.add_rows(len(qry_result or []))
+    else:
+        qry_seed = build_rule_query(diam, limit=row_count, **filters)
+        metrics.explain(conn, "rule_query", qry_seed)
 
-    qry_result = execute_query(conn, qry_seed)
+        with metrics.stage("query") as stage:
+            qry_result = execute_query(conn, qry_seed)
+            stage.add_rows(len(qry_result or []))
 
-    return post_query_process(qry_result, row_count)
+    with metrics.stage("transform") as stage:
+        out_data = post_query_process(qry_result, row_count)
+        stage.add_rows(len(out_data))
+    return out_data
 
 
 def generate_rule_per_row_table_seed_cpds(conn, row_count=0, diam=10):
@@ -401,12 +569,163 @@ def generate_rule_per_row_table_seed_cpds(conn, row_count=0, diam=10):
     :param diam: reaction diameter
     :return: a list of rows (tuples) if no error, otherwise None
     """
-    qry = build_query_seed_cpds(diam)
+    qry = build_rule_query(diam, seed_cpds=True, limit=row_count)
     qry_result = execute_query(conn, qry)
 
     return post_query_process(qry_result, row_count)
 
 
+def generate_rule_per_row_table_stream(conn, fpath, row_count=0, diam=10,
+                                       batch_size=FETCH_BATCH_SIZE, ordered=False,
+                                       reaction_filter=None, filters=None, metrics=NO_METRICS,
+                                       compression=None):
+    """
+    generate_rule_per_row_table_stream: the streaming version of
+    generate_rule_per_row_table, where the rows flow from the cursor through
+    post-processing to the TSV file batch by batch, so the memory use stays
+    flat regardless of the number of rules
+    :param conn: the Connection object
+    :param fpath: filename with path to write to
+    :param row_count: number of rows to output, if 0 output all
+    :param diam: reaction diameter
+    :param batch_size: number of rows fetched and written at a time
+    :param ordered: sort the rows by the rule key (RULE_KEY_ORDER)
+    :param reaction_filter: optional reaction id condition, see build_rule_query
+    :param filters: optional dict of extra build_rule_query filters; repo_prefix defaults to 'rxn'
+    :param metrics: an ExportMetrics to record the fetch, transform and write stages in
+    :param compression: None, 'gzip' or 'zstd', see csv_write_stream
+    :return: the number of rows written
+    """
+    qry_seed = build_rule_query(diam, reaction_filter=reaction_filter, limit=row_count, ordered=ordered,
+                                **dict({'repo_prefix': 'rxn'}, **(filters or {})))
+    metrics.explain(conn, "rule_query", qry_seed)
+
+    row_batches = metrics.iter_stage("fetch", execute_query_iter(conn, qry_seed, batch_size))
+    out_batches = metrics.iter_stage("transform", post_query_process_iter(row_batches, row_count))
+    with metrics.stage("write") as stage:
+        n_rows = csv_write_stream(out_batches, fpath, compression)
+        stage.add_rows(n_rows)
+        stage.add_bytes(os.path.getsize(fpath))
+    return n_rows
+
+
+def generate_rule_tables_per_diameter(conn, fpath_tmpl, diams=ALL_DIAMETERS, row_count=0,
+                                      batch_size=FETCH_BATCH_SIZE, metrics=NO_METRICS, compression=None):
+    """
+    generate_rule_tables_per_diameter: run the rule query once for all the given
+    diameters and route each row to its per-diameter TSV file, instead of running
+    the whole join once per diameter
+    :param conn: the Connection object
+    :param fpath_tmpl: output filename template with a {} placeholder for the diameter
+    :param diams: the reaction diameters to export
+    :param row_count: number of rows to output per diameter, if 0 output all
+    :param batch_size: number of rows fetched at a time
+    :param metrics: an ExportMetrics to record the fetch, transform and write stages in
+    :param compression: None, 'gzip' or 'zstd', see csv_write_stream
+    :return: a dict of diameter to the number of rows written
+    """
+    qry_seed = build_rule_query(list(diams), repo_prefix='rxn')
+    metrics.explain(conn, "rule_query", qry_seed)
+
+    files = {}
+    writers = {}
+    counts = dict((d, 0) for d in diams)
+    with metrics.stage("write") as write_stage:
+        try:
+            for d in diams:
+                files[d] = open_text_output(fpath_tmpl.format(d), compression)
+                writers[d] = csv.writer(files[d], delimiter='\t')  # create a csv.writer, tab delimited
+                writers[d].writerow(RULE_TABLE_HEADER)
+
+            for rows in metrics.iter_stage("fetch", execute_query_iter(conn, qry_seed, batch_size)):
+                with metrics.stage("transform") as stage:
+                    out_rows = post_query_process_batch(rows)
+                    stage.add_rows(len(out_rows))
+                for row in out_rows:
+                    d = row[6]  # 'diameter'
+                    if row_count > 0 and counts[d] >= row_count:
+                        continue
+                    writers[d].writerow(row)
+                    counts[d] += 1
+                if row_count > 0 and all(c >= row_count for c in counts.values()):
+                    break
+        finally:
+            for f in files.values():
+                f.close()
+        write_stage.add_rows(sum(counts.values()))
+        write_stage.add_bytes(sum(os.path.getsize(f.name) for f in files.values()))
+
+    return counts
+
+
+def fetch_smarts(conn, smarts_ids, chunk_size=500):
+    """
+    fetch_smarts: look up the SMARTS strings of the given smarts ids
+    :param conn: the Connection object
+    :param smarts_ids: an iterable of smarts.id
+    :param chunk_size: the number of ids per query
+    :return: a dict of smarts id to SMARTS string; raises sqlite3.Error if a
+    lookup fails, as every id is needed by the callers
+    """
+    smarts_ids = sorted(smarts_ids)
+    smarts = {}
+    for i in range(0, len(smarts_ids), chunk_size):
+        chunk = smarts_ids[i:i + chunk_size]
+        qry = "select id, smarts_string from smarts where id in ({})".format(
+            ",".join(str(sid) for sid in chunk))
+        result = execute_query(conn, qry)
+        if result is None:  # the error is printed by execute_query
+            raise Error("unable to look up the SMARTS strings of {} smarts ids".format(len(chunk)))
+        smarts.update(result)
+    return smarts
+
+
+def generate_rule_table_smarts_dict(conn, fpath, smarts_fpath, diam=10, row_count=0,
+                                    batch_size=FETCH_BATCH_SIZE):
+    """
+    generate_rule_table_smarts_dict: stream the rule table with the SMARTS column
+    replaced by a key into a separate SMARTS dictionary file. The SMARTS strings
+    are the bulk of the table and are shared by many rules; here each distinct
+    SMARTS is fetched, unwrapped and written only once.
+    The dictionary file has the columns SMARTS_DICT_HEADER, and the rule table
+    has 'smarts_key' in place of 'SMARTS'.
+    :param conn: the Connection object
+    :param fpath: the rule table filename with path
+    :param smarts_fpath: the SMARTS dictionary filename with path
+    :param diam: reaction diameter, or a list of diameters
+    :param row_count: number of rows to output, if 0 output all
+    :param batch_size: number of rows fetched and written at a time
+    :return: a tuple of (the number of rows, the number of distinct SMARTS) written
+    """
+    qry_seed = build_rule_query(diam, repo_prefix='rxn', limit=row_count, smarts_ids=True)
+    keys = {}  # (smarts id, unwrapped) to smarts key
+    n_rows = 0
+    with open(fpath, "w") as csv_file, open(smarts_fpath, "w") as smarts_file:
+        writer = csv.writer(csv_file, delimiter='\t')  # create a csv.writer, tab delimited
+        smarts_writer = csv.writer(smarts_file, delimiter='\t')
+        writer.writerow(RULE_TABLE_HEADER_SMARTS_KEY)
+        smarts_writer.writerow(SMARTS_DICT_HEADER)
+        for rows in execute_query_iter(conn, qry_seed, batch_size):
+            missing = set(row[9] for row in rows if (row[9], row[17] > 1) not in keys)
+            smarts = fetch_smarts(conn, missing) if missing else {}
+            out_rows = []
+            for row in rows:
+                lst_row = list(row)
+                any_num = lst_row[17]  # 'total_stoichios'
+                k = (lst_row[9], any_num > 1)
+                key = keys.get(k)
+                if key is None:
+                    key = keys[k] = len(keys)
+                    smt = smarts[lst_row[9]]
+                    smarts_writer.writerow([key, lst_row[9], unwrap_smarts(smt) if any_num > 1 else smt])
+                lst_row[9] = key
+                lst_row[17] = repeat_any_lookup(any_num)
+                out_rows.append(lst_row)
+            writer.writerows(out_rows)
+            n_rows += len(out_rows)
+    return (n_rows, len(keys))
+
+
 def csv_dict_reader(file_obj):
     """
     Read a CSV file using csv.DictReader
@@ -423,25 +742,44 @@ def csv_dict_reader(file_obj):
         print(line["last_name"])
 
 
-def csv_write(data, fpath):
+def csv_write(data, fpath, compression=None):
     """
     Write data to a CSV file path
     We create a csv_writer function that accepts two arguments: data and path.
     The data is a list of lists that is returned by a database query.
     :param fpath: filename with path to write to
+    :param compression: None, 'gzip' or 'zstd' (see compressed_output.open_text_output)
     """
-    with open(fpath, "w") as csv_file:
+    with open_text_output(fpath, compression) as csv_file:
         writer = csv.writer(csv_file, delimiter='\t')  # create a csv.writer, tab delimited
         # write the header
-        writer.writerow(
-            ["reaction_id", "repo_rxn_id", "ec_numbers", "rule_substrate_id", "rule_substrate_cpd",
-             "direction", "diameter", "isStereo", "score", "SMARTS", "Reactants", "rule_prod_ids",
-             "rule_prod_stoichios", "rxn_substrate_ids", "rxn_substrate_inchis", "rxn_product_ids",
-             "rxn_product_inchis", "Products", "Name"])
+        writer.writerow(RULE_TABLE_HEADER)
         # write the data rows
         writer.writerows(row for row in data)
 
 
+def csv_write_stream(row_batches, fpath, compression=None):
+    """
+    csv_write_stream: Write batches of rows to a CSV file path as they arrive,
+    flushing after each batch so that the first rows reach the disk early.
+    Compressed, the blocks are compressed on background threads while the
+    next batches are fetched.
+    :param row_batches: an iterable of lists of rows
+    :param fpath: filename with path to write to
+    :param compression: None, 'gzip' or 'zstd' (see compressed_output.open_text_output)
+    :return: the number of rows written
+    """
+    n_rows = 0
+    with open_text_output(fpath, compression) as csv_file:
+        writer = csv.writer(csv_file, delimiter='\t')  # create a csv.writer, tab delimited
+        writer.writerow(RULE_TABLE_HEADER)
+        for rows in row_batches:
+            writer.writerows(rows)
+            csv_file.flush()
+            n_rows += len(rows)
+    return n_rows
+
+
 def csv_dict_writer(path, fieldnames, data, delm):
     """
     Writes a CSV file using DictWriter
@@ -467,29 +805,63 @@ def main():
     database = "/Users/qzhang/qzwk_dir/upload_RetroRules/retrorules_dump/mvc.db"
 
     print("0. create a database connection...")
-    conn = create_connection(database)
+    conn = create_connection(database, immutable=True, profile="fast_read")
     row_cnt = 0   # 200
     diam = 16
+    stream = True   # write rows batch by batch instead of holding all of them
+    all_diams = False   # export every diameter to its own file in a single pass
+    engine = "sql"   # or "hash_join" to join the tables in Python (not streamed)
+    collect_metrics = True   # write the per-stage timings, row counts and query plans
+    profile = False   # also capture a cProfile of the run (slower)
+    compression = None   # or "gzip"/"zstd" to compress the TSVs as they are written
     str_row_cnt = str(row_cnt) if row_cnt > 0 else 'all'
-    outfile_nm = "../TSVs/retro_rules_dia{}_{}".format(str(diam), str_row_cnt) + ".tsv"
-    outfile_nm_seed_cpds = "../TSVs/seed_cpds_rules_dia{}_{}".format(str(diam), str_row_cnt) + ".tsv"
+    outfile_nm = compressed_fpath("../TSVs/retro_rules_dia{}_{}".format(str(diam), str_row_cnt) + ".tsv",
+                                  compression)
+    outfile_nm_seed_cpds = compressed_fpath(
+        "../TSVs/seed_cpds_rules_dia{}_{}".format(str(diam), str_row_cnt) + ".tsv", compression)
+    date_str = datetime.datetime.now().strftime("%Y-%m-%d")
+    metrics_nm = "../TSVs/retro_rules_metrics_{}.json".format(date_str)
 
     rule_per_row_results = None
     rule_per_row_results_seed_cpds = None
-    with conn:
-        print("1. Query tables to create the result data...")
-        rule_per_row_results = generate_rule_per_row_table(
-                                           conn, row_cnt, diam)
-        # rule_per_row_results_seed_cpds = generate_rule_per_row_table_seed_cpds(
-        #                                    conn, row_cnt, diam)
-            
-        print("2. Write to output file {}".format(outfile_nm))
-        if rule_per_row_results:
-            csv_write(rule_per_row_results, outfile_nm)
-
-        print("2. Write to output file {}".format(outfile_nm_seed_cpds))
-        if rule_per_row_results_seed_cpds:
-            csv_write(rule_per_row_results_seed_cpds, outfile_nm_seed_cpds)
+    metrics = ExportMetrics("retroRules", enabled=collect_metrics, profile=profile)
+    with conn, metrics:
+        if all_diams:
+            outfile_tmpl = compressed_fpath("../TSVs/retro_rules_dia{}_" + str_row_cnt + ".tsv", compression)
+            print("1. Query tables and route the results per diameter to {}".format(outfile_tmpl))
+            counts = generate_rule_tables_per_diameter(conn, outfile_tmpl, ALL_DIAMETERS, row_cnt,
+                                                       metrics=metrics, compression=compression)
+            for d in sorted(counts):
+                print("2. Wrote {} rows to output file {}".format(counts[d], outfile_tmpl.format(d)))
+
+        elif stream and engine == "sql":
+            print("1. Query tables and stream the results to {}".format(outfile_nm))
+            n_rows = generate_rule_per_row_table_stream(conn, outfile_nm, row_cnt, diam, metrics=metrics,
+                                                        compression=compression)
+            print("2. Wrote {} rows to output file {}".format(n_rows, outfile_nm))
+
+        else:
+            print("1. Query tables to create the result data...")
+            rule_per_row_results = generate_rule_per_row_table(
+                                               conn, row_cnt, diam, metrics=metrics, engine=engine)
+            # rule_per_row_results_seed_cpds = generate_rule_per_row_table_seed_cpds(
+            #                                    conn, row_cnt, diam)
+
+            print("2. Write to output file {}".format(outfile_nm))
+            if rule_per_row_results:
+                with metrics.stage("write") as stage:
+                    csv_write(rule_per_row_results, outfile_nm, compression)
+                    stage.add_rows(len(rule_per_row_results))
+                    stage.add_bytes(os.path.getsize(outfile_nm))
+
+            print("2. Write to output file {}".format(outfile_nm_seed_cpds))
+            if rule_per_row_results_seed_cpds:
+                csv_write(rule_per_row_results_seed_cpds, outfile_nm_seed_cpds, compression)
+
+    if collect_metrics:
+        metrics.write(metrics_nm)
+        print("3. Wrote the run metrics to {}".format(metrics_nm))
+        metrics.print_summary()
 
 
 if __name__ == '__main__':
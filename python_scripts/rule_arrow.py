@@ -0,0 +1,311 @@
+import os
+import shutil
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is only needed for the columnar outputs
+    pa = None
+    pq = None
+
+from retroRules import (create_connection, execute_query_iter, build_rule_query,
+                        post_query_process_iter, RULE_TABLE_HEADER, ALL_DIAMETERS,
+                        FETCH_BATCH_SIZE)
+
+
+# the columns stored dictionary encoded: ids and strings repeated across many rules
+DICTIONARY_COLUMNS = ("repo_rxn_id", "ec_numbers", "rule_substrate_cpd", "Reactants", "Products")
+
+PARTITION_COLUMNS = ("diameter", "isStereo")
+
+# the number of rows per Parquet row group: the fetch batches are split over
+# up to 16 partitions, far too few rows each for a row group of their own
+ROW_GROUP_SIZE = 65536
+
+
+def require_pyarrow():
+    """
+    require_pyarrow: fail with a clear message if pyarrow is not installed
+    """
+    if pa is None:
+        raise ImportError("pyarrow is required for the Parquet/Arrow outputs: pip install pyarrow")
+
+
+def rule_arrow_schema(dictionary_columns=DICTIONARY_COLUMNS):
+    """
+    rule_arrow_schema: the typed Arrow schema of the (post-processed) rule table
+    :param dictionary_columns: the string columns to dictionary encode
+    :return: a pyarrow.Schema with the RULE_TABLE_HEADER columns
+    """
+    require_pyarrow()
+    types = {
+        "reaction_id": pa.int64(), "rule_substrate_id": pa.int64(),
+        "direction": pa.int8(), "diameter": pa.int8(), "isStereo": pa.int8(),
+        "score": pa.float64(),
+    }
+    fields = []
+    for name in RULE_TABLE_HEADER:
+        typ = types.get(name, pa.string())
+        if name in dictionary_columns:
+            typ = pa.dictionary(pa.int32(), pa.string())
+        fields.append(pa.field(name, typ))
+    return pa.schema(fields)
+
+
+class DictionaryEncoder(object):
+    """
+    DictionaryEncoder: encodes a string column batch by batch against one
+    growing dictionary, so that consecutive batches share their dictionary
+    and an Arrow IPC file only gets the new values of each batch as a
+    dictionary delta. The dictionary is kept as Arrow string buffers with
+    spare capacity, appended to in place: a batch costs its new values, not
+    a rebuild of every value seen so far.
+    """
+
+    def __init__(self):
+        self.index = {}
+        self.n_values = 0
+        self.offsets = np.zeros(1024, dtype=np.int32)
+        self.data = np.zeros(1 << 16, dtype=np.uint8)
+
+    def append_values(self, values):
+        """
+        append_values: append new distinct values to the dictionary buffers,
+        doubling them when full
+        :param values: a list of str
+        """
+        encoded = [val.encode("utf-8") for val in values]
+        lengths = np.fromiter((len(b) for b in encoded), dtype=np.int64, count=len(encoded))
+        start = int(self.offsets[self.n_values])
+        end = start + int(lengths.sum())
+        if end > np.iinfo(np.int32).max:
+            raise OverflowError("the dictionary exceeds the 2 GB of an Arrow string array")
+        n_values = self.n_values + len(values)
+        if n_values + 1 > len(self.offsets):
+            self.offsets = np.concatenate([self.offsets, np.zeros(max(len(self.offsets), n_values + 1),
+                                                                  dtype=np.int32)])
+        if end > len(self.data):
+            self.data = np.concatenate([self.data, np.zeros(max(len(self.data), end), dtype=np.uint8)])
+        self.offsets[self.n_values + 1:n_values + 1] = start + np.cumsum(lengths)
+        self.data[start:end] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        self.n_values = n_values
+
+    def dictionary(self):
+        """
+        dictionary: the values seen so far, as a pyarrow string array viewing the buffers
+        """
+        return pa.StringArray.from_buffers(
+            self.n_values, pa.py_buffer(self.offsets[:self.n_values + 1]),
+            pa.py_buffer(self.data[:int(self.offsets[self.n_values])]))
+
+    def encode(self, column):
+        """
+        encode: dictionary encode the values of one batch
+        :param column: a list of str (or None)
+        :return: a pyarrow.DictionaryArray over all the values seen so far
+        """
+        index = self.index
+        indices = []
+        new_values = []
+        for val in column:
+            if val is None:
+                indices.append(None)
+                continue
+            idx = index.get(val)
+            if idx is None:
+                idx = index[val] = self.n_values + len(new_values)
+                new_values.append(val)
+            indices.append(idx)
+        if new_values:
+            self.append_values(new_values)
+        return pa.DictionaryArray.from_arrays(pa.array(indices, pa.int32()), self.dictionary())
+
+
+def rows_to_record_batch(rows, schema, encoders=None):
+    """
+    rows_to_record_batch: convert a batch of processed rule rows to an Arrow
+    record batch of the given schema
+    :param rows: a list of rows (lists) in RULE_TABLE_HEADER order
+    :param schema: the result of rule_arrow_schema, possibly without some columns
+    :param encoders: optional dict of column name to DictionaryEncoder, to share
+    the dictionaries across batches
+    :return: a pyarrow.RecordBatch
+    """
+    cols = dict(zip(RULE_TABLE_HEADER, zip(*rows))) if rows else \
+        dict((name, ()) for name in RULE_TABLE_HEADER)
+    arrays = []
+    for field in schema:
+        values = list(cols[field.name])
+        if pa.types.is_dictionary(field.type):
+            if encoders is not None:
+                encoder = encoders.setdefault(field.name, DictionaryEncoder())
+                arrays.append(encoder.encode(values))
+            else:
+                arrays.append(pa.array(values, pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def partition_dir(out_dir, key):
+    """
+    partition_dir: the hive-style directory of a partition, e.g., diameter=16/isStereo=0
+    """
+    return os.path.join(out_dir, *["{}={}".format(name, val) for name, val in zip(PARTITION_COLUMNS, key)])
+
+
+def replace_dir(src_dir, dst_dir):
+    """
+    replace_dir: move a fully written directory in place of another one, so
+    that none of the files of the old one are left behind
+    :param src_dir: the new directory
+    :param dst_dir: the directory to replace, if it exists
+    """
+    old_dir = dst_dir.rstrip(os.sep) + ".old"
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+    if os.path.exists(dst_dir):
+        os.rename(dst_dir, old_dir)
+    os.rename(src_dir, dst_dir)
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+
+
+def write_rule_parquet(row_batches, out_dir, compression="zstd", dictionary_columns=DICTIONARY_COLUMNS,
+                       row_group_size=ROW_GROUP_SIZE):
+    """
+    write_rule_parquet: write the processed rule rows as a Parquet dataset
+    partitioned by diameter and isStereo (hive-style directories). The rows of
+    each partition are converted to Arrow as they stream from the cursor and
+    buffered until they fill a row group of row_group_size rows. The dataset
+    is written to <out_dir>.tmp and replaces out_dir once complete, so a rerun
+    leaves no partition of the last run behind
+    :param row_batches: an iterable of lists of processed rows
+    :param out_dir: the dataset directory
+    :param compression: the Parquet compression codec
+    :param dictionary_columns: the string columns to dictionary encode
+    :param row_group_size: the number of rows per row group (the last one of a
+    partition may be smaller)
+    :return: a dict of partition (diameter, isStereo) to the number of rows
+    """
+    require_pyarrow()
+    full_schema = rule_arrow_schema(dictionary_columns)
+    schema = pa.schema([f for f in full_schema if f.name not in PARTITION_COLUMNS])
+    part_idx = [RULE_TABLE_HEADER.index(name) for name in PARTITION_COLUMNS]
+    tmp_dir = out_dir.rstrip(os.sep) + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    writers = {}
+    pending = {}  # partition to its buffered record batches
+    counts = {}
+
+    def write_row_groups(key, final=False):
+        table = pa.Table.from_batches(pending.pop(key), schema)
+        n_full = len(table) if final else len(table) - len(table) % row_group_size
+        if n_full:
+            writers[key].write_table(table.slice(0, n_full), row_group_size=row_group_size)
+        if n_full < len(table):
+            pending[key] = table.slice(n_full).to_batches()
+
+    try:
+        for rows in row_batches:
+            parts = {}
+            for row in rows:
+                parts.setdefault(tuple(row[i] for i in part_idx), []).append(row)
+            for key, part_rows in parts.items():
+                if key not in writers:
+                    pdir = partition_dir(tmp_dir, key)
+                    os.makedirs(pdir, exist_ok=True)
+                    writers[key] = pq.ParquetWriter(
+                        os.path.join(pdir, "part-0.parquet"), schema, compression=compression)
+                pending.setdefault(key, []).append(rows_to_record_batch(part_rows, schema))
+                n_pending = counts.get(key, 0) % row_group_size + len(part_rows)
+                counts[key] = counts.get(key, 0) + len(part_rows)
+                if n_pending >= row_group_size:
+                    write_row_groups(key)
+        for key in list(pending):
+            write_row_groups(key, final=True)
+    except BaseException:
+        for writer in writers.values():
+            writer.close()
+        shutil.rmtree(tmp_dir)
+        raise
+    for writer in writers.values():
+        writer.close()
+    replace_dir(tmp_dir, out_dir)
+    return counts
+
+
+def write_rule_arrow_ipc(row_batches, fpath, compression="zstd", dictionary_columns=DICTIONARY_COLUMNS):
+    """
+    write_rule_arrow_ipc: write the processed rule rows to an Arrow IPC file,
+    one record batch per incoming batch, with dictionaries shared across batches
+    :param row_batches: an iterable of lists of processed rows
+    :param fpath: filename with path to write to
+    :param compression: the IPC buffer compression codec, 'zstd', 'lz4' or None
+    :param dictionary_columns: the string columns to dictionary encode
+    :return: the number of rows written
+    """
+    require_pyarrow()
+    schema = rule_arrow_schema(dictionary_columns)
+    options = pa.ipc.IpcWriteOptions(compression=compression, emit_dictionary_deltas=True)
+    encoders = {}
+    n_rows = 0
+    with pa.OSFile(fpath, "wb") as sink:
+        with pa.ipc.new_file(sink, schema, options=options) as writer:
+            for rows in row_batches:
+                if rows:
+                    writer.write_batch(rows_to_record_batch(rows, schema, encoders))
+                    n_rows += len(rows)
+    return n_rows
+
+
+def generate_rule_table_columnar(conn, out_path, diam=ALL_DIAMETERS, fmt="parquet", row_count=0,
+                                 batch_size=FETCH_BATCH_SIZE, dictionary_smarts=False):
+    """
+    generate_rule_table_columnar: stream the rule table of one or more diameters
+    to a partitioned Parquet dataset or to an Arrow IPC file
+    :param conn: the Connection object
+    :param out_path: the dataset directory (parquet) or file (arrow)
+    :param diam: reaction diameter, or a list of diameters
+    :param fmt: 'parquet' or 'arrow'
+    :param row_count: number of rows to output, if 0 output all
+    :param batch_size: number of rows fetched and written at a time
+    :param dictionary_smarts: store SMARTS as a dictionary column, unwrapping each
+    distinct SMARTS only once
+    :return: the number of rows written
+    """
+    qry = build_rule_query(list(diam) if isinstance(diam, tuple) else diam,
+                           repo_prefix='rxn', limit=row_count)
+    dict_cols = DICTIONARY_COLUMNS + ("SMARTS",) if dictionary_smarts else DICTIONARY_COLUMNS
+    smarts_cache = {} if dictionary_smarts else None
+    row_batches = post_query_process_iter(execute_query_iter(conn, qry, batch_size),
+                                          smarts_cache=smarts_cache)
+    if fmt == "parquet":
+        return sum(write_rule_parquet(row_batches, out_path, dictionary_columns=dict_cols).values())
+    elif fmt == "arrow":
+        return write_rule_arrow_ipc(row_batches, out_path, dictionary_columns=dict_cols)
+    raise ValueError("unknown columnar format: {}".format(fmt))
+
+
+def main():
+    """
+    main: export all the rule diameters as a partitioned Parquet dataset
+    """
+    database = "/Users/qzhang/qzwk_dir/upload_RetroRules/retrorules_dump/mvc.db"
+    out_dir = "../TSVs/retro_rules_parquet"
+
+    print("0. create a database connection...")
+    conn = create_connection(database, read_only=True, profile="fast_read")
+    with conn:
+        print("1. Query tables and stream the results to {}".format(out_dir))
+        n_rows = generate_rule_table_columnar(conn, out_dir, ALL_DIAMETERS, "parquet")
+        print("2. Wrote {} rows to {}".format(n_rows, out_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+import numpy as np
+
+from retroRules import execute_query_iter, fetch_smarts, diameter_condition
+
+
+# the columns of chemical_species/reactions whose first non-null value is the repository id
+CPD_ID_COLUMNS = "seed, bigg, kegg, metacyc, mnxm"
+RXN_ID_COLUMNS = "seed, bigg, kegg, metacyc, mnxr"
+
+# the product of the key cardinalities above which the composite keys would overflow int64
+MAX_KEY_SPACE = 1 << 62
+
+# the case folding of SQLite's LIKE, which only folds the ASCII letters
+ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+
+def like_prefix(value, prefix):
+    """
+    like_prefix: whether value starts with prefix, as retroRules.prefix_condition
+    (LIKE 'prefix%') decides it in SQL
+    """
+    if value is None:
+        return False
+    text = value if isinstance(value, str) else str(value)
+    return text[:len(prefix)].translate(ASCII_LOWER) == prefix.translate(ASCII_LOWER)
+
+
+def fetch_columns(conn, qry, n_cols):
+    """
+    fetch_columns: run a query and return its result column-wise
+    :param conn: the Connection object
+    :param qry: SQL query string
+    :param n_cols: the number of columns selected
+    :return: a list of n_cols lists of values
+    """
+    cols = [[] for _ in range(n_cols)]
+    for rows in execute_query_iter(conn, qry):
+        for col, values in zip(cols, zip(*rows)):
+            col.extend(values)
+    return cols
+
+
+def first_not_null(*cols):
+    """
+    first_not_null: the ifnull(a, ifnull(b, ...)) of parallel columns
+    :return: a list of values
+    """
+    out = []
+    for values in zip(*cols):
+        val = None
+        for v in values:
+            if v is not None:
+                val = v
+                break
+        out.append(val)
+    return out
+
+
+def factorize(values):
+    """
+    factorize: encode values as int64 codes in the sort order of the values,
+    with -1 for NULL (SQLite sorts NULL first)
+    :param values: a list of comparable values or None
+    :return: an int64 array of codes
+    """
+    codes = np.full(len(values), -1, dtype=np.int64)
+    present = np.fromiter((v is not None for v in values), dtype=bool, count=len(values))
+    if present.any():
+        _, inv = np.unique(np.array([v for v in values if v is not None], dtype=object),
+                           return_inverse=True)
+        codes[present] = inv
+    return codes
+
+
+def composite_keys(*col_pairs):
+    """
+    composite_keys: encode multi-column join keys of two tables as one int64
+    key per row, comparable across the two tables
+    :param col_pairs: (left column, right column) int64 arrays, one pair per key column
+    :return: a tuple of (left keys, right keys)
+    """
+    n_left = len(col_pairs[0][0])
+    left = np.zeros(n_left, dtype=np.int64)
+    right = np.zeros(len(col_pairs[0][1]), dtype=np.int64)
+    space = 1
+    for left_col, right_col in col_pairs:
+        uniq, inv = np.unique(np.concatenate([left_col, right_col]), return_inverse=True)
+        space *= max(len(uniq), 1)
+        if space > MAX_KEY_SPACE:
+            raise OverflowError("the join key space does not fit in int64")
+        left = left * len(uniq) + inv[:n_left]
+        right = right * len(uniq) + inv[n_left:]
+    return (left, right)
+
+
+def lookup(sorted_keys, keys):
+    """
+    lookup: the hash-join probe, as a vectorized binary search
+    :param sorted_keys: the sorted (build side) keys
+    :param keys: the probe keys
+    :return: an int64 array of positions into sorted_keys, -1 where not found
+    """
+    pos = np.searchsorted(sorted_keys, keys)
+    clipped = np.minimum(pos, max(len(sorted_keys) - 1, 0))
+    found = (pos < len(sorted_keys)) & (sorted_keys[clipped] == keys) if len(sorted_keys) else \
+        np.zeros(len(keys), dtype=bool)
+    return np.where(found, clipped, -1)
+
+
+def group_bounds(sorted_group_keys):
+    """
+    group_bounds: the start and end offsets of the runs of equal keys
+    :param sorted_group_keys: a sorted int64 array
+    :return: a tuple of (unique keys, starts, ends)
+    """
+    if not len(sorted_group_keys):
+        empty = np.zeros(0, dtype=np.int64)
+        return (empty, empty, empty)
+    starts = np.flatnonzero(np.concatenate([[True], sorted_group_keys[1:] != sorted_group_keys[:-1]]))
+    ends = np.append(starts[1:], len(sorted_group_keys))
+    return (sorted_group_keys[starts], starts, ends)
+
+
+def sql_text(value):
+    """
+    sql_text: a value as SQLite renders it in group_concat/||
+    """
+    return value if isinstance(value, str) else str(value)
+
+
+def distinct_concat(values):
+    """
+    distinct_concat: group_concat(distinct ...) of the values in the given order
+    """
+    seen = set()
+    out = []
+    for v in values:
+        if v is not None and v not in seen:
+            seen.add(v)
+            out.append(sql_text(v))
+    return ",".join(out) if out else None
+
+
+class CompoundTable(object):
+    """
+    CompoundTable: chemical_species loaded once as arrays sorted by id, with the
+    repository compound id (cs_info.repo_cpd_id) and the InChIKey
+    """
+
+    def __init__(self, conn, seed_cpds=False):
+        ids, seed, bigg, kegg, metacyc, mnxm, inchi = fetch_columns(
+            conn, "select id, " + CPD_ID_COLUMNS + ", inchi_key from chemical_species", 7)
+        repo = seed if seed_cpds else first_not_null(seed, bigg, kegg, metacyc, mnxm)
+        keep = [i for i, cid in enumerate(ids)
+                if cid is not None and (not seed_cpds or seed[i] is not None)]
+        id_arr = np.array([ids[i] for i in keep], dtype=np.int64)
+        order = np.argsort(id_arr, kind="stable")
+        self.ids = id_arr[order]
+        self.repo_ids = np.array([repo[i] for i in keep], dtype=object)[order]
+        self.inchi_keys = np.array([inchi[i] for i in keep], dtype=object)[order]
+
+    def positions(self, cpd_ids):
+        """
+        positions: the rows of the given compound ids, -1 for the missing ones
+        """
+        return lookup(self.ids, cpd_ids)
+
+
+def key_column(values):
+    """
+    key_column: an int64 array of a join key column with NULL as a never-matching -1
+    and a mask of the non-NULL rows
+    """
+    mask = np.fromiter((v is not None for v in values), dtype=bool, count=len(values))
+    return (np.array([v if v is not None else -1 for v in values], dtype=np.int64), mask)
+
+
+def reaction_side_lists(conn, table, rxn_ids, cpds):
+    """
+    reaction_side_lists: the group_concat(distinct) compound ids and InChIKeys
+    of one side of the given reactions. The values are concatenated in the
+    order SQLite reads them through its automatic covering index on the
+    side's rows, i.e., by (repo compound id, chemical id, InChIKey).
+    :param conn: the Connection object
+    :param table: 'reaction_substrates' or 'reaction_products'
+    :param rxn_ids: the sorted reaction ids of interest (int64 array)
+    :param cpds: the CompoundTable
+    :return: a dict of reaction id to (compound ids, InChIKeys)
+    """
+    rxn_col, chem_col = fetch_columns(conn, "select reaction_id, chemical_id from " + table, 2)
+    rxn_arr, rxn_mask = key_column(rxn_col)
+    chem_arr, chem_mask = key_column(chem_col)
+    cpd_pos = cpds.positions(chem_arr)
+    keep = rxn_mask & chem_mask & (cpd_pos >= 0) & (lookup(rxn_ids, rxn_arr) >= 0)
+    rxn_arr, chem_arr, cpd_pos = rxn_arr[keep], chem_arr[keep], cpd_pos[keep]
+
+    repo_codes = factorize(list(cpds.repo_ids[cpd_pos]))
+    inchi_codes = factorize(list(cpds.inchi_keys[cpd_pos]))
+    order = np.lexsort((inchi_codes, chem_arr, repo_codes, rxn_arr))
+    uniq, starts, ends = group_bounds(rxn_arr[order])
+    repo_sorted = cpds.repo_ids[cpd_pos[order]]
+    inchi_sorted = cpds.inchi_keys[cpd_pos[order]]
+    return dict((int(rxn), (distinct_concat(repo_sorted[s:e]), distinct_concat(inchi_sorted[s:e])))
+                for rxn, s, e in zip(uniq, starts, ends))
+
+
+def rxn_info_lists(conn, rxn_ids, cpds):
+    """
+    rxn_info_lists: the rxn_info columns of the given reactions: the EC numbers
+    (distinct, sorted as in retroRules.ec_numbers_subquery) and the substrate
+    and product lists.
+    :param conn: the Connection object
+    :param rxn_ids: the sorted reaction ids of interest (int64 array)
+    :param cpds: the CompoundTable
+    :return: a dict of reaction id to (ec_numbers, substrate ids, substrate InChIKeys,
+    product ids, product InChIKeys)
+    """
+    er_rxn, er_ec = fetch_columns(conn, "select reaction_id, ec_number from ec_reactions", 2)
+    er_arr, er_mask = key_column(er_rxn)
+    keep = np.flatnonzero(er_mask & (lookup(rxn_ids, er_arr) >= 0))
+    ecs = {}
+    for i in keep:
+        ecs.setdefault(int(er_arr[i]), []).append(er_ec[i])
+    subs = reaction_side_lists(conn, "reaction_substrates", rxn_ids, cpds)
+    prods = reaction_side_lists(conn, "reaction_products", rxn_ids, cpds)
+
+    info = {}
+    for rxn in rxn_ids.tolist():
+        sub_ids, sub_inchis = subs.get(rxn, (None, None))
+        prod_ids, prod_inchis = prods.get(rxn, (None, None))
+        ec_list = ecs.get(rxn, ())
+        info[rxn] = (distinct_concat(sorted(ec for ec in ec_list if ec is not None)), sub_ids, sub_inchis,
+                     prod_ids, prod_inchis)
+    return info
+
+
+def rule_name(reaction_id, repo_rxn_id, rule_substrate_cpd, diameter, direction, is_stereo):
+    """
+    rule_name: the 'Name' column, '<reaction_id|repo_rxn_id|substrate|diameter|direction[|isStereo]>',
+    NULL if any of its parts is NULL
+    """
+    if repo_rxn_id is None or rule_substrate_cpd is None:
+        return None
+    return "<{}|{}|{}|{}|{}{}".format(reaction_id, sql_text(repo_rxn_id), sql_text(rule_substrate_cpd),
+                                      diameter, "reverse" if direction == -1 else "forward",
+                                      "|isStereo>" if is_stereo == 1 else ">")
+
+
+def rule_rows_hash_join(conn, diam=10, seed_cpds=False, reaction_filter=None, repo_prefix=None, ec_prefix=None,
+                        min_score=None, is_stereo=None, substrate_cpds=None, limit=0, ordered=False):
+    """
+    rule_rows_hash_join: the rows of build_rule_query computed in Python. Each
+    base table is scanned once into NumPy arrays; the joins are vectorized
+    probes of sorted int64 (composite) keys and the group-bys are runs over
+    sorted keys, and only the rule products and reactions of the selected
+    rules are aggregated. The rows, their order and the group_concat orders
+    are those of the SQL path (in rules order, unless ordered).
+    :param conn: the Connection object
+    :param diam: reaction diameter, or a list of diameters
+    :param seed_cpds: ONLY rules that have seed reactants/products
+    :param reaction_filter: condition on the reaction id with a {col} placeholder,
+    e.g., '{col} % 4 = 1', evaluated by SQLite in the base table scans
+    :param repo_prefix: keep the reactions whose repository id starts with it, e.g., 'rxn'
+    :param ec_prefix: keep the reactions with an EC number starting with it, e.g., '1.1.'
+    :param min_score: keep the rules scoring at least min_score
+    :param is_stereo: keep the stereo (1) or non-stereo (0) rules only
+    :param substrate_cpds: keep the rules whose substrate is one of these compound ids
+    :param limit: the maximum number of rows, if 0 return all
+    :param ordered: sort the rows by the rule key (RULE_KEY_ORDER)
+    :return: a list of rows (tuples), as execute_query(conn, build_rule_query(...))
+    """
+    cpds = CompoundTable(conn, seed_cpds)
+    rxn_cond = " and (" + reaction_filter.format(col="reaction_id") + ")" if reaction_filter else ""
+
+    # the reactions: the ones the rules may come from, and the ones in rxn_info
+    rxn_id_col, seed, bigg, kegg, metacyc, mnxr = fetch_columns(
+        conn, "select id, " + RXN_ID_COLUMNS + " from reactions", 6)
+    repo_rxn = first_not_null(seed, bigg, kegg, metacyc, mnxr) if seed_cpds else seed
+    rule_rxns = set()
+    info_rxns = set()
+    ec_rxns = None
+    if ec_prefix:
+        ec_rxns = set(rxn for rxn, ec in zip(*fetch_columns(conn, "select reaction_id, ec_number from ec_reactions", 2))
+                      if like_prefix(ec, ec_prefix))
+    repo_ids = {}
+    for rxn, repo, sd in zip(rxn_id_col, repo_rxn, seed):
+        if rxn is None or (ec_rxns is not None and rxn not in ec_rxns):
+            continue
+        if repo_prefix and not like_prefix(repo, repo_prefix):
+            continue
+        rule_rxns.add(rxn)
+        if seed_cpds or sd is not None:
+            info_rxns.add(rxn)
+            repo_ids[rxn] = repo
+    filter_rxns = bool(repo_prefix or ec_prefix)
+
+    # the rules, in rules order
+    r_cond = diameter_condition(diam, "diameter")
+    rowid, r_rxn, r_sub, r_diam, r_dir, r_stereo, r_score, r_smarts = fetch_columns(
+        conn, "select rowid, reaction_id, substrate_id, diameter, direction, isStereo, score, smarts_id "
+        "from rules where " + r_cond + rxn_cond + " order by rowid", 8)
+    rxn_arr, rxn_mask = key_column(r_rxn)
+    sub_arr, sub_mask = key_column(r_sub)
+    diam_arr, diam_mask = key_column(r_diam)
+    stereo_arr, stereo_mask = key_column(r_stereo)
+    smarts_arr, smarts_mask = key_column(r_smarts)
+    sub_pos = cpds.positions(sub_arr)
+    smarts_ids = np.sort(np.array(fetch_columns(conn, "select id from smarts where id not null", 1)[0],
+                                  dtype=np.int64))
+    keep = rxn_mask & sub_mask & diam_mask & stereo_mask & smarts_mask & (sub_pos >= 0) & \
+        (lookup(smarts_ids, smarts_arr) >= 0)
+    if filter_rxns:
+        rxn_set = np.array(sorted(rule_rxns & info_rxns), dtype=np.int64)
+        keep &= (lookup(rxn_set, rxn_arr) >= 0) & (rxn_arr > 0)
+    if min_score is not None:
+        keep &= np.fromiter((s is not None and s >= min_score for s in r_score), dtype=bool, count=len(r_score))
+    if is_stereo is not None:
+        keep &= stereo_arr == int(is_stereo)
+    if substrate_cpds:
+        wanted = set(substrate_cpds)
+        keep &= np.fromiter((cpd in wanted for cpd in cpds.repo_ids[np.maximum(sub_pos, 0)]),
+                            dtype=bool, count=len(sub_pos))
+
+    # the rule products grouped by rule key, in rule_products order within a group
+    p_rowid, p_rxn, p_sub, p_prod, p_diam, p_stereo, p_stoich = fetch_columns(
+        conn, "select rowid, reaction_id, substrate_id, product_id, diameter, isStereo, stochiometry "
+        "from rule_products where " + r_cond + rxn_cond, 7)
+    p_rxn_arr, p_rxn_mask = key_column(p_rxn)
+    p_sub_arr, p_sub_mask = key_column(p_sub)
+    p_diam_arr, p_diam_mask = key_column(p_diam)
+    p_stereo_arr, p_stereo_mask = key_column(p_stereo)
+    p_prod_pos = cpds.positions(key_column(p_prod)[0])
+    p_keep = np.flatnonzero(p_rxn_mask & p_sub_mask & p_diam_mask & p_stereo_mask & (p_prod_pos >= 0))
+
+    rule_keys, prod_keys = composite_keys((rxn_arr, p_rxn_arr[p_keep]), (sub_arr, p_sub_arr[p_keep]),
+                                          (diam_arr, p_diam_arr[p_keep]), (stereo_arr, p_stereo_arr[p_keep]))
+    p_order = np.lexsort((np.array(p_rowid, dtype=np.int64)[p_keep], prod_keys))
+    group_keys, group_starts, group_ends = group_bounds(prod_keys[p_order])
+    p_rows = p_keep[p_order]
+    rule_group = lookup(group_keys, rule_keys)
+    keep &= rule_group >= 0
+
+    selected = np.flatnonzero(keep)
+    if ordered:
+        selected = selected[np.lexsort((stereo_arr[selected], diam_arr[selected],
+                                        sub_arr[selected], rxn_arr[selected]))]
+    if limit > 0:
+        selected = selected[:limit]
+
+    smarts = fetch_smarts(conn, set(smarts_arr[selected].tolist()))
+    rxn_info = rxn_info_lists(conn, np.array(sorted(set(rxn_arr[selected].tolist()) & info_rxns),
+                                             dtype=np.int64), cpds)
+
+    rows = []
+    no_info = (None, None, None, None, None)
+    for i in selected.tolist():
+        g = rule_group[i]
+        prod_rows = p_rows[group_starts[g]:group_ends[g]]
+        prod_ids = [cpds.repo_ids[p_prod_pos[p]] for p in prod_rows]
+        stoichs = [p_stoich[p] for p in prod_rows]
+        prod_id_list = [sql_text(v) for v in prod_ids if v is not None]
+        stoich_list = [sql_text(v) for v in stoichs if v is not None]
+        total = sum(v for v in stoichs if v is not None) if stoich_list else None
+
+        rxn = r_rxn[i]
+        repo_rxn_id = repo_ids.get(rxn) if rxn in info_rxns else None
+        ec_numbers, sub_ids, sub_inchis, prod_ids_rxn, prod_inchis = rxn_info.get(rxn, no_info)
+        cpd_id = cpds.repo_ids[sub_pos[i]]
+        rows.append((rxn, repo_rxn_id, ec_numbers, r_sub[i], cpd_id, r_dir[i], r_diam[i], r_stereo[i],
+                     r_score[i], smarts[r_smarts[i]], 'Any', ",".join(prod_id_list) if prod_id_list else None,
+                     ",".join(stoich_list) if stoich_list else None, sub_ids, sub_inchis,
+                     prod_ids_rxn, prod_inchis, total,
+                     rule_name(rxn, repo_rxn_id, cpd_id, r_diam[i], r_dir[i], r_stereo[i])))
+    return rows
@@ -0,0 +1,253 @@
+import asyncio
+import argparse
+import csv
+import json
+import sys
+from array import array
+from urllib.parse import urlsplit, parse_qs
+
+from db_connection import create_connection
+from retroRules import RULE_TABLE_HEADER, execute_query_iter
+
+
+# the lookup fields: the rule substrate's compound id and InChIKey, the
+# InChIKey of any substrate of the rule's reaction, an EC number and the
+# repository reaction id
+LOOKUP_FIELDS = ("cpd", "inchikey", "rxn_inchikey", "ec", "rxn")
+
+
+class RuleIndex(object):
+    """
+    RuleIndex: an exported rule table held in memory with compact indexes
+    (arrays of row numbers) keyed by substrate compound id, substrate
+    InChIKey, reaction substrate InChIKeys, EC number and repository reaction
+    id. The exported table has no InChIKey of the rule substrate itself, so
+    inchikeys maps each rule_substrate_id to its key (see
+    substrate_inchikey_map); without it there is no inchikey index, only the
+    rxn_inchikey one of all the reaction's substrate keys.
+    """
+
+    def __init__(self, header, rows, inchikeys=None):
+        self.header = list(header)
+        self.rows = rows
+        self.indexes = dict((field, {}) for field in LOOKUP_FIELDS if field != "inchikey" or inchikeys is not None)
+        col = dict((name, i) for i, name in enumerate(self.header))
+        for n, row in enumerate(rows):
+            self._add("cpd", row[col["rule_substrate_cpd"]], n)
+            self._add("rxn", row[col["repo_rxn_id"]], n)
+            for ec in split_list(row[col["ec_numbers"]]):
+                self._add("ec", ec, n)
+            if inchikeys is not None:
+                self._add("inchikey", inchikeys.get(row[col["rule_substrate_id"]]), n)
+            for key in split_list(row[col["rxn_substrate_inchis"]]):
+                self._add("rxn_inchikey", key, n)
+
+    def _add(self, field, key, n):
+        if not key:
+            return
+        idx = self.indexes[field]
+        row_nums = idx.get(key)
+        if row_nums is None:
+            row_nums = idx[key] = array('I')
+        row_nums.append(n)
+
+    def lookup(self, field, key):
+        """
+        lookup: the rules matching one key
+        :param field: one of LOOKUP_FIELDS ('cpd', 'inchikey', 'rxn_inchikey', 'ec', 'rxn')
+        :param key: the key value
+        :return: a list of rows (tuples) in table order
+        """
+        if field == "inchikey" and field not in self.indexes:
+            raise KeyError("inchikey lookups need the rules database the table was exported from")
+        if field not in self.indexes:
+            raise KeyError("unknown lookup field: {}".format(field))
+        rows = self.rows
+        return [rows[n] for n in self.indexes[field].get(key, ())]
+
+    def lookup_batch(self, field, keys):
+        """
+        lookup_batch: the rules matching each of the keys
+        :param field: one of LOOKUP_FIELDS
+        :param keys: an iterable of key values
+        :return: a dict of key to list of rows
+        """
+        return dict((key, self.lookup(field, key)) for key in keys)
+
+    def as_dicts(self, rows):
+        """
+        as_dicts: the rows as dicts keyed by the table header
+        """
+        header = self.header
+        return [dict(zip(header, row)) for row in rows]
+
+
+def split_list(value):
+    """
+    split_list: split a group_concat'ed column value into its items
+    """
+    return value.split(",") if value else []
+
+
+def substrate_inchikey_map(db_file):
+    """
+    substrate_inchikey_map: the InChIKey of every chemical species, keyed by its
+    id as exported in the rule_substrate_id column
+    :param db_file: the rules database the table was exported from
+    :return: a dict of rule_substrate_id (str) to InChIKey
+    """
+    conn = create_connection(db_file, read_only=True)
+    if conn is None:
+        raise IOError("unable to open {}".format(db_file))
+    try:
+        qry = "select id, inchi_key from chemical_species where ifnull(inchi_key, '')<>''"
+        return dict((str(cs_id), key) for batch in execute_query_iter(conn, qry)
+                    for cs_id, key in batch)
+    finally:
+        conn.close()
+
+
+def load_rule_index(tsv_path, db_file=None):
+    """
+    load_rule_index: load an exported rule table (see retroRules.csv_write) into a RuleIndex
+    :param tsv_path: the rule table TSV file
+    :param db_file: the rules database the table was exported from; when given,
+    each rule is indexed under its own substrate's InChIKey
+    :return: a RuleIndex
+    """
+    with open(tsv_path, "r", newline="") as file_obj:
+        reader = csv.reader(file_obj, delimiter='\t')
+        header = next(reader, RULE_TABLE_HEADER)
+        rows = [tuple(row) for row in reader]
+    inchikeys = substrate_inchikey_map(db_file) if db_file else None
+    return RuleIndex(header, rows, inchikeys)
+
+
+def http_response(writer, status, body, keep_alive):
+    """
+    http_response: write a JSON HTTP/1.1 response
+    """
+    payload = json.dumps(body).encode()
+    reason = {200: "OK", 400: "Bad Request", 404: "Not Found"}.get(status, "Error")
+    writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+                 "Connection: {}\r\n\r\n".format(status, reason, len(payload),
+                                                 "keep-alive" if keep_alive else "close").encode())
+    writer.write(payload)
+
+
+def parse_batch_request(body):
+    """
+    parse_batch_request: the field and keys of a POST /lookup body
+    :param body: the request body, a JSON object of a field name and a list of keys
+    :return: a tuple of (field, list of keys as strings)
+    """
+    request = json.loads(body or b"{}")
+    if not isinstance(request, dict):
+        raise ValueError("the request body must be a JSON object")
+    field, keys = request.get("field"), request.get("keys")
+    if not isinstance(field, str):
+        raise ValueError("field must be a string")
+    if not isinstance(keys, list) or not all(isinstance(key, (str, int, float)) for key in keys):
+        raise ValueError("keys must be a list of strings or numbers")
+    return (field, [str(key) for key in keys])
+
+
+def handle_request(index, method, target, body):
+    """
+    handle_request: answer one lookup request
+        GET  /lookup?field=cpd&key=cpd00001
+        POST /lookup  {"field": "ec", "keys": ["1.1.1.1", "2.7.1.2"]}
+    :return: a tuple of (HTTP status, JSON-serializable body)
+    """
+    url = urlsplit(target)
+    if url.path != "/lookup":
+        return (404, {"error": "not found"})
+    try:
+        if method == "GET":
+            params = parse_qs(url.query)
+            field, key = params["field"][0], params["key"][0]
+            return (200, {key: index.as_dicts(index.lookup(field, key))})
+        elif method == "POST":
+            field, keys = parse_batch_request(body)
+            found = index.lookup_batch(field, keys)
+            return (200, dict((key, index.as_dicts(rows)) for key, rows in found.items()))
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        return (400, {"error": str(e.args[0]) if e.args else str(e)})
+    return (400, {"error": "unsupported method {}".format(method)})
+
+
+async def serve_client(index, reader, writer):
+    """
+    serve_client: serve the HTTP/1.1 requests of one (keep-alive) connection
+    """
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, target, version = request_line.decode().split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode().partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get("content-length", 0))
+            body = await reader.readexactly(length) if length else b""
+            keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+
+            status, result = handle_request(index, method, target, body)
+            http_response(writer, status, result, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (ValueError, asyncio.IncompleteReadError, ConnectionResetError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(index, host="127.0.0.1", port=8765):
+    """
+    start_server: start serving the lookups of a RuleIndex over HTTP
+    :param port: the port, 0 for any free one (see server.sockets)
+    :return: the asyncio Server
+    """
+    return await asyncio.start_server(
+        lambda reader, writer: serve_client(index, reader, writer), host, port)
+
+
+async def run_server(index, host="127.0.0.1", port=8765):
+    """
+    run_server: serve the lookups of a RuleIndex over HTTP until cancelled
+    """
+    server = await start_server(index, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    """
+    main: load an exported rule table and serve lookups on a local port
+    """
+    parser = argparse.ArgumentParser(description="Serve rule lookups from an exported rule table")
+    parser.add_argument("tsv", help="the exported rule table TSV")
+    parser.add_argument("--database", help="the rules database the table was exported from, "
+                        "to index each rule under its own substrate's InChIKey (the inchikey "
+                        "lookups); without it only rxn_inchikey, any substrate of the reaction, is served")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    print("1. Load and index {}...".format(args.tsv))
+    index = load_rule_index(args.tsv, args.database)
+    print("2. Serving {} rules on http://{}:{}/lookup".format(len(index.rows), args.host, args.port))
+    try:
+        asyncio.run(run_server(index, args.host, args.port))
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+import sqlite3
+from sqlite3 import Error
+import hashlib
+import os
+import datetime
+
+from db_connection import database_uri
+from retroRules import (create_connection, diameter_condition, execute_query_iter,
+                        post_query_process_iter, csv_write_stream, FETCH_BATCH_SIZE,
+                        CPD_ID_EXPR, RXN_ID_EXPR, ec_numbers_subquery, prefix_condition)
+
+# bump whenever the layout of the staging tables changes, so that stale
+# staging files are rebuilt rather than queried
+STAGING_VERSION = "2"
+
+
+def file_checksum(fpath, chunk_size=1 << 20):
+    """
+    file_checksum: compute the md5 checksum of the given file
+    :param fpath: filename with path
+    :param chunk_size: number of bytes read at a time
+    :return: the hex digest string
+    """
+    md5 = hashlib.md5()
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def staging_db_path(src_db):
+    """
+    staging_db_path: the sidecar staging file name for the source database,
+    next to it; the staging_meta table records which state of src_db it was built from
+    :param src_db: the source (mvc.db) database file
+    :return: the staging database filename with path
+    """
+    base = os.path.splitext(src_db)[0]
+    return "{}_staging.db".format(base)
+
+
+def staging_statements():
+    """
+    staging_statements: the statements that materialize the derived tables of
+    build_query/build_query_seed_cpds into the staging database, which has the
+    source database attached as 'src'
+    :return: a list of sqlite3 statement strings
+    """
+    return [
+        # compound id resolution over chemical_species, done once for all joins
+        """
+        create table cpd_info as
+        select cs.id, """ + CPD_ID_EXPR + """ as repo_cpd_id, cs.seed as seed_cpd_id, cs.inchi_key
+        from src.chemical_species cs
+        """,
+        "create unique index cpd_info_id on cpd_info(id)",
+
+        # per-rule products, for any repo compound id and for seed compounds only
+        """
+        create table rule_prod_info as
+        select reaction_id, substrate_id, diameter, isStereo,
+        group_concat(repo_prod_id) as rule_prod_ids,
+        group_concat(prod_stoichio) as rule_prod_stoichios,
+        sum(prod_stoichio) as total_stoichios
+        from
+        (
+            select rp.reaction_id, rp.substrate_id, rp.diameter, rp.isStereo,
+            ci.repo_cpd_id as repo_prod_id, rp.stochiometry as prod_stoichio
+            from src.rule_products rp, cpd_info ci
+            where rp.product_id=ci.id
+        )
+        group by reaction_id, substrate_id, diameter, isStereo
+        """,
+        "create unique index rule_prod_info_key on rule_prod_info(reaction_id, substrate_id, diameter, isStereo)",
+        """
+        create table rule_prod_info_seed as
+        select reaction_id, substrate_id, diameter, isStereo,
+        group_concat(repo_prod_id) as rule_prod_ids,
+        group_concat(prod_stoichio) as rule_prod_stoichios,
+        sum(prod_stoichio) as total_stoichios
+        from
+        (
+            select rp.reaction_id, rp.substrate_id, rp.diameter, rp.isStereo,
+            ci.seed_cpd_id as repo_prod_id, rp.stochiometry as prod_stoichio
+            from src.rule_products rp, cpd_info ci
+            where rp.product_id=ci.id and ci.seed_cpd_id not null
+        )
+        group by reaction_id, substrate_id, diameter, isStereo
+        """,
+        "create unique index rule_prod_info_seed_key on rule_prod_info_seed(reaction_id, substrate_id, diameter, isStereo)",
+
+        # the reactions + ec_reactions expansion, built once instead of twice per query
+        """
+        create table rxn_ec as
+        select rxn1.id, rxn1.seed as seed_rxn_id, """ + RXN_ID_EXPR + """ as repo_rxn_id,
+        ec.ec_numbers
+        from src.reactions rxn1
+        left join """ + ec_numbers_subquery("src.ec_reactions") + """
+        on ec.reaction_id=rxn1.id
+        """,
+        "create unique index rxn_ec_id on rxn_ec(id)",
+
+        # the reaction substrates/products, for any repo compound id and for seed compounds only,
+        # aggregated in compound id order so that the lists are deterministic
+        """
+        create table rxn_cpds as
+        select rs.reaction_id, 's' as side, ci.repo_cpd_id, ci.seed_cpd_id, ci.inchi_key
+        from src.reaction_substrates rs, cpd_info ci
+        where rs.chemical_id=ci.id
+        union all
+        select rp.reaction_id, 'p' as side, ci.repo_cpd_id, ci.seed_cpd_id, ci.inchi_key
+        from src.reaction_products rp, cpd_info ci
+        where rp.chemical_id=ci.id
+        """,
+        """
+        create table rxn_cpd_lists as
+        select reaction_id, side, group_concat(distinct repo_cpd_id) as cpd_ids,
+        group_concat(distinct inchi_key) as inchi_keys
+        from (select * from rxn_cpds order by reaction_id, side, repo_cpd_id)
+        group by reaction_id, side
+        """,
+        "create unique index rxn_cpd_lists_key on rxn_cpd_lists(reaction_id, side)",
+        """
+        create table rxn_cpd_lists_seed as
+        select reaction_id, side, group_concat(distinct seed_cpd_id) as cpd_ids,
+        group_concat(distinct inchi_key) as inchi_keys
+        from (select * from rxn_cpds where seed_cpd_id not null order by reaction_id, side, seed_cpd_id)
+        group by reaction_id, side
+        """,
+        "create unique index rxn_cpd_lists_seed_key on rxn_cpd_lists_seed(reaction_id, side)",
+        """
+        create table rxn_info as
+        select re.id, re.seed_rxn_id as repo_rxn_id, re.ec_numbers,
+        sub.cpd_ids as rxn_substrate_ids, sub.inchi_keys as rxn_substrate_inchis,
+        prod.cpd_ids as rxn_product_ids, prod.inchi_keys as rxn_product_inchis
+        from rxn_ec re
+        left join rxn_cpd_lists sub on sub.reaction_id=re.id and sub.side='s'
+        left join rxn_cpd_lists prod on prod.reaction_id=re.id and prod.side='p'
+        where re.seed_rxn_id not null
+        """,
+        "create unique index rxn_info_id on rxn_info(id)",
+        """
+        create table rxn_info_seed as
+        select re.id, re.repo_rxn_id, re.ec_numbers,
+        sub.cpd_ids as rxn_substrate_ids, sub.inchi_keys as rxn_substrate_inchis,
+        prod.cpd_ids as rxn_product_ids, prod.inchi_keys as rxn_product_inchis
+        from rxn_ec re
+        left join rxn_cpd_lists_seed sub on sub.reaction_id=re.id and sub.side='s'
+        left join rxn_cpd_lists_seed prod on prod.reaction_id=re.id and prod.side='p'
+        """,
+        "create unique index rxn_info_seed_id on rxn_info_seed(id)",
+        "drop table rxn_cpd_lists",
+        "drop table rxn_cpd_lists_seed",
+        "drop table rxn_cpds",
+        "drop table rxn_ec",
+    ]
+
+
+def read_staging_meta(conn):
+    """
+    read_staging_meta: read the key/value metadata of a staging database
+    :param conn: the Connection object of the staging database
+    :return: a dict, empty if the staging database is not complete
+    """
+    try:
+        return dict(conn.execute("select key, value from staging_meta").fetchall())
+    except Error:
+        return {}
+
+
+def staging_is_current(staging_path, src_db):
+    """
+    staging_is_current: whether the staging file is complete and built from
+    the current state of src_db. A source with the recorded size and mtime is
+    taken as unchanged; when only the mtime changed, src_db is checksummed and
+    the recorded mtime refreshed if the content is the same.
+    :param staging_path: the staging database file
+    :param src_db: the source (mvc.db) database file
+    :return: a tuple of (True if current, the checksum of src_db if computed, else None)
+    """
+    if not os.path.exists(staging_path):
+        return (False, None)
+    conn = create_connection(staging_path)
+    if conn is None:
+        return (False, None)
+    try:
+        meta = read_staging_meta(conn)
+        st = os.stat(src_db)
+        if meta.get("staging_version") != STAGING_VERSION or meta.get("source_size") != str(st.st_size):
+            return (False, None)
+        if meta.get("source_mtime_ns") == str(st.st_mtime_ns):
+            return (True, None)
+        checksum = file_checksum(src_db)
+        if meta.get("source_checksum") != checksum:
+            return (False, checksum)
+        with conn:
+            conn.execute("update staging_meta set value=? where key='source_mtime_ns'", (str(st.st_mtime_ns),))
+        return (True, checksum)
+    finally:
+        conn.close()
+
+
+def prepare_staging_db(src_db, staging_path=None, force=False):
+    """
+    prepare_staging_db: the "prepare" step that materializes the derived tables
+    shared by all rule exports (compound id resolution, per-rule products,
+    reaction/EC expansion with substrates and products) as indexed tables in a
+    sidecar SQLite file. An existing, complete staging file built from the
+    same source database (see staging_is_current) is reused as is.
+    :param src_db: the source (mvc.db) database file
+    :param staging_path: the staging database file, default derived from src_db
+    :param force: rebuild even if a matching staging file exists
+    :return: the staging database filename with path, or None on error
+    """
+    if staging_path is None:
+        staging_path = staging_db_path(src_db)
+
+    checksum = None
+    if not force:
+        current, checksum = staging_is_current(staging_path, src_db)
+        if current:
+            return staging_path
+    st = os.stat(src_db)
+    checksum = checksum or file_checksum(src_db)
+
+    # build into a temporary file and move it in place once complete
+    tmp_path = staging_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = create_connection(tmp_path)
+    conn.execute("attach database ? as src", (database_uri(src_db),))
+    try:
+        with conn:
+            for stmt in staging_statements():
+                conn.execute(stmt)
+            conn.execute("create table staging_meta(key text primary key, value text)")
+            conn.executemany("insert into staging_meta values (?, ?)", [
+                ("source_checksum", checksum),
+                ("source_size", str(st.st_size)),
+                ("source_mtime_ns", str(st.st_mtime_ns)),
+                ("source_path", os.path.abspath(src_db)),
+                ("staging_version", STAGING_VERSION),
+                ("created", datetime.datetime.now().isoformat())])
+    except Error as e:
+        print("An error occurred:", e.args[0])
+        conn.close()
+        os.remove(tmp_path)
+        return None
+    conn.execute("detach database src")
+    conn.close()
+    os.replace(tmp_path, staging_path)
+
+    return staging_path
+
+
+def open_staging_connection(src_db, staging_path):
+    """
+    open_staging_connection: connect to the staging database with the source
+    database attached read-only as 'src'
+    :param src_db: the source (mvc.db) database file
+    :param staging_path: the staging database file
+    :return: Connection object or None
+    """
+    conn = create_connection(staging_path)
+    if conn is not None:
+        conn.execute("attach database ? as src", (database_uri(src_db),))
+    return conn
+
+
+def build_staged_query(diam=10, seed_cpds=False):
+    """
+    build_staged_query: the staging database counterpart of build_query (or of
+    build_query_seed_cpds if seed_cpds), as plain indexed joins of the source
+    rules/smarts against the materialized tables. It selects the rows of
+    retroRules.build_rule_query. The list columns are guaranteed in a fixed
+    order here: the EC numbers sorted, the reaction compound ids sorted by id
+    and their InChIKeys in the order of those ids. The direct query gets the
+    same EC order (see retroRules.ec_numbers_subquery) but its compound lists
+    come in the order SQLite's group_concat visits the rows, which is the id
+    order for the plans of the supported SQLite versions rather than a
+    guarantee.
+    :param diam: reaction diameter, or a list of diameters
+    :param seed_cpds: only rules with seed reactants/products
+    :return: an sqlite3 query string
+    """
+    suffix = "_seed" if seed_cpds else ""
+    cpd_col = "ci.seed_cpd_id" if seed_cpds else "ci.repo_cpd_id"
+
+    qry = """
+    select r.reaction_id, ri.repo_rxn_id, ri.ec_numbers,
+        r.substrate_id as rule_substrate_id, """ + cpd_col + """ as rule_substrate_cpd,
+        r.direction, r.diameter, r.isStereo, r.score,
+        s.smarts_string as SMARTS, 'Any' as Reactants, rp.rule_prod_ids,
+        rp.rule_prod_stoichios, ri.rxn_substrate_ids, ri.rxn_substrate_inchis,
+        ri.rxn_product_ids, ri.rxn_product_inchis, rp.total_stoichios,
+        '<'||r.reaction_id||'|'||ri.repo_rxn_id||'|'||""" + cpd_col + """||'|'||r.diameter||'|'||
+        (CASE WHEN r.direction=-1 THEN 'reverse' ELSE 'forward' END) ||
+        (CASE WHEN r.isStereo=1 THEN '|'||'isStereo'||'>' ELSE ''||'>' END) as Name
+    from src.rules r
+    join src.smarts s on s.id=r.smarts_id
+    join cpd_info ci on ci.id=r.substrate_id""" + (" and ci.seed_cpd_id not null" if seed_cpds else "") + """
+    join rule_prod_info""" + suffix + """ rp
+    on rp.reaction_id=r.reaction_id and rp.substrate_id=r.substrate_id and
+    rp.diameter=r.diameter and rp.isStereo=r.isStereo
+    left join rxn_info""" + suffix + """ ri on ri.id=r.reaction_id
+    where """ + diameter_condition(diam, "r.diameter")
+
+    return qry
+
+
+def generate_rule_per_row_table_staged(conn, fpath, row_count=0, diam=10, seed_cpds=False,
+                                       batch_size=FETCH_BATCH_SIZE):
+    """
+    generate_rule_per_row_table_staged: stream the rule table for the given
+    diameter from the staging database to the TSV file fpath
+    :param conn: the Connection object from open_staging_connection
+    :param fpath: filename with path to write to
+    :param row_count: number of rows to output, if 0 output all
+    :param diam: reaction diameter
+    :param seed_cpds: only rules with seed reactants/products
+    :param batch_size: number of rows fetched and written at a time
+    :return: the number of rows written
+    """
+    qry = build_staged_query(diam, seed_cpds)
+    if not seed_cpds:
+        qry += " and " + prefix_condition("ri.repo_rxn_id", "rxn")
+
+    row_batches = execute_query_iter(conn, qry, batch_size)
+    return csv_write_stream(post_query_process_iter(row_batches, row_count), fpath)
+
+
+def main():
+    """
+    main: prepare (or reuse) the staging database and export from it
+    """
+    database = "/Users/qzhang/qzwk_dir/upload_RetroRules/retrorules_dump/mvc.db"
+    row_cnt = 0
+    diam = 16
+    str_row_cnt = str(row_cnt) if row_cnt > 0 else 'all'
+    outfile_nm = "../TSVs/retro_rules_dia{}_{}".format(str(diam), str_row_cnt) + ".tsv"
+
+    print("0. prepare the staging database...")
+    staging_path = prepare_staging_db(database)
+    print("   using {}".format(staging_path))
+
+    conn = open_staging_connection(database, staging_path)
+    with conn:
+        print("1. Query staging tables and stream the results to {}".format(outfile_nm))
+        n_rows = generate_rule_per_row_table_staged(conn, outfile_nm, row_cnt, diam)
+        print("2. Wrote {} rows to output file {}".format(n_rows, outfile_nm))
+
+
+if __name__ == '__main__':
+    main()
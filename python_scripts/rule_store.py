@@ -0,0 +1,198 @@
+import datetime
+import os
+
+from retroRules import (create_connection, build_rule_query, execute_query_iter, fetch_smarts,
+                        post_query_process_iter, csv_write_stream, ALL_DIAMETERS, FETCH_BATCH_SIZE)
+
+# bump whenever the layout of the store tables changes
+STORE_VERSION = "1"
+
+# the store tables: one shared record per rule core (reaction_id, substrate_id,
+# isStereo) with the columns that do not depend on the diameter, the distinct
+# product lists and SMARTS, and a small row per (rule core, diameter)
+STORE_SCHEMA = """
+create table store_meta (key text primary key, value text);
+create table rule_cores (
+    core_id integer primary key, reaction_id integer, substrate_id integer, isStereo integer,
+    repo_rxn_id text, ec_numbers text, rule_substrate_cpd text,
+    rxn_substrate_ids text, rxn_substrate_inchis text, rxn_product_ids text, rxn_product_inchis text);
+create table product_sets (
+    product_set_id integer primary key, rule_prod_ids text, rule_prod_stoichios text, total_stoichios integer);
+create table smarts (smarts_id integer primary key, smarts_string text);
+create table rule_diameters (
+    core_id integer, diameter integer, direction integer, score real, smarts_id integer, product_set_id integer);
+"""
+
+# created once the tables are filled
+STORE_INDEXES = [
+    "create index rule_diameters_diameter on rule_diameters(diameter)",
+]
+
+# the columns of the rule query (build_rule_query) by position
+CORE_COLUMNS = (0, 3, 7, 1, 2, 4, 13, 14, 15, 16)  # rule_cores, after core_id
+PRODUCT_COLUMNS = (11, 12, 17)  # product_sets, after product_set_id
+
+# rebuilds the rows of build_rule_query for one diameter, in the same order
+DIAMETER_VIEW_QUERY = """
+    select c.reaction_id,c.repo_rxn_id,c.ec_numbers,c.substrate_id,c.rule_substrate_cpd,
+        d.direction,d.diameter,c.isStereo,d.score,s.smarts_string,'Any' as Reactants,
+        p.rule_prod_ids,p.rule_prod_stoichios,c.rxn_substrate_ids,c.rxn_substrate_inchis,
+        c.rxn_product_ids,c.rxn_product_inchis,p.total_stoichios,
+        '<'||c.reaction_id||'|'||c.repo_rxn_id||'|'||c.rule_substrate_cpd||'|'||d.diameter||'|'||
+        (case when d.direction=-1 then 'reverse' else 'forward' end)||
+        (case when c.isStereo=1 then '|isStereo>' else '>' end) as Name
+    from rule_diameters d
+    join rule_cores c on c.core_id=d.core_id
+    join product_sets p on p.product_set_id=d.product_set_id
+    join smarts s on s.smarts_id=d.smarts_id
+    where d.diameter={diam}
+    order by d.rowid
+"""
+
+
+def build_rule_store(conn, store_path, diams=ALL_DIAMETERS, repo_prefix='rxn', batch_size=FETCH_BATCH_SIZE):
+    """
+    build_rule_store: store the rules of all the given diameters compactly in a
+    SQLite file: the rule core columns (the reaction, EC numbers, substrate and
+    reaction compounds) once per (reaction_id, substrate_id, isStereo), each
+    distinct product list and SMARTS once, and per diameter only (direction,
+    score, smarts_id, product_set_id). One pass of the rule query fills it.
+    :param conn: the Connection object of the RetroRules database
+    :param store_path: the store filename with path, built as <store_path>.tmp
+    and moved in place once complete
+    :param diams: the reaction diameters to store
+    :param repo_prefix: keep the reactions whose repository id starts with it
+    :param batch_size: number of rows fetched and inserted at a time
+    :return: a dict of the row counts per store table
+    """
+    tmp_path = store_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    store = create_connection(tmp_path)
+    store.executescript(STORE_SCHEMA)
+
+    cores = {}
+    product_sets = {}
+    smarts_ids = set()
+    n_rows = 0
+    qry = build_rule_query(list(diams), repo_prefix=repo_prefix, smarts_ids=True)
+    for rows in execute_query_iter(conn, qry, batch_size):
+        new_cores = []
+        new_product_sets = []
+        diameter_rows = []
+        for row in rows:
+            core_key = (row[0], row[3], row[7])
+            core_id = cores.get(core_key)
+            if core_id is None:
+                core_id = cores[core_key] = len(cores) + 1
+                new_cores.append((core_id,) + tuple(row[i] for i in CORE_COLUMNS))
+            product_key = tuple(row[i] for i in PRODUCT_COLUMNS)
+            product_set_id = product_sets.get(product_key)
+            if product_set_id is None:
+                product_set_id = product_sets[product_key] = len(product_sets) + 1
+                new_product_sets.append((product_set_id,) + product_key)
+            smarts_ids.add(row[9])
+            diameter_rows.append((core_id, row[6], row[5], row[8], row[9], product_set_id))
+        store.executemany("insert into rule_cores values (?,?,?,?,?,?,?,?,?,?,?)", new_cores)
+        store.executemany("insert into product_sets values (?,?,?,?)", new_product_sets)
+        store.executemany("insert into rule_diameters values (?,?,?,?,?,?)", diameter_rows)
+        n_rows += len(rows)
+
+    store.executemany("insert into smarts values (?,?)", fetch_smarts(conn, smarts_ids).items())
+    for stmt in STORE_INDEXES:
+        store.execute(stmt)
+    meta = {"store_version": STORE_VERSION, "diameters": ",".join(str(d) for d in sorted(diams)),
+            "repo_prefix": repo_prefix or "", "created": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+    store.executemany("insert into store_meta values (?,?)", meta.items())
+    store.commit()
+    store.execute("vacuum")
+    store.close()
+    os.replace(tmp_path, store_path)
+    return {"rule_diameters": n_rows, "rule_cores": len(cores),
+            "product_sets": len(product_sets), "smarts": len(smarts_ids)}
+
+
+class RuleStore(object):
+    """
+    RuleStore: the reader of a build_rule_store file, rebuilding the rule table
+    of any single diameter on demand, row for row as the rule query (and so
+    the TSV export) of that diameter would return it
+
+        with RuleStore("rules_store.db") as store:
+            store.write_diameter_tsv(16, "retro_rules_dia16_all.tsv")
+    """
+
+    def __init__(self, store_path):
+        self.conn = create_connection(store_path, read_only=True)
+        if self.conn is None:
+            raise IOError("cannot open the rule store {}".format(store_path))
+        self.meta = dict(self.conn.execute("select key, value from store_meta").fetchall())
+        if self.meta.get("store_version") != STORE_VERSION:
+            raise ValueError("unsupported rule store version: {}".format(self.meta.get("store_version")))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        self.conn.close()
+
+    def diameters(self):
+        """
+        diameters: the diameters in the store
+        """
+        return [int(d) for d in self.meta["diameters"].split(",") if d]
+
+    def iter_diameter_rows(self, diam, batch_size=FETCH_BATCH_SIZE):
+        """
+        iter_diameter_rows: stream the rule rows of one diameter
+        :param diam: the reaction diameter
+        :param batch_size: number of rows per batch
+        :return: a generator of lists of rows (tuples), as execute_query_iter of
+        build_rule_query(diam, repo_prefix=...)
+        """
+        if diam not in self.diameters():
+            raise ValueError("diameter {} is not in the store".format(diam))
+        return execute_query_iter(self.conn, DIAMETER_VIEW_QUERY.format(diam=int(diam)), batch_size)
+
+    def write_diameter_tsv(self, diam, fpath, row_count=0, batch_size=FETCH_BATCH_SIZE):
+        """
+        write_diameter_tsv: write the post-processed rule table of one diameter,
+        the same file as generate_rule_per_row_table_stream writes
+        :param diam: the reaction diameter
+        :param fpath: filename with path to write to
+        :param row_count: number of rows to output, if 0 output all
+        :param batch_size: number of rows read and written at a time
+        :return: the number of rows written
+        """
+        return csv_write_stream(post_query_process_iter(self.iter_diameter_rows(diam, batch_size), row_count),
+                                fpath)
+
+
+def main():
+    """
+    main: store all the rule diameters, then rebuild the diameter 16 table from the store
+    """
+    database = "/Users/qzhang/qzwk_dir/upload_RetroRules/retrorules_dump/mvc.db"
+    store_nm = "../TSVs/retro_rules_store.db"
+    diam = 16
+    outfile_nm = "../TSVs/retro_rules_dia{}_all.tsv".format(diam)
+
+    print("0. create a database connection...")
+    conn = create_connection(database, read_only=True, profile="fast_read")
+    with conn:
+        print("1. Store the rules of all the diameters in {}".format(store_nm))
+        counts = build_rule_store(conn, store_nm, ALL_DIAMETERS)
+        print("2. Stored {rule_diameters} rules as {rule_cores} rule cores, {product_sets} product sets "
+              "and {smarts} SMARTS".format(**counts))
+
+    with RuleStore(store_nm) as store:
+        n_rows = store.write_diameter_tsv(diam, outfile_nm)
+        print("3. Wrote {} rows to output file {}".format(n_rows, outfile_nm))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+import argparse
+import os
+import random
+import sqlite3
+
+
+# the tables of the RetroRules mvc.db that the rule queries read
+RETRORULES_SCHEMA = """
+create table chemical_species(id integer primary key, mnxm text, inchi_key text,
+    seed text, bigg text, kegg text, metacyc text);
+create table reactions(id integer primary key, mnxr text, seed text, bigg text, kegg text, metacyc text);
+create table smarts(id integer primary key, smarts_string text);
+create table rules(id integer primary key, reaction_id integer, substrate_id integer, diameter integer,
+    direction integer, isStereo integer, score real, smarts_id integer);
+create table rule_products(id integer primary key, reaction_id integer, substrate_id integer,
+    product_id integer, diameter integer, isStereo integer, stochiometry integer);
+create table ec_reactions(ec_number text, reaction_id integer);
+create table reaction_substrates(reaction_id integer, chemical_id integer, stochiometry integer);
+create table reaction_products(reaction_id integer, chemical_id integer, stochiometry integer);
+"""
+
+# the tables of wom.sqlite3 that the WOM queries read
+WOM_SCHEMA = """
+create table matchmaker_compound(id integer primary key, compound_name text, formula text, neutralmass real);
+create table matchmaker_environment(id integer primary key, env_name text);
+create table matchmaker_organism(id integer primary key, common_name text, NCBI_taxid integer);
+create table matchmaker_project(id integer primary key, project_name text, contributor text,
+    project_description text);
+create table matchmaker_observation(id integer primary key, compound_id integer, action text,
+    confidence real, environment_id integer, organism_id integer, project_id integer);
+"""
+
+# the rule diameters and stereo flags, i.e., 16 rules per reaction and rule substrate
+RULE_DIAMETERS = (2, 4, 6, 8, 10, 12, 14, 16)
+RULES_PER_SUBSTRATE = len(RULE_DIAMETERS) * 2
+
+WOM_ACTIONS = ("N", "D", "I", "E")
+
+
+def new_database(db_path, schema):
+    """
+    new_database: (re)create a SQLite database file with the given schema
+    :param db_path: the database file
+    :param schema: the DDL script
+    :return: the Connection object
+    """
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    conn = sqlite3.connect(db_path)
+    conn.execute("pragma journal_mode=off")
+    conn.execute("pragma synchronous=off")
+    conn.executescript(schema)
+    return conn
+
+
+def repo_id(rnd, prefix, i, share):
+    """
+    repo_id: a repository id present for about the given share of the entries
+    """
+    return "{}{:05d}".format(prefix, i) if rnd.random() < share else None
+
+
+def generate_retrorules_db(db_path, n_rules=10000, seed=0):
+    """
+    generate_retrorules_db: build a synthetic database with the RetroRules
+    schema, with about the proportions of mvc.db (2.5 reactions in all per
+    reaction with rules, 1-2 rule substrates per reaction, 16 rules per rule
+    substrate, 1-3 products per rule, multi-product SMARTS wrapped in '>>(...)')
+    :param db_path: the database file, overwritten
+    :param n_rules: the number of rules
+    :param seed: the random seed
+    :return: a dict of table name to the number of rows
+    """
+    rnd = random.Random(seed)
+    n_pairs = -(-n_rules // RULES_PER_SUBSTRATE)
+    n_rxns = max(1, n_pairs * 5 // 3)
+    n_cpds = max(10, n_rxns)
+
+    conn = new_database(db_path, RETRORULES_SCHEMA)
+    conn.executemany(
+        "insert into chemical_species values (?,?,?,?,?,?,?)",
+        ((i, "MNXM{}".format(i), "IK{:012d}-UHFFFAOYSA-N".format(i), repo_id(rnd, "cpd", i, 0.6),
+          repo_id(rnd, "bigg", i, 0.3), repo_id(rnd, "C", i, 0.3), repo_id(rnd, "CPD-", i, 0.3))
+         for i in range(1, n_cpds + 1)))
+    conn.executemany(
+        "insert into reactions values (?,?,?,?,?,?)",
+        ((i, "MNXR{}".format(i), repo_id(rnd, "rxn", i, 0.3), repo_id(rnd, "BIGG", i, 0.27),
+          repo_id(rnd, "R", i, 0.24), repo_id(rnd, "RXN-", i, 0.34))
+         for i in range(1, n_rxns + 1)))
+
+    rxn_sides = {}
+    ec_rows, subs_rows, prod_rows = [], [], []
+    for rxn in range(1, n_rxns + 1):
+        subs = rnd.sample(range(1, n_cpds + 1), rnd.randint(1, 3))
+        prods = rnd.sample(range(1, n_cpds + 1), rnd.randint(1, 3))
+        rxn_sides[rxn] = (subs, prods)
+        subs_rows.extend((rxn, cpd, rnd.randint(1, 2)) for cpd in subs)
+        prod_rows.extend((rxn, cpd, rnd.randint(1, 2)) for cpd in prods)
+        ec_rows.extend(("{}.{}.{}.{}".format(rnd.randint(1, 7), rnd.randint(1, 20), rnd.randint(1, 30),
+                                             rnd.randint(1, 200)), rxn)
+                       for _ in range(rnd.choice((0, 1, 1, 1, 2))))
+    conn.executemany("insert into ec_reactions values (?,?)", ec_rows)
+    conn.executemany("insert into reaction_substrates values (?,?,?)", subs_rows)
+    conn.executemany("insert into reaction_products values (?,?,?)", prod_rows)
+
+    # the (reaction, rule substrate) pairs: 1-2 substrates of a random subset of the reactions
+    pairs = []
+    for rxn in rnd.sample(range(1, n_rxns + 1), n_rxns):
+        pairs.extend((rxn, sub) for sub in rxn_sides[rxn][0][:rnd.randint(1, 2)])
+        if len(pairs) >= n_pairs:
+            break
+    pairs = sorted(pairs[:n_pairs])
+
+    smarts_rows, rule_rows, rule_prod_rows = [], [], []
+    n_made = 0
+    for rxn, sub in pairs:
+        prods = rxn_sides[rxn][1]
+        for diam in RULE_DIAMETERS:
+            for stereo in (0, 1):
+                if n_made >= n_rules:
+                    break
+                n_made += 1
+                rule_prods = rnd.sample(prods, rnd.randint(1, len(prods)))
+                stoichios = [rnd.choice((1, 1, 1, 2)) for _ in rule_prods]
+                core = "[#6:{0}]-[#8:{1}]".format(diam, diam + 1) + "-[#6]" * (diam // 2)
+                rhs = ".".join("[#6:{0}]=[#8:{1}]".format(diam, diam + 1 + k) for k in range(len(rule_prods)))
+                smarts = "({})>>".format(core) + ("({})".format(rhs) if sum(stoichios) > 1 else rhs)
+                smarts_rows.append((n_made, smarts))
+                rule_rows.append((n_made, rxn, sub, diam, rnd.choice((1, -1)), stereo,
+                                  round(rnd.random(), 6), n_made))
+                rule_prod_rows.extend((None, rxn, sub, prod, diam, stereo, st)
+                                      for prod, st in zip(rule_prods, stoichios))
+        if len(rule_rows) >= 50000:
+            conn.executemany("insert into smarts values (?,?)", smarts_rows)
+            conn.executemany("insert into rules values (?,?,?,?,?,?,?,?)", rule_rows)
+            conn.executemany("insert into rule_products values (?,?,?,?,?,?,?)", rule_prod_rows)
+            smarts_rows, rule_rows, rule_prod_rows = [], [], []
+    conn.executemany("insert into smarts values (?,?)", smarts_rows)
+    conn.executemany("insert into rules values (?,?,?,?,?,?,?,?)", rule_rows)
+    conn.executemany("insert into rule_products values (?,?,?,?,?,?,?)", rule_prod_rows)
+    conn.commit()
+
+    counts = dict((tbl, conn.execute("select count(*) from " + tbl).fetchone()[0])
+                  for tbl in ("rules", "rule_products", "smarts", "chemical_species", "reactions",
+                              "reaction_substrates", "reaction_products", "ec_reactions"))
+    conn.close()
+    return counts
+
+
+def generate_wom_db(db_path, n_compounds=2000, n_eops=100, density=0.3, seed=0):
+    """
+    generate_wom_db: build a synthetic database with the WOM schema, where each
+    environment-organism-project has an observation for about the given share
+    of the compounds (compound ids are 1..n_compounds, as wom.py expects)
+    :param db_path: the database file, overwritten
+    :param n_compounds: the number of compounds (matrix rows)
+    :param n_eops: the number of environment-organism-project combinations (matrix columns)
+    :param density: the share of compounds observed per combination
+    :param seed: the random seed
+    :return: a dict of table name to the number of rows
+    """
+    rnd = random.Random(seed)
+    n_envs = max(1, n_eops // 10)
+    n_orgs = max(1, n_eops // 5)
+    n_prjs = max(1, n_eops // 20)
+
+    conn = new_database(db_path, WOM_SCHEMA)
+    conn.executemany("insert into matchmaker_compound values (?,?,?,?)",
+                     ((i, "compound_{}".format(i), "C{}H{}O{}".format(i % 30 + 1, i % 60 + 1, i % 9),
+                       round(50 + rnd.random() * 900, 4)) for i in range(1, n_compounds + 1)))
+    conn.executemany("insert into matchmaker_environment values (?,?)",
+                     ((i, "environment {}".format(i)) for i in range(1, n_envs + 1)))
+    conn.executemany("insert into matchmaker_organism values (?,?,?)",
+                     ((i, "organism {}".format(i), 1000 + i) for i in range(1, n_orgs + 1)))
+    conn.executemany("insert into matchmaker_project values (?,?,?,?)",
+                     ((i, "project {}".format(i), "contributor {}".format(i), "description of project {}".format(i))
+                      for i in range(1, n_prjs + 1)))
+
+    eops = set()
+    while len(eops) < min(n_eops, n_envs * n_orgs * n_prjs):
+        eops.add((rnd.randint(1, n_envs), rnd.randint(1, n_orgs), rnd.randint(1, n_prjs)))
+    n_observed = max(1, int(n_compounds * density))
+
+    def observations():
+        for env, org, prj in sorted(eops):
+            for cpd in sorted(rnd.sample(range(1, n_compounds + 1), n_observed)):
+                yield (None, cpd, rnd.choice(WOM_ACTIONS), round(rnd.random(), 4), env, org, prj)
+    conn.executemany("insert into matchmaker_observation values (?,?,?,?,?,?,?)", observations())
+    conn.commit()
+
+    counts = dict((tbl, conn.execute("select count(*) from " + tbl).fetchone()[0])
+                  for tbl in ("matchmaker_compound", "matchmaker_environment", "matchmaker_organism",
+                              "matchmaker_project", "matchmaker_observation"))
+    conn.close()
+    return counts
+
+
+def main():
+    """
+    main: generate a synthetic RetroRules and/or WOM database
+    """
+    parser = argparse.ArgumentParser(description="Generate synthetic RetroRules/WOM databases")
+    parser.add_argument("--rules", type=int, default=0, help="the number of rules of the RetroRules database")
+    parser.add_argument("--rules-db", default="synthetic_mvc.db")
+    parser.add_argument("--compounds", type=int, default=0, help="the number of compounds of the WOM database")
+    parser.add_argument("--eops", type=int, default=100)
+    parser.add_argument("--wom-db", default="synthetic_wom.sqlite3")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.rules:
+        print("Generate {} with {} rules...".format(args.rules_db, args.rules))
+        print(generate_retrorules_db(args.rules_db, args.rules, args.seed))
+    if args.compounds:
+        print("Generate {} with {} compounds...".format(args.wom_db, args.compounds))
+        print(generate_wom_db(args.wom_db, args.compounds, args.eops, seed=args.seed))
+
+
+if __name__ == '__main__':
+    main()
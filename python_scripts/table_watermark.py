@@ -0,0 +1,50 @@
+import hashlib
+
+
+# the rowids at the end of a table whose rows a watermark checksums: a row
+# inserted after the last ones were deleted reuses their rowids
+TAIL_ROWIDS = 4096
+
+
+def table_watermark(conn, table, max_rowid=None):
+    """
+    table_watermark: the state of a table up to a rowid: that rowid, the number
+    of rows up to it and an md5 of the rows of its last TAIL_ROWIDS rowids.
+    Only the tail and the rows after max_rowid are read; the row count of the
+    whole table is a count(*), which SQLite answers from the b-tree pages
+    without decoding the rows.
+    :param conn: the Connection object
+    :param table: the table name
+    :param max_rowid: the last rowid, by default the last rowid of the table
+    :return: a dict of max_rowid, count and tail_md5 (JSON serializable)
+    """
+    if max_rowid is None:
+        max_rowid = conn.execute("select max(rowid) from " + table).fetchone()[0]
+    if max_rowid is None:
+        return {"max_rowid": None, "count": 0, "tail_md5": None}
+    n_rows = conn.execute("select count(*) from " + table).fetchone()[0]
+    n_after = conn.execute("select count(*) from " + table + " where rowid > ?", (max_rowid,)).fetchone()[0]
+    md5 = hashlib.md5()
+    qry = "select rowid, * from " + table + " where rowid > ? and rowid <= ? order by rowid"
+    for row in conn.execute(qry, (max_rowid - TAIL_ROWIDS, max_rowid)):
+        md5.update(repr(row).encode())
+    return {"max_rowid": max_rowid, "count": n_rows - n_after, "tail_md5": md5.hexdigest()}
+
+
+def is_appended(conn, table, watermark):
+    """
+    is_appended: whether rows were only appended to the table since the
+    watermark was taken: the rows up to its rowid must still have the same
+    count and tail checksum. A row deleted anywhere changes the count, and a
+    new row reusing the rowid of a deleted one lands in the tail; a row
+    updated in place before the tail goes unnoticed.
+    :param conn: the Connection object
+    :param table: the table name
+    :param watermark: a table_watermark of the table, or None
+    :return: True if the table was only appended to
+    """
+    if watermark is None:
+        return False
+    if watermark["max_rowid"] is None:
+        return True
+    return table_watermark(conn, table, watermark["max_rowid"]) == watermark
@@ -0,0 +1,51 @@
+import os
+import sys
+
+import pytest
+
+# the scripts import each other as top-level modules, as when run from python_scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic_db import generate_retrorules_db, generate_wom_db  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def rules_db(tmp_path_factory):
+    """
+    rules_db: a small synthetic RetroRules database, shared by the tests
+    """
+    db_path = str(tmp_path_factory.mktemp("rules") / "mvc.db")
+    generate_retrorules_db(db_path, n_rules=3000, seed=0)
+    return db_path
+
+
+@pytest.fixture(scope="session")
+def wom_db(tmp_path_factory):
+    """
+    wom_db: a small synthetic WOM database, shared by the tests
+    """
+    db_path = str(tmp_path_factory.mktemp("wom") / "wom.sqlite3")
+    generate_wom_db(db_path, n_compounds=300, n_eops=20, density=0.3, seed=0)
+    return db_path
+
+
+@pytest.fixture
+def vm_steps():
+    """
+    vm_steps: a function counting the SQLite virtual machine instructions that
+    func() runs on conn, a measure of the rows a query reads that does not
+    depend on the machine
+    """
+    def count_steps(conn, func):
+        steps = [0]
+
+        def count():
+            steps[0] += 1
+            return 0
+        conn.set_progress_handler(count, 1)
+        try:
+            func()
+        finally:
+            conn.set_progress_handler(None, 1)
+        return steps[0]
+    return count_steps
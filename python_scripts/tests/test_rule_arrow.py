@@ -0,0 +1,98 @@
+import os
+
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+from retroRules import RULE_TABLE_HEADER  # noqa: E402
+from rule_arrow import DictionaryEncoder, DICTIONARY_COLUMNS, write_rule_arrow_ipc, write_rule_parquet  # noqa: E402
+
+SMARTS_COLUMNS = DICTIONARY_COLUMNS + ("SMARTS",)
+
+
+def distinct_values(n_batches, batch_size=1000):
+    """
+    distinct_values: n_batches lists of distinct 200-character strings, the
+    worst case of a dictionary column, e.g., the SMARTS of distinct rules
+    """
+    return [["{:09d}".format(b * batch_size + i) * 22 for i in range(batch_size)] for b in range(n_batches)]
+
+
+def rule_row_batches(n_batches, batch_size=1000):
+    """
+    rule_row_batches: processed rule rows with a distinct SMARTS each
+    """
+    for b, smarts in enumerate(distinct_values(n_batches, batch_size)):
+        yield [[b * batch_size + i, "rxn{:05d}".format(i % 97), "1.1.1.1", i, "cpd{:05d}".format(i % 50), 1, 16,
+                0, 1.0, smt, "Any", "cpd00002", "1", "cpd00001", "IK1", "cpd00002", "IK2", "Any", "<{}>".format(i)]
+               for i, smt in enumerate(smarts)]
+
+
+def test_dictionary_encoder_shares_one_dictionary():
+    encoder = DictionaryEncoder()
+    first = encoder.encode(["a", None, "b", "a"])
+    second = encoder.encode(["c", "b", "é"])
+    assert first.to_pylist() == ["a", None, "b", "a"]
+    assert second.to_pylist() == ["c", "b", "é"]
+    assert second.dictionary.to_pylist() == ["a", "b", "c", "é"]
+    assert first.dictionary.to_pylist() == ["a", "b"]
+
+
+def test_dictionary_encoder_appends_only_the_new_values():
+    encoder = DictionaryEncoder()
+    batches = distinct_values(20, batch_size=100)
+    seen = []
+    for b, column in enumerate(batches):
+        # half of the batch repeats the values of the batch before
+        column = column + (batches[b - 1][:50] if b else [])
+        encoded = encoder.encode(column)
+        seen.extend(batches[b])
+        assert encoder.n_values == len(seen)
+        assert encoded.dictionary.to_pylist() == seen
+        assert encoded.to_pylist() == column
+
+
+def test_arrow_ipc_writes_the_new_values_of_each_batch_as_a_delta(tmp_path):
+    fpath = str(tmp_path / "rules.arrow")
+    n_batches = 12
+    n_rows = write_rule_arrow_ipc(rule_row_batches(n_batches, 100), fpath, compression=None,
+                                  dictionary_columns=SMARTS_COLUMNS)
+    assert n_rows == n_batches * 100
+    smarts = distinct_values(n_batches, 100)
+
+    with pa.memory_map(fpath) as source:
+        table = pa.ipc.open_file(source).read_all()
+    assert table.column_names == list(RULE_TABLE_HEADER)
+    assert table.column("SMARTS").to_pylist() == [smt for batch in smarts for smt in batch]
+
+    # the file is the IPC stream after an 8-byte magic: read it message by
+    # message to see the dictionary each batch is written with
+    with pa.memory_map(fpath) as source:
+        source.seek(8)
+        reader = pa.ipc.open_stream(source)
+        for b, batch in enumerate(reader):
+            assert batch.column("SMARTS").dictionary.to_pylist() == [smt for values in smarts[:b + 1]
+                                                                     for smt in values]
+        stats = reader.stats
+    # one dictionary per column, then a delta of the new SMARTS of each batch,
+    # the other columns having no new values after the first batch
+    assert stats.num_replaced_dictionaries == 0
+    assert stats.num_dictionary_deltas == n_batches - 1
+    assert stats.num_dictionary_batches == len(SMARTS_COLUMNS) + n_batches - 1
+
+
+def test_parquet_rewrite_leaves_no_stale_partition(tmp_path):
+    out_dir = str(tmp_path / "rules_parquet")
+    diameter, is_stereo = RULE_TABLE_HEADER.index("diameter"), RULE_TABLE_HEADER.index("isStereo")
+    rows = next(rule_row_batches(1, 10))
+    counts = write_rule_parquet([rows], out_dir)
+    assert counts == {(16, 0): 10}
+    for row in rows:
+        row[diameter], row[is_stereo] = 2, 1
+    counts = write_rule_parquet([rows], out_dir)
+    assert counts == {(2, 1): 10}
+    assert os.listdir(out_dir) == ["diameter=2"]
+    assert sorted(os.listdir(str(tmp_path))) == ["rules_parquet"]
+    table = pq.read_table(out_dir)
+    assert table.num_rows == 10
@@ -0,0 +1,182 @@
+import gzip
+import hashlib
+import shutil
+import sqlite3
+
+import pytest
+
+import retroRules
+from delta_export import delta_export
+from parallel_export import parallel_rule_export
+from resumable_export import resumable_rule_export
+from rule_staging import prepare_staging_db, open_staging_connection, generate_rule_per_row_table_staged
+
+# the sha256 of the TSVs the original retroRules.py (generate_rule_per_row_table
+# and csv_write) wrote for the rules_db fixture, per diameter
+BASELINE_SHA256 = {
+    2: "3ac6878b52cc526b0b853fd1ff69e2e3e8daba6df1f4151151311c231050015b",
+    16: "0d7a716de6b1eaa00b1b30e305c7a5fb5d7e5da71535aa9d7dadfb94d8db87d1",
+}
+
+DIAMETERS = sorted(BASELINE_SHA256)
+
+
+def sha256_of(fpath):
+    opener = gzip.open if fpath.endswith(".gz") else open
+    with opener(fpath, "rb") as file_obj:
+        return hashlib.sha256(file_obj.read()).hexdigest()
+
+
+def read_bytes(fpath):
+    with open(fpath, "rb") as file_obj:
+        return file_obj.read()
+
+
+@pytest.fixture
+def conn(rules_db):
+    conn = sqlite3.connect(rules_db)
+    yield conn
+    conn.close()
+
+
+@pytest.mark.parametrize("diam", DIAMETERS)
+@pytest.mark.parametrize("engine", retroRules.RULE_JOIN_ENGINES)
+def test_csv_write_matches_baseline(conn, tmp_path, diam, engine):
+    fpath = str(tmp_path / "rules.tsv")
+    retroRules.csv_write(retroRules.generate_rule_per_row_table(conn, diam=diam, engine=engine), fpath)
+    assert sha256_of(fpath) == BASELINE_SHA256[diam]
+
+
+@pytest.mark.parametrize("diam", DIAMETERS)
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_stream_export_matches_baseline(conn, tmp_path, diam, compression):
+    fpath = retroRules.compressed_fpath(str(tmp_path / "rules.tsv"), compression)
+    n_rows = retroRules.generate_rule_per_row_table_stream(conn, fpath, diam=diam, compression=compression)
+    assert n_rows > 0
+    assert sha256_of(fpath) == BASELINE_SHA256[diam]
+
+
+def test_per_diameter_export_matches_baseline(conn, tmp_path):
+    fpath_tmpl = str(tmp_path / "rules_{}.tsv")
+    retroRules.generate_rule_tables_per_diameter(conn, fpath_tmpl, diams=DIAMETERS)
+    for diam in DIAMETERS:
+        assert sha256_of(fpath_tmpl.format(diam)) == BASELINE_SHA256[diam]
+
+
+@pytest.mark.parametrize("diam", DIAMETERS)
+def test_staged_export_matches_baseline(rules_db, tmp_path, diam):
+    staging_path = prepare_staging_db(rules_db, str(tmp_path / "staging.db"))
+    conn = open_staging_connection(rules_db, staging_path)
+    fpath = str(tmp_path / "rules.tsv")
+    generate_rule_per_row_table_staged(conn, fpath, diam=diam)
+    conn.close()
+    assert sha256_of(fpath) == BASELINE_SHA256[diam]
+
+
+def test_staged_export_keeps_substrates_without_repository_id(rules_db, tmp_path):
+    db_path = str(tmp_path / "mvc.db")
+    shutil.copy(rules_db, db_path)
+    conn = sqlite3.connect(db_path)
+    substrate_id = conn.execute("select r.substrate_id from rules r join reactions rxn on rxn.id=r.reaction_id "
+                                "where rxn.seed like 'rxn%' limit 1").fetchone()[0]
+    conn.execute("update chemical_species set seed=null, bigg=null, kegg=null, metacyc=null, mnxm=null "
+                 "where id=?", (substrate_id,))
+    conn.commit()
+    staging_path = prepare_staging_db(db_path, str(tmp_path / "staging.db"))
+    direct_fpath, staged_fpath = str(tmp_path / "direct.tsv"), str(tmp_path / "staged.tsv")
+    retroRules.generate_rule_per_row_table_stream(conn, direct_fpath, diam=DIAMETERS[0])
+    conn.close()
+    conn = open_staging_connection(db_path, staging_path)
+    generate_rule_per_row_table_staged(conn, staged_fpath, diam=DIAMETERS[0])
+    conn.close()
+    direct_lines = read_bytes(direct_fpath).splitlines()
+    assert any(line.split(b"\t")[3] == str(substrate_id).encode() for line in direct_lines[1:])
+    assert sorted(read_bytes(staged_fpath).splitlines()) == sorted(direct_lines)
+
+
+@pytest.fixture
+def ordered_export(conn, tmp_path):
+    """
+    ordered_export: the bytes of the serial export sorted by the rule key, the
+    output the parallel and resumable exports reproduce; its rows are those of
+    the baseline export
+    """
+    def export(diam):
+        fpath = str(tmp_path / "ordered_{}.tsv".format(diam))
+        retroRules.generate_rule_per_row_table_stream(conn, fpath, diam=diam, ordered=True)
+        baseline_fpath = str(tmp_path / "baseline_{}.tsv".format(diam))
+        retroRules.generate_rule_per_row_table_stream(conn, baseline_fpath, diam=diam)
+        assert sha256_of(baseline_fpath) == BASELINE_SHA256[diam]
+        ordered = read_bytes(fpath)
+        assert sorted(ordered.splitlines()) == sorted(read_bytes(baseline_fpath).splitlines())
+        return ordered
+    return export
+
+
+@pytest.mark.parametrize("diam", DIAMETERS)
+@pytest.mark.parametrize("shard_mode", ["range", "hash"])
+def test_parallel_export_round_trip(rules_db, tmp_path, ordered_export, diam, shard_mode):
+    fpath = str(tmp_path / "rules.tsv")
+    fpaths, n_rows = parallel_rule_export(rules_db, fpath, diam=diam, n_workers=2, n_shards=3,
+                                          shard_mode=shard_mode)
+    assert fpaths == [fpath]
+    expected = ordered_export(diam)
+    assert read_bytes(fpath) == expected
+    assert n_rows == expected.count(b"\n") - 1
+
+
+@pytest.mark.parametrize("diam", DIAMETERS)
+def test_resumable_export_round_trip(rules_db, tmp_path, ordered_export, diam):
+    fpath = str(tmp_path / "rules.tsv")
+    n_rows, done = resumable_rule_export(rules_db, fpath, diam=diam, n_ranges=4, max_parts=1)
+    assert not done and 0 < n_rows
+    n_rows, done = resumable_rule_export(rules_db, fpath, diam=diam, n_ranges=4)
+    assert done
+    expected = ordered_export(diam)
+    assert read_bytes(fpath) == expected
+    assert n_rows == expected.count(b"\n") - 1
+
+
+def test_stream_export_raises_on_a_failing_query(conn, tmp_path):
+    with pytest.raises(sqlite3.Error):
+        retroRules.generate_rule_per_row_table_stream(conn, str(tmp_path / "rules.tsv"),
+                                                      reaction_filter="{col} = no_such_column")
+
+
+def manifest_rows(fpath):
+    manifest = sqlite3.connect(fpath)
+    rows = manifest.execute("select * from rule_fingerprints order by 1, 2, 3, 4").fetchall()
+    manifest.close()
+    return rows
+
+
+def test_delta_export_only_fingerprints_the_appended_reactions(rules_db, tmp_path):
+    db_path = str(tmp_path / "mvc.db")
+    shutil.copy(rules_db, db_path)
+    conn = sqlite3.connect(db_path)
+    diam = DIAMETERS[0]
+    baseline_fpath = str(tmp_path / "baseline.tsv")
+    retroRules.generate_rule_per_row_table_stream(conn, baseline_fpath, diam=diam)
+    baseline_lines = read_bytes(baseline_fpath).splitlines()
+    manifest_fpath = str(tmp_path / "manifest.db")
+    counts = delta_export(conn, str(tmp_path / "first"), manifest_fpath, diam)
+    assert counts["added"] == len(baseline_lines) - 1
+    assert sorted(read_bytes(str(tmp_path / "first_added.tsv")).splitlines()) == sorted(baseline_lines)
+
+    # a new EC number of one exported reaction: only its rules are fingerprinted and re-queried
+    rxn_id = int(baseline_lines[1].split(b"\t")[0])
+    n_rules = sum(1 for line in baseline_lines[1:] if int(line.split(b"\t")[0]) == rxn_id)
+    conn.execute("insert into ec_reactions(ec_number, reaction_id) values ('9.9.9.9', ?)", (rxn_id,))
+    conn.commit()
+    counts = delta_export(conn, str(tmp_path / "second"), manifest_fpath, diam)
+    assert counts["changed"] == n_rules and counts["added"] == counts["removed"] == 0
+    n_fingerprinted = counts["changed"] + counts["unchanged"]
+    assert n_fingerprinted < len(baseline_lines) / 10
+    changed_lines = read_bytes(str(tmp_path / "second_changed.tsv")).splitlines()[1:]
+    assert all(b"9.9.9.9" in line for line in changed_lines)
+
+    # the manifest is the one a full export of the new tables writes
+    fresh_fpath = str(tmp_path / "fresh.db")
+    delta_export(conn, str(tmp_path / "fresh"), fresh_fpath, diam)
+    conn.close()
+    assert manifest_rows(manifest_fpath) == manifest_rows(fresh_fpath)
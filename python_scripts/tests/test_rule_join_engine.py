@@ -0,0 +1,24 @@
+import sqlite3
+
+import pytest
+
+from retroRules import build_rule_query, execute_query
+from rule_join_engine import rule_rows_hash_join
+
+
+@pytest.mark.parametrize("filters", [
+    {},
+    {"repo_prefix": "rxn"},
+    {"ec_prefix": "1."},
+    {"reaction_filter": "{col} % 4 = 1"},
+    {"reaction_filter": "{col} < 300", "repo_prefix": "rxn"},
+])
+def test_hash_join_matches_the_sql_query(rules_db, filters):
+    conn = sqlite3.connect(rules_db)
+    try:
+        expected = execute_query(conn, build_rule_query([2, 16], ordered=True, **filters))
+        rows = rule_rows_hash_join(conn, [2, 16], ordered=True, **filters)
+    finally:
+        conn.close()
+    assert expected
+    assert [tuple(row) for row in rows] == expected
@@ -0,0 +1,71 @@
+import asyncio
+import csv
+import http.client
+import json
+import sqlite3
+import threading
+
+import pytest
+
+from retroRules import RULE_TABLE_HEADER, generate_rule_per_row_table
+from rule_lookup import load_rule_index, start_server
+
+
+@pytest.fixture
+def rules_tsv(rules_db, tmp_path):
+    tsv_path = str(tmp_path / "rules.tsv")
+    conn = sqlite3.connect(rules_db)
+    with open(tsv_path, "w", newline="") as file_obj:
+        writer = csv.writer(file_obj, delimiter='\t')
+        writer.writerow(RULE_TABLE_HEADER)
+        writer.writerows(generate_rule_per_row_table(conn, diam=2))
+    conn.close()
+    return tsv_path
+
+
+def test_inchikey_index_uses_the_rule_substrate_key(rules_db, rules_tsv):
+    conn = sqlite3.connect(rules_db)
+    species_keys = dict((str(cs_id), key) for cs_id, key in conn.execute("select id, inchi_key from chemical_species"))
+    conn.close()
+
+    index = load_rule_index(rules_tsv, rules_db)
+    substrate_id = RULE_TABLE_HEADER.index("rule_substrate_id")
+    assert index.indexes["inchikey"]
+    for key in index.indexes["inchikey"]:
+        rows = index.lookup("inchikey", key)
+        assert rows and all(species_keys[row[substrate_id]] == key for row in rows)
+    assert sum(len(rows) for rows in index.indexes["inchikey"].values()) == len(index.rows)
+
+
+def test_http_lookup(rules_tsv):
+    index = load_rule_index(rules_tsv)
+    cpd = index.rows[0][RULE_TABLE_HEADER.index("rule_substrate_cpd")]
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(start_server(index, "127.0.0.1", 0))
+    port = server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        client = http.client.HTTPConnection("127.0.0.1", port, timeout=10)
+
+        def request(method, target, body=None):
+            client.request(method, target, body)
+            response = client.getresponse()
+            return response.status, json.loads(response.read())
+
+        status, found = request("GET", "/lookup?field=cpd&key=" + cpd)
+        assert status == 200 and found[cpd] and all(rule["rule_substrate_cpd"] == cpd for rule in found[cpd])
+        status, found = request("POST", "/lookup", json.dumps({"field": "cpd", "keys": [cpd, "none"]}))
+        assert status == 200 and found["none"] == [] and len(found[cpd]) == len(index.lookup("cpd", cpd))
+        for body in ([cpd], {"field": "cpd", "keys": cpd}, {"field": "cpd", "keys": [[cpd]]}):
+            status, error = request("POST", "/lookup", json.dumps(body))
+            assert status == 400 and error["error"]
+        status, error = request("GET", "/lookup?field=inchikey&key=IK")
+        assert status == 400 and "database" in error["error"]
+        client.close()
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
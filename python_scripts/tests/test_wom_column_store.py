@@ -0,0 +1,80 @@
+import shutil
+import sqlite3
+
+import numpy as np
+
+import table_watermark
+from wom_column_store import WomColumnStore
+from wom_matrix import build_dense_matrix
+
+INSERT_OBSERVATION = """insert into matchmaker_observation(compound_id, action, confidence, environment_id,
+    organism_id, project_id) values (?, ?, ?, ?, ?, ?)"""
+
+
+def store_matches_matrix(store, conn, row_count):
+    labels, matrix = build_dense_matrix(conn, row_count)
+    columns = np.column_stack([store.column(label) for label in store.labels()])
+    return list(labels) == store.labels() and np.array_equal(np.asarray(matrix, dtype=np.float64), columns,
+                                                             equal_nan=True)
+
+
+def test_refresh_after_appends_and_a_reused_rowid(wom_db, tmp_path):
+    db_path = str(tmp_path / "wom.sqlite3")
+    shutil.copy(wom_db, db_path)
+    store_dir = str(tmp_path / "store")
+    conn = sqlite3.connect(db_path)
+    row_count = conn.execute("select count(*) from matchmaker_compound").fetchone()[0]
+    counts = WomColumnStore(store_dir).refresh(conn, row_count)
+    assert counts["added"] > 0
+
+    # a new project is appended: only its column is built
+    conn.execute(INSERT_OBSERVATION, (5, 'I', 0.7, 1, 1, 999))
+    conn.commit()
+    store = WomColumnStore(store_dir)
+    assert store.is_appended(conn)
+    counts = store.refresh(conn, row_count)
+    assert counts["added"] == 1 and counts["changed"] == 0
+    assert store_matches_matrix(store, conn, row_count)
+
+    # the last observation is replaced by a new one reusing its rowid
+    max_rowid = conn.execute("select max(rowid) from matchmaker_observation").fetchone()[0]
+    row = conn.execute("select compound_id, environment_id, organism_id from matchmaker_observation "
+                       "where rowid=?", (max_rowid,)).fetchone()
+    conn.execute("delete from matchmaker_observation where rowid=?", (max_rowid,))
+    conn.execute(INSERT_OBSERVATION, (row[0], 'E', 0.25, row[1], row[2], 999))
+    conn.commit()
+    assert conn.execute("select max(rowid) from matchmaker_observation").fetchone()[0] == max_rowid
+    store = WomColumnStore(store_dir)
+    assert not store.is_appended(conn)
+    store.refresh(conn, row_count)
+    assert store_matches_matrix(store, conn, row_count)
+    conn.close()
+
+
+def test_is_appended_reads_the_tail_only(wom_db, tmp_path, monkeypatch, vm_steps):
+    monkeypatch.setattr(table_watermark, "TAIL_ROWIDS", 50)
+    db_path = str(tmp_path / "wom.sqlite3")
+    shutil.copy(wom_db, db_path)
+    conn = sqlite3.connect(db_path)
+    row_count = conn.execute("select count(*) from matchmaker_compound").fetchone()[0]
+    store = WomColumnStore(str(tmp_path / "store"))
+    store.refresh(conn, row_count)
+    steps = vm_steps(conn, lambda: store.is_appended(conn))
+
+    # the observations are appended again as a new project: the check costs the same
+    conn.execute("insert into matchmaker_observation(compound_id, action, confidence, environment_id, "
+                 "organism_id, project_id) select compound_id, action, confidence, environment_id, "
+                 "organism_id, 999 from matchmaker_observation")
+    conn.commit()
+    assert store.is_appended(conn)
+    store.refresh(conn, row_count)
+    assert store_matches_matrix(store, conn, row_count)
+    assert vm_steps(conn, lambda: store.is_appended(conn)) == steps
+
+    # an observation deleted before the tail still shows in the count
+    conn.execute("delete from matchmaker_observation where rowid=(select min(rowid) from matchmaker_observation)")
+    conn.commit()
+    assert not store.is_appended(conn)
+    store.refresh(conn, row_count)
+    assert store_matches_matrix(store, conn, row_count)
+    conn.close()
@@ -0,0 +1,83 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import wom
+from wom_column_store import WomColumnStore
+from wom_matrix import (build_dense_matrix, build_dense_matrix_parallel, build_sparse_matrix, fetch_observations,
+                        open_binary_matrix, rowid_blocks, write_binary_matrix, write_dense_matrix)
+
+
+def read_bytes(fpath):
+    with open(fpath, "rb") as file_obj:
+        return file_obj.read()
+
+
+@pytest.fixture
+def conn(wom_db):
+    conn = sqlite3.connect(wom_db)
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def row_count(conn):
+    return conn.execute("select count(*) from matchmaker_compound").fetchone()[0]
+
+
+@pytest.fixture
+def group_concat_matrix(conn, row_count, tmp_path):
+    """
+    group_concat_matrix: the matrix TSV of the original group_concat build
+    (matrix_query, post_query_process and pandas), as written by wom.main
+    """
+    fpath = str(tmp_path / "group_concat.tsv")
+    matrix_dict, _ = wom.post_query_process(wom.execute_query(conn, wom.matrix_query()), row_count)
+    pd.DataFrame(matrix_dict, columns=list(matrix_dict.keys())).to_csv(fpath, sep='\t', index=False, decimal='.')
+    return read_bytes(fpath)
+
+
+@pytest.mark.parametrize("build", ["dense", "sparse", "parallel", "incremental"])
+def test_matrix_builds_match_group_concat(wom_db, conn, row_count, tmp_path, group_concat_matrix, build):
+    fpath = str(tmp_path / "matrix.tsv")
+    if build == "dense":
+        col_labels, matrix = build_dense_matrix(conn, row_count)
+        write_dense_matrix(fpath, col_labels, matrix)
+    elif build == "sparse":
+        build_sparse_matrix(conn, row_count).write_dense(fpath)
+    elif build == "parallel":
+        col_labels, row_ids, matrix = build_dense_matrix_parallel(wom_db, n_workers=2)
+        write_dense_matrix(fpath, col_labels, matrix, None, row_ids)
+    else:
+        store = WomColumnStore(str(tmp_path / "store"))
+        store.refresh(conn, row_count)
+        store.write_dense(fpath)
+    assert read_bytes(fpath) == group_concat_matrix
+
+
+def test_rowid_blocks_read_their_share_of_the_table(conn, row_count, vm_steps):
+    min_rowid, max_rowid = conn.execute("select min(rowid), max(rowid) from matchmaker_observation").fetchone()
+    blocks = rowid_blocks(min_rowid, max_rowid, 4)
+    assert len(blocks) == 4 and blocks[0][0] == min_rowid and blocks[-1][1] == max_rowid
+    assert all(blocks[k][1] + 1 == blocks[k + 1][0] for k in range(3))
+
+    full = vm_steps(conn, lambda: fetch_observations(conn, row_count))
+    block_steps = [vm_steps(conn, lambda: fetch_observations(conn, row_count, rowids=block)) for block in blocks]
+    assert all(steps < full / 2 for steps in block_steps)
+    assert sum(block_steps) < 1.5 * full
+
+
+def test_binary_matrix_round_trip(conn, row_count, tmp_path):
+    col_labels, matrix = build_dense_matrix(conn, row_count)
+    dense_fpath = str(tmp_path / "matrix.f32")
+    write_binary_matrix(dense_fpath, col_labels, matrix)
+    sparse_fpath = str(tmp_path / "sparse.f32")
+    build_sparse_matrix(conn, row_count).write_binary(sparse_fpath)
+
+    for fpath in (dense_fpath, sparse_fpath):
+        values, compound_ids, labels = open_binary_matrix(fpath)
+        assert labels == list(col_labels)
+        assert compound_ids == list(range(1, row_count + 1))
+        assert np.array_equal(values, np.asarray(matrix, dtype=np.float32), equal_nan=True)
@@ -1,25 +1,15 @@
-
 import sqlite3
 from sqlite3 import Error
 import csv
 import pandas as pd
 import datetime
+import os
 import pprint
 
-
-def create_connection(db_file):
-    """ create a database connection to the SQLite database
-        specified by the db_file
-    :param db_file: database file
-    :return: Connection object or None
-    """
-    try:
-        conn = sqlite3.connect(db_file)
-        return conn
-    except Error as e:
-        print(e)
- 
-    return None
+from db_connection import create_connection
+from export_metrics import ExportMetrics
+from compressed_output import open_text_output, compressed_fpath
+from inchikey_index import INDEX_SCHEMA, attach_inchikey_index
 
 
 def column_attribute_query():
@@ -42,12 +32,21 @@ def column_attribute_query():
     return qry
 
 
-def row_attribute_query():
+def row_attribute_query(inchikeys=False):
     """
     row_attribute_query: construct a query that retrieves data for defining
     the matrix's row attributes from one table: matchmaker_compound
+    :param inchikeys: also select the inchikey column, looked up by compound
+    name in the ATTACHed InChIKey index (see inchikey_index), '' if none
     :return: an sqlite3 query string
     """
+    if inchikeys:
+        return """
+    SELECT c.compound_name as cpd_name, c.formula, c.id as cpd_id, c.neutralmass,
+    ifnull(k.inchikey, '') as inchikey
+    from matchmaker_compound c
+    left join {}.cpd_inchikeys k on k.cpd_name=c.compound_name
+    """.format(INDEX_SCHEMA)
     qry = """
     SELECT compound_name as cpd_name, formula, id as cpd_id, neutralmass
     from matchmaker_compound
@@ -224,15 +223,16 @@ def read_tsv_into_dict(tsvfile_path):
     return cpd_inchis
 
 
-def csv_write(data, fpath, fheader):
+def csv_write(data, fpath, fheader, compression=None):
     """
     csv_write: Write data to a CSV file path
     :param data: a list of lists that is returned by a database query
     :param fpath: filename with path to write to
     :param fheader: data header in the TSV file
     e.g., ["cpd_name", "formula", "cpd_id", "neutralmass", "inchiKey"]
+    :param compression: None, 'gzip' or 'zstd' (see compressed_output.open_text_output)
     """
-    with open(fpath, "w") as csv_file:
+    with open_text_output(fpath, compression) as csv_file:
         writer = csv.writer(csv_file, delimiter='\t')  # create a csv.writer, tab delimited
         # write the header
         writer.writerow(fheader)
@@ -262,51 +262,181 @@ def csv_dict_writer(path, fieldnames, data, delm):
 def main():
     # pp = pprint.PrettyPrinter(indent=4)
     database = "/Users/qzhang/qzwk_dir/wom/wom.sqlite3"
+    collect_metrics = True   # write the per-stage timings, row counts and query plans
+    profile = False   # also capture a cProfile of the run (slower)
+    compression = None   # or "gzip"/"zstd" to compress the TSVs as they are written
+    # "sparse" (triplets), "dense" (float array), "parallel" (dense, rowid blocks built
+    # in a process pool, rows mapped by the compound ids), "incremental" (refresh the changed
+    # columns of a column store, see wom_column_store) or "group_concat" (matrix_query);
+    # all but "sparse" write the wom_matrix_df TSV, "sparse" only with dense_matrix
+    matrix_build = "dense"
+    n_workers = None   # the worker processes of the "parallel" build, default the number of CPUs
+    dense_matrix = False   # also write the dense matrix TSV when matrix_build is "sparse"
+    binary_matrix = False   # also write the float32 matrix (see wom_matrix.open_binary_matrix), not "group_concat"
+    inchikey_index = True   # join the compounds to the indexed InChIKey TSV in SQL, not a dict
     print("1. create a database connection...")
-    conn = create_connection(database)
-
-    with conn:
-        now = datetime.datetime.now()
-        date_str = now.strftime("%Y-%m-%d")
+    conn = create_connection(database, read_only=True, profile="fast_read")
 
+    now = datetime.datetime.now()
+    date_str = now.strftime("%Y-%m-%d")
+    metrics = ExportMetrics("wom", enabled=collect_metrics, profile=profile)
+    with conn, metrics:
         print("2.1 Column query result...")
-        col_qry_result = execute_query(conn, column_attribute_query())
+        col_qry = column_attribute_query()
+        metrics.explain(conn, "column_attribute_query", col_qry)
+        with metrics.stage("column_query") as stage:
+            col_qry_result = execute_query(conn, col_qry)
+            stage.add_rows(len(col_qry_result or []))
         eop_header = ["env_org_proj_id", "environment_name", "organism_name",
                       "project_name", "NCBI_taxid", "contributor",
                       "project_description"]
-        eopfile_nm = "../TSVs/wom_eop_{}{}".format(date_str, ".tsv")
+        eopfile_nm = compressed_fpath("../TSVs/wom_eop_{}{}".format(date_str, ".tsv"), compression)
         print("2.2 Write environment_organism_project info to output file {}"
               .format(eopfile_nm))
         if col_qry_result:
             # pp.pprint(col_qry_result)
-            csv_write(col_qry_result, eopfile_nm, eop_header)
+            with metrics.stage("write_eop") as stage:
+                csv_write(col_qry_result, eopfile_nm, eop_header, compression)
+                stage.add_rows(len(col_qry_result))
+                stage.add_bytes(os.path.getsize(eopfile_nm))
 
-        print("3.1. read inchikey file...")
         csvfile_path = "/Users/qzhang/qzwk_dir/wom/genericLoading/" + \
             "formula_withoutNA_withInchiKeys.tsv"
-
-        cpd_inchi_dict = read_tsv_into_dict(csvfile_path)
-
-        print("3.2 Row query result...")
-        row_qry_result = execute_query(conn, row_attribute_query())
-
-        print("3.3 Inserting inchikey to compounds")
-        row_result = insert_inchikey(row_qry_result, cpd_inchi_dict)
+        if inchikey_index:
+            print("3.1. attach the inchikey index...")
+            with metrics.stage("inchikey_index"):
+                if attach_inchikey_index(conn, csvfile_path):
+                    print("3.1. rebuilt the inchikey index of {}".format(csvfile_path))
+
+            print("3.2 Row query result with inchikeys...")
+            row_qry = row_attribute_query(inchikeys=True)
+            metrics.explain(conn, "row_attribute_query", row_qry)
+            with metrics.stage("row_query") as stage:
+                row_result = execute_query(conn, row_qry) or []
+                stage.add_rows(len(row_result))
+        else:
+            print("3.1. read inchikey file...")
+            with metrics.stage("read_inchikeys") as stage:
+                cpd_inchi_dict = read_tsv_into_dict(csvfile_path)
+                stage.add_rows(len(cpd_inchi_dict))
+
+            print("3.2 Row query result...")
+            row_qry = row_attribute_query()
+            metrics.explain(conn, "row_attribute_query", row_qry)
+            with metrics.stage("row_query") as stage:
+                row_qry_result = execute_query(conn, row_qry)
+                stage.add_rows(len(row_qry_result or []))
+
+            print("3.3 Inserting inchikey to compounds")
+            with metrics.stage("insert_inchikey") as stage:
+                row_result = insert_inchikey(row_qry_result, cpd_inchi_dict)
+                stage.add_rows(len(row_result))
         cpd_header = ["cpd_name", "formula", "cpd_id",
                       "mass", "inchikey"]
-        cpdfile_nm = "../TSVs/wom_cpd_{}{}".format(date_str, ".tsv")
+        cpdfile_nm = compressed_fpath("../TSVs/wom_cpd_{}{}".format(date_str, ".tsv"), compression)
 
         print("3.4 Write compounds to output file {}".format(cpdfile_nm))
         if row_result:
-            csv_write(row_result, cpdfile_nm, cpd_header)
+            with metrics.stage("write_cpd") as stage:
+                csv_write(row_result, cpdfile_nm, cpd_header, compression)
+                stage.add_rows(len(row_result))
+                stage.add_bytes(os.path.getsize(cpdfile_nm))
 
         row_count = len(row_result)
-        matrix_dict, matrix_list = build_matrix(conn, row_count)
-        matrixfile_nm = "../TSVs/wom_matrix_df_{}{}".format(date_str, ".tsv")
-
-        print("4. Write matrix to output file {}".format(matrixfile_nm))
-        df = pd.DataFrame(matrix_dict, columns=list(matrix_dict.keys()))
-        df.to_csv(matrixfile_nm, sep='\t', index=False, decimal='.')
+        matrixfile_nm = compressed_fpath("../TSVs/wom_matrix_df_{}{}".format(date_str, ".tsv"), compression)
+        binaryfile_nm = "../TSVs/wom_matrix_{}{}".format(date_str, ".f32")
+        if matrix_build == "sparse":
+            from wom_matrix import build_sparse_matrix
+            with metrics.stage("matrix_sparse_build") as stage:
+                matrix = build_sparse_matrix(conn, row_count)
+                stage.add_rows(matrix.nnz)
+            mtxfile_nm = compressed_fpath("../TSVs/wom_matrix_{}{}".format(date_str, ".mtx"), compression)
+            tripletfile_nm = compressed_fpath("../TSVs/wom_matrix_triplets_{}{}".format(date_str, ".tsv"),
+                                              compression)
+            print("4. Write the sparse matrix to output files {} and {}".format(mtxfile_nm, tripletfile_nm))
+            with metrics.stage("write_matrix_sparse") as stage:
+                stage.add_rows(matrix.write_matrix_market(mtxfile_nm, compression))
+                matrix.write_triplets(tripletfile_nm, compression)
+                stage.add_bytes(os.path.getsize(mtxfile_nm) + os.path.getsize(tripletfile_nm))
+            if dense_matrix:
+                print("4. Write matrix to output file {}".format(matrixfile_nm))
+                with metrics.stage("write_matrix") as stage:
+                    stage.add_rows(matrix.write_dense(matrixfile_nm, compression))
+                    stage.add_bytes(os.path.getsize(matrixfile_nm))
+            if binary_matrix:
+                print("4. Write the float32 matrix to output file {}".format(binaryfile_nm))
+                with metrics.stage("write_matrix_binary") as stage:
+                    stage.add_bytes(matrix.write_binary(binaryfile_nm))
+                    stage.add_rows(matrix.n_rows)
+        elif matrix_build == "dense":
+            from wom_matrix import build_dense_matrix, write_dense_matrix, write_binary_matrix
+            with metrics.stage("matrix_dense_build") as stage:
+                col_labels, matrix = build_dense_matrix(conn, row_count)
+                stage.add_rows(len(matrix))
+            print("4. Write matrix to output file {}".format(matrixfile_nm))
+            with metrics.stage("write_matrix") as stage:
+                stage.add_rows(write_dense_matrix(matrixfile_nm, col_labels, matrix, compression))
+                stage.add_bytes(os.path.getsize(matrixfile_nm))
+            if binary_matrix:
+                print("4. Write the float32 matrix to output file {}".format(binaryfile_nm))
+                with metrics.stage("write_matrix_binary") as stage:
+                    stage.add_bytes(write_binary_matrix(binaryfile_nm, col_labels, matrix))
+                    stage.add_rows(len(matrix))
+        elif matrix_build == "parallel":
+            from wom_matrix import build_dense_matrix_parallel, write_dense_matrix, write_binary_matrix
+            with metrics.stage("matrix_parallel_build") as stage:
+                col_labels, row_ids, matrix = build_dense_matrix_parallel(database, n_workers=n_workers)
+                stage.add_rows(len(matrix))
+            print("4. Write matrix to output file {}".format(matrixfile_nm))
+            with metrics.stage("write_matrix") as stage:
+                stage.add_rows(write_dense_matrix(matrixfile_nm, col_labels, matrix, compression, row_ids))
+                stage.add_bytes(os.path.getsize(matrixfile_nm))
+            if binary_matrix:
+                print("4. Write the float32 matrix to output file {}".format(binaryfile_nm))
+                with metrics.stage("write_matrix_binary") as stage:
+                    stage.add_bytes(write_binary_matrix(binaryfile_nm, col_labels, matrix, row_ids))
+                    stage.add_rows(len(matrix))
+        elif matrix_build == "incremental":
+            from wom_column_store import WomColumnStore
+            store_dir = "../TSVs/wom_matrix_store"
+            with metrics.stage("matrix_store_refresh") as stage:
+                store = WomColumnStore(store_dir)
+                counts = store.refresh(conn, row_count)
+                stage.add_rows(counts["added"] + counts["changed"])
+            print("4. Refreshed {} ({added} added, {changed} changed, {removed} removed columns)"
+                  .format(store_dir, **counts))
+            print("4. Write matrix to output file {}".format(matrixfile_nm))
+            with metrics.stage("write_matrix") as stage:
+                stage.add_rows(store.write_dense(matrixfile_nm, compression))
+                stage.add_bytes(os.path.getsize(matrixfile_nm))
+            if binary_matrix:
+                print("4. Write the float32 matrix to output file {}".format(binaryfile_nm))
+                with metrics.stage("write_matrix_binary") as stage:
+                    stage.add_bytes(store.write_binary(binaryfile_nm))
+                    stage.add_rows(store.n_rows)
+        else:
+            mtx_qry = matrix_query()
+            metrics.explain(conn, "matrix_query", mtx_qry)
+            with metrics.stage("matrix_query") as stage:
+                mtx_qry_result = execute_query(conn, mtx_qry)
+                stage.add_rows(len(mtx_qry_result or []))
+            with metrics.stage("matrix_transform") as stage:
+                matrix_dict, matrix_list = post_query_process(mtx_qry_result, row_count)
+                stage.add_rows(len(matrix_list))
+
+            print("4. Write matrix to output file {}".format(matrixfile_nm))
+            with metrics.stage("write_matrix") as stage:
+                df = pd.DataFrame(matrix_dict, columns=list(matrix_dict.keys()))
+                with open_text_output(matrixfile_nm, compression) as matrix_file:
+                    df.to_csv(matrix_file, sep='\t', index=False, decimal='.')
+                stage.add_rows(len(df))
+                stage.add_bytes(os.path.getsize(matrixfile_nm))
+
+    if collect_metrics:
+        metrics_nm = "../TSVs/wom_metrics_{}{}".format(date_str, ".json")
+        metrics.write(metrics_nm)
+        print("5. Wrote the run metrics to {}".format(metrics_nm))
+        metrics.print_summary()
 
 
 if __name__ == '__main__':
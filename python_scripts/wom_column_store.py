@@ -0,0 +1,279 @@
+import csv
+import datetime
+import json
+import os
+
+import numpy as np
+
+from atomic_files import atomic_path, write_json_atomic
+from db_connection import execute_query_iter
+from table_watermark import table_watermark, is_appended
+from wom import create_connection, execute_query
+from wom_matrix import (eop_label, eop_label_query, build_dense_matrix, dense_rows, create_binary_matrix,
+                        OBSERVATION_BATCH_SIZE)
+from compressed_output import open_text_output, compressed_fpath
+
+# bump whenever the layout of the store files changes
+STORE_VERSION = "3"
+
+# the number of matrix rows assembled from the column files at a time
+ROW_BLOCK_SIZE = 10000
+
+
+def new_observation_query():
+    """
+    new_observation_query: the matrix columns observed after a rowid (the ?
+    parameter): (environment_id, organism_id, project_id, min(rowid)), read
+    through the rowid range only
+    :return: an sqlite3 query string
+    """
+    return """
+        select environment_id, organism_id, project_id, min(rowid)
+        from matchmaker_observation
+        where rowid > ?
+        group by environment_id, organism_id, project_id
+    """
+
+
+def compound_range_query():
+    """
+    compound_range_query: the matrix columns with observations of the
+    compound_ids in (?, ?], i.e., the columns a change of row_count affects
+    :return: an sqlite3 query string
+    """
+    return """
+        select distinct environment_id, organism_id, project_id
+        from matchmaker_observation
+        where compound_id > ? and compound_id <= ?
+    """
+
+
+class WomColumnStore(object):
+    """
+    WomColumnStore: the compound x env_org_proj_id matrix kept on disk column
+    by column: a directory with one float64 .npy file per env_org_proj_id
+    (row k is compound_id k + 1, nan for the empty cells) and a manifest.json
+    recording the materialized rows (n_rows), the columns and their files, and
+    the watermark of the observations they were built from (see
+    table_watermark: the last rowid, the count and a checksum of the last rows).
+    The matchmaker loads append the observations of new projects, so
+    refresh() checks the watermark, which reads the tail of the table only,
+    and queries the observations after the last rowid: the column of a new
+    project is built from those alone, and a column with new observations is
+    rebuilt from all of its own; the whole matchmaker_observation table is
+    only read again when rows before the tail were deleted or replaced.
+
+        store = WomColumnStore("../TSVs/wom_matrix_store")
+        counts = store.refresh(conn, row_count)
+        store.write_dense(matrixfile_nm)
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.manifest_fpath = os.path.join(store_dir, "manifest.json")
+        self.manifest = {"version": STORE_VERSION, "n_rows": 0, "watermark": None, "columns": {}}
+        if os.path.exists(self.manifest_fpath):
+            with open(self.manifest_fpath, "r") as file_obj:
+                manifest = json.load(file_obj)
+            if manifest.get("version") == STORE_VERSION:
+                self.manifest = manifest
+
+    @property
+    def n_rows(self):
+        return self.manifest["n_rows"]
+
+    def labels(self):
+        """
+        labels: the column labels, sorted as the columns of matrix_query
+        """
+        return sorted(self.manifest["columns"])
+
+    def column_fpath(self, label):
+        return os.path.join(self.store_dir, self.manifest["columns"][label]["file"])
+
+    def column(self, label):
+        """
+        column: the values of one column, memory-mapped
+        :return: a float64 array of n_rows
+        """
+        return np.load(self.column_fpath(label), mmap_mode='r')
+
+    def save_column(self, label, values):
+        """
+        save_column: write the values of one column to its file, atomically;
+        the manifest is only updated by refresh, once all the columns are written
+        """
+        fname = label + ".npy"
+        with atomic_path(os.path.join(self.store_dir, fname)) as tmp_fpath:
+            with open(tmp_fpath, "wb") as file_obj:
+                np.save(file_obj, np.ascontiguousarray(values, dtype=np.float64))
+        return fname
+
+    def is_appended(self, conn):
+        """
+        is_appended: whether the observations of the last refresh are all still
+        there, i.e., the table was only appended to since (see
+        table_watermark.is_appended: after the last observation is deleted, a
+        new one may reuse its rowid; an observation edited in place before the
+        tail needs a full refresh)
+        """
+        if not self.manifest["columns"]:
+            return False
+        return is_appended(conn, "matchmaker_observation", self.manifest["watermark"])
+
+    def refresh(self, conn, row_count, batch_size=OBSERVATION_BATCH_SIZE, full=False):
+        """
+        refresh: bring the store up to date with the observations. When the
+        table was only appended to, the columns observed after the last
+        refresh are (re)built, a new column from the new observations only, and
+        the others are kept; a change of row_count rebuilds the columns with
+        observations of the compounds in between and pads the others with nan
+        (or cuts them). Otherwise, e.g., after observations were deleted, every
+        column is rebuilt.
+        :param conn: the Connection object
+        :param row_count: the number of compounds (matrix rows), as in
+        wom.post_query_process
+        :param batch_size: the width of the rowid ranges fetched at a time
+        :param full: rebuild every column
+        :return: a dict of the added/changed/removed/resized/unchanged column counts
+        """
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+        watermark = table_watermark(conn, "matchmaker_observation")
+        max_rowid = watermark["max_rowid"]
+        old_rows = self.n_rows
+        old_labels = set(self.manifest["columns"])
+        columns = dict((label, dict(col)) for label, col in self.manifest["columns"].items())
+        new_from = None
+        changed, resized = [], []
+        if full or not self.is_appended(conn):
+            columns = {}
+            new_columns = [(eop_label(*row), list(row)) for rows in execute_query_iter(conn, eop_label_query())
+                           for row in rows]
+        else:
+            new_columns = []
+            for env_id, org_id, prj_id, min_rowid in conn.execute(new_observation_query(),
+                                                                   (self.manifest["watermark"]["max_rowid"],)):
+                label = eop_label(env_id, org_id, prj_id)
+                if label in columns:
+                    changed.append(label)
+                else:
+                    new_columns.append((label, [env_id, org_id, prj_id]))
+                    new_from = min_rowid if new_from is None else min(new_from, min_rowid)
+            if old_rows != row_count:
+                affected = set(eop_label(*row) for row in conn.execute(
+                    compound_range_query(), (min(old_rows, row_count), max(old_rows, row_count))))
+                changed.extend(label for label in columns if label in affected and label not in changed)
+                resized = [label for label in columns if label not in changed]
+
+        for label, eop in new_columns:
+            columns[label] = {"eop": eop}
+        if new_columns:
+            # a new column has no observation before new_from
+            rowids = None if new_from is None else (new_from, max_rowid)
+            self.save_columns(conn, row_count, batch_size, [eop for _, eop in new_columns], rowids, columns)
+        if changed:
+            self.save_columns(conn, row_count, batch_size, [columns[label]["eop"] for label in changed],
+                              None, columns)
+        for label in resized:
+            values = np.full(row_count, np.nan)
+            n = min(old_rows, row_count)
+            values[:n] = self.column(label)[:n]
+            columns[label]["file"] = self.save_column(label, values)
+
+        self.manifest = {"version": STORE_VERSION, "n_rows": row_count, "watermark": watermark, "columns": columns,
+                         "refreshed": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        write_json_atomic(self.manifest, self.manifest_fpath)
+        removed = old_labels - set(columns)
+        for label in removed:
+            fpath = os.path.join(self.store_dir, label + ".npy")
+            if os.path.exists(fpath):
+                os.remove(fpath)
+
+        rebuilt = set(label for label, _ in new_columns) | set(changed)
+        return {"added": len(rebuilt - old_labels), "changed": len(rebuilt & old_labels),
+                "removed": len(removed), "resized": len(resized),
+                "unchanged": len(columns) - len(rebuilt) - len(resized)}
+
+    def save_columns(self, conn, row_count, batch_size, eops, rowids, columns):
+        """
+        save_columns: build the columns of the given env_org_proj_ids and save them
+        """
+        col_labels, matrix = build_dense_matrix(conn, row_count, batch_size, eops=eops, rowids=rowids)
+        for j, label in enumerate(col_labels):
+            columns[label]["file"] = self.save_column(label, matrix[:, j])
+
+    def iter_dense_rows(self, block_size=ROW_BLOCK_SIZE):
+        """
+        iter_dense_rows: the rows of the dense matrix, assembled from the
+        column files block_size rows at a time
+        :return: a generator of lists, as wom_matrix.dense_rows
+        """
+        columns = [self.column(label) for label in self.labels()]
+        for start in range(0, self.n_rows, block_size):
+            stop = min(start + block_size, self.n_rows)
+            block = np.empty((stop - start, len(columns)))
+            for j, values in enumerate(columns):
+                block[:, j] = values[start:stop]
+            for row in dense_rows(block):
+                row[0] += start
+                yield row
+
+    def write_dense(self, fpath, compression=None):
+        """
+        write_dense: write the matrix TSV from the store, the same file as the
+        full build (wom_matrix.write_dense_matrix)
+        :param fpath: filename with path to write to
+        :param compression: None, 'gzip' or 'zstd' (see compressed_output)
+        :return: the number of rows written
+        """
+        with open_text_output(fpath, compression) as file_obj:
+            writer = csv.writer(file_obj, delimiter='\t', lineterminator='\n')
+            writer.writerow(["compound_id"] + self.labels())
+            writer.writerows(self.iter_dense_rows())
+        return self.n_rows
+
+    def write_binary(self, fpath):
+        """
+        write_binary: write the matrix as a binary matrix (see
+        wom_matrix.create_binary_matrix), one column file at a time
+        :param fpath: the matrix filename with path
+        :return: the number of bytes of the matrix file
+        """
+        labels = self.labels()
+        out = create_binary_matrix(fpath, labels, self.n_rows)
+        for j, label in enumerate(labels):
+            out[:, j] = self.column(label)
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out.nbytes
+
+
+def main():
+    """
+    main: refresh the column store of the WOM matrix and write the matrix TSV from it
+    """
+    database = "/Users/qzhang/qzwk_dir/wom/wom.sqlite3"
+    store_dir = "../TSVs/wom_matrix_store"
+    compression = None   # or "gzip"/"zstd" to compress the TSV as it is written
+    full_refresh = False   # rebuild every column, e.g., after observations were edited in place
+    date_str = datetime.datetime.now().strftime("%Y-%m-%d")
+    matrixfile_nm = compressed_fpath("../TSVs/wom_matrix_df_{}{}".format(date_str, ".tsv"), compression)
+
+    print("1. create a database connection...")
+    conn = create_connection(database, read_only=True, profile="fast_read")
+    with conn:
+        row_count = execute_query(conn, "select count(*) from matchmaker_compound")[0][0]
+        print("2. Refresh the matrix columns in {}".format(store_dir))
+        store = WomColumnStore(store_dir)
+        counts = store.refresh(conn, row_count, full=full_refresh)
+        print("3. {added} added, {changed} changed, {removed} removed, {resized} resized and "
+              "{unchanged} unchanged columns".format(**counts))
+
+    print("4. Write matrix to output file {}".format(matrixfile_nm))
+    n_rows = store.write_dense(matrixfile_nm, compression)
+    print("5. Wrote {} rows to output file {}".format(n_rows, matrixfile_nm))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,536 @@
+import csv
+import json
+import multiprocessing
+import os
+import sqlite3
+
+import numpy as np
+
+from db_connection import create_connection, execute_query_iter
+from compressed_output import open_text_output
+
+# the width of the observation rowid ranges fetched at a time
+OBSERVATION_BATCH_SIZE = 500000
+
+# the cell type of the binary matrix: little-endian float32, nan for the empty cells
+BINARY_DTYPE = "<f4"
+
+
+def eop_label(environment_id, organism_id, project_id):
+    """
+    eop_label: the env_org_proj_id column label, as built in matrix_query
+    """
+    return "eop_E{}-O{}-P{}".format(environment_id, organism_id, project_id)
+
+
+def observation_query(bounds, cpd_range, eops=None):
+    """
+    observation_query: the matrix cell assignments of one observation rowid
+    range (the ? parameters), as three texts holding a plain column each, in
+    observation order: the cell keys, eop_keys(env_org_proj_id) * (the size
+    of cpd_range) + compound_id - the first compound_id, joined by ','; the
+    action codes, one character per observation; the confidences, joined by
+    ',' with 'nan' for NULL. Only the compound_ids in cpd_range and the
+    actions that set (I, E) or empty (N, D) a cell are kept. A column per text lets NumPy parse a whole range in C,
+    where fetching one Python object per value costs more than the legacy
+    build; the confidences get the text form of the group_concat of
+    matrix_query, so the values print the same.
+    :param bounds: the (organism, project) id ranges, see eop_keys
+    :param cpd_range: the (first, last) compound_id of the matrix rows
+    :param eops: only the observations of these (environment_id,
+    organism_id, project_id), default all
+    :return: an sqlite3 query string
+    """
+    eop_filter = ""
+    if eops is not None:
+        eop_filter = " and (environment_id, organism_id, project_id) in (values {})".format(
+            ",".join("({:d},{:d},{:d})".format(*eop) for eop in eops) or "(null,null,null)")
+    return """
+        select group_concat(cell_key), group_concat(action, ''), group_concat(ifnull(confidence, 'nan'))
+        from (select ((environment_id*{0}+organism_id)*{1}+project_id)*{2}+compound_id-{3} as cell_key,
+              action, confidence
+              from matchmaker_observation
+              where rowid between ? and ? and action in ('I','E','N','D') and compound_id between {3} and {4}{5}
+              order by rowid)
+    """.format(int(bounds[0]), int(bounds[1]), max(int(cpd_range[1]) - int(cpd_range[0]) + 1, 1),
+               int(cpd_range[0]), int(cpd_range[1]), eop_filter)
+
+
+def eop_label_query(rowids=False):
+    """
+    eop_label_query: the (environment_id, organism_id, project_id) of every
+    matrix column, i.e., of every env_org_proj_id observed
+    :param rowids: only those observed in a rowid range, the two ? parameters
+    """
+    return """
+        select distinct environment_id, organism_id, project_id
+        from matchmaker_observation""" + ("""
+        where rowid between ? and ?""" if rowids else "") + """
+    """
+
+
+def bounds_of(eops):
+    """
+    bounds_of: the (organism, project) id ranges of eop_keys for the given
+    (environment_id, organism_id, project_id)
+    """
+    return (max([eop[1] for eop in eops], default=0) + 1, max([eop[2] for eop in eops], default=0) + 1)
+
+
+def eop_keys(env_ids, org_ids, prj_ids, bounds):
+    """
+    eop_keys: encode (environment_id, organism_id, project_id) as one int64 key
+    :param bounds: the (organism, project) id ranges, i.e., the maxima + 1
+    """
+    return (env_ids * bounds[0] + org_ids) * bounds[1] + prj_ids
+
+
+def action_values(actions, confidences):
+    """
+    action_values: the signed cell values of a batch of observations, as the
+    if/elif chain of wom.post_query_process: intake (I) is the negated
+    confidence, excretion (E) the confidence, and not detected/no significant
+    change (N) and control detected (D) empty their cell (nan)
+    :param actions: the action codes, a uint8 array of their characters
+    :param confidences: the confidences, a float64 array
+    :return: a float64 array
+    """
+    signs = np.where(actions == ord('I'), -1.0, np.where(actions == ord('E'), 1.0, np.nan))
+    return signs * confidences
+
+
+def compound_row_ids(conn):
+    """
+    compound_row_ids: the compound_id of every matrix row, i.e., the ids of
+    matchmaker_compound in order, gaps (deleted compounds) included
+    :return: a sorted int64 array
+    """
+    ids = [row[0] for rows in execute_query_iter(conn, "select id from matchmaker_compound order by id")
+           for row in rows]
+    return np.array(ids, dtype=np.int64)
+
+
+def row_ids_of(row_count, compound_ids=None):
+    """
+    row_ids_of: the compound_id of every matrix row: the given compound_ids
+    (sorted, once each), or else 1 to row_count as in wom.post_query_process
+    """
+    if compound_ids is None:
+        return np.arange(1, row_count + 1, dtype=np.int64)
+    return np.unique(np.asarray(compound_ids, dtype=np.int64))
+
+
+def fetch_observations(conn, row_count, batch_size=OBSERVATION_BATCH_SIZE, eops=None, rowids=None,
+                       compound_ids=None):
+    """
+    fetch_observations: fetch the observations by rowid ranges and resolve
+    them to the final matrix cells with NumPy, without the per env_org_proj_id
+    group_concat of matrix_query and without per-cell Python code. As in
+    wom.post_query_process, the rows are the compound_ids 1 to row_count,
+    unless compound_ids maps them explicitly; the observations of other
+    compounds are dropped, and a later observation of a cell overrides an
+    earlier one.
+    :param conn: the Connection object
+    :param row_count: the number of compounds (matrix rows)
+    :param batch_size: the width of the rowid ranges fetched at a time
+    :param eops: only the columns of these (environment_id, organism_id,
+    project_id), default every env_org_proj_id observed (in rowids, if given)
+    :param rowids: the (first, last) observation rowids to scan, default all;
+    the cells are then those of the observations in the range, the whole
+    columns only for eops observed nowhere else
+    :param compound_ids: the compound_id of each row (see row_ids_of), for
+    ids with gaps or not starting at 1; row_count is then ignored
+    :return: a tuple of (column labels sorted as in matrix_query, 0-based rows,
+    columns, values), one entry per assigned cell in observation order, with
+    nan for the cells emptied by their last observation
+    """
+    eop_filter = None if eops is None else set(tuple(eop) for eop in eops)
+    if eops is None and rowids is None:
+        eops = [row for rows in execute_query_iter(conn, eop_label_query()) for row in rows]
+    elif eops is None:
+        eops = conn.execute(eop_label_query(rowids=True), rowids).fetchall()
+    labels = sorted((eop_label(*eop), eop) for eop in set(tuple(eop) for eop in eops))
+    col_labels = [label for label, _ in labels]
+    label_ids = np.array([eop for _, eop in labels], dtype=np.int64).reshape(-1, 3)
+    bounds = bounds_of(label_ids.tolist())
+    row_ids = row_ids_of(row_count, compound_ids)
+    cpd_range = (int(row_ids[0]), int(row_ids[-1])) if len(row_ids) else (1, 0)
+    span = max(cpd_range[1] - cpd_range[0] + 1, 1)
+    qry = observation_query(bounds, cpd_range, eop_filter).strip()
+    label_keys = eop_keys(label_ids[:, 0], label_ids[:, 1], label_ids[:, 2], bounds)
+    key_order = np.argsort(label_keys)
+
+    cur = conn.cursor()
+    if rowids is None:
+        rowids = cur.execute("select min(rowid), max(rowid) from matchmaker_observation").fetchone()
+    min_rowid, max_rowid = rowids
+    cell_keys, values = [], []
+    for start in range(min_rowid or 0, (max_rowid or -1) + 1, batch_size):
+        keys, actions, confidences = cur.execute(qry, (start, min(start + batch_size - 1, max_rowid))).fetchone()
+        if keys is None:
+            continue
+        cell_keys.append(np.fromstring(keys, dtype=np.int64, sep=','))
+        values.append(action_values(np.frombuffer(actions.encode(), dtype=np.uint8),
+                                    np.fromstring(confidences, dtype=np.float64, sep=',')))
+    cell_keys = np.concatenate(cell_keys) if cell_keys else np.zeros(0, dtype=np.int64)
+    values = np.concatenate(values) if values else np.zeros(0, dtype=np.float64)
+
+    # keep the last observation of each cell
+    _, last = np.unique(cell_keys[::-1], return_index=True)
+    keep = np.sort(len(cell_keys) - 1 - last)
+    cell_keys = cell_keys[keep]
+    values = values[keep]
+    cpd_ids = cell_keys % span + cpd_range[0]
+    rows = np.searchsorted(row_ids, cpd_ids)
+    if compound_ids is not None:  # drop the ids in the gaps
+        found = row_ids[np.minimum(rows, len(row_ids) - 1)] == cpd_ids
+        rows, cell_keys, values = rows[found], cell_keys[found], values[found]
+    cols = key_order[np.searchsorted(label_keys[key_order], cell_keys // span)]
+    return (col_labels, rows, cols, values)
+
+
+def dense_rows(matrix, row_ids=None):
+    """
+    dense_rows: the rows of a dense float matrix as written to the matrix TSV:
+    the compound_id then str(value), or '' for nan, of every column
+    :param row_ids: the compound_id of each row, default the row number + 1
+    :return: a generator of lists
+    """
+    row_ids = range(1, len(matrix) + 1) if row_ids is None else row_ids.tolist()
+    for cpd_id, values in zip(row_ids, matrix):
+        yield [cpd_id] + ['' if v != v else str(v) for v in values.tolist()]
+
+
+def write_dense_matrix(fpath, col_labels, matrix, compression=None, row_ids=None):
+    """
+    write_dense_matrix: stream a dense float matrix (see build_dense_matrix) to
+    the matrix TSV, the same file as the DataFrame of wom.post_query_process
+    written by pandas to_csv
+    :param fpath: filename with path to write to
+    :param col_labels: the env_org_proj_id column labels
+    :param matrix: the float matrix, nan for the empty cells
+    :param compression: None, 'gzip' or 'zstd' (see compressed_output)
+    :param row_ids: the compound_id of each row, default the row number + 1
+    :return: the number of rows written
+    """
+    with open_text_output(fpath, compression) as file_obj:
+        writer = csv.writer(file_obj, delimiter='\t', lineterminator='\n')
+        writer.writerow(["compound_id"] + list(col_labels))
+        writer.writerows(dense_rows(matrix, row_ids))
+    return len(matrix)
+
+
+def binary_matrix_fpaths(fpath):
+    """
+    binary_matrix_fpaths: the sidecar files of a binary matrix: its layout
+    (.json), row labels (.rows.tsv) and column labels (.cols.tsv)
+    """
+    return {"meta": fpath + ".json", "rows": fpath + ".rows.tsv", "cols": fpath + ".cols.tsv"}
+
+
+def create_binary_matrix(fpath, col_labels, n_rows, row_ids=None):
+    """
+    create_binary_matrix: create the binary matrix file, all nan, with its
+    sidecars, for the writers to fill. The cells are float32 in column-major
+    (Fortran) order, so each column is a contiguous run of n_rows cells and
+    reading a column only touches its own pages.
+    :param fpath: the matrix filename with path
+    :param col_labels: the env_org_proj_id column labels
+    :param n_rows: the number of rows
+    :param row_ids: the compound_id of each row, default 1 to n_rows
+    :return: the writable numpy.memmap; flush (or del) it when done
+    """
+    sidecars = binary_matrix_fpaths(fpath)
+    shape = (n_rows, len(col_labels))
+    with open(sidecars["meta"], "w") as file_obj:
+        json.dump({"dtype": BINARY_DTYPE, "shape": list(shape), "order": "F", "missing": "nan",
+                   "rows": "compound_id", "cols": "env_org_proj_id"}, file_obj, indent=2)
+    with open(sidecars["rows"], "w") as file_obj:
+        writer = csv.writer(file_obj, delimiter='\t', lineterminator='\n')
+        writer.writerow(["row", "compound_id"])
+        writer.writerows(enumerate(row_ids_of(n_rows, row_ids).tolist()))
+    with open(sidecars["cols"], "w") as file_obj:
+        writer = csv.writer(file_obj, delimiter='\t', lineterminator='\n')
+        writer.writerow(["column", "env_org_proj_id"])
+        writer.writerows(enumerate(col_labels))
+    if 0 in shape:  # numpy.memmap cannot map an empty file
+        open(fpath, "wb").close()
+        return np.full(shape, np.nan, dtype=BINARY_DTYPE, order="F")
+    matrix = np.memmap(fpath, dtype=BINARY_DTYPE, mode="w+", shape=shape, order="F")
+    matrix[:] = np.nan
+    return matrix
+
+
+def write_binary_matrix(fpath, col_labels, matrix, row_ids=None):
+    """
+    write_binary_matrix: write a dense float matrix (see build_dense_matrix)
+    as a binary matrix, see create_binary_matrix and open_binary_matrix
+    :param fpath: the matrix filename with path
+    :param col_labels: the env_org_proj_id column labels
+    :param matrix: the float matrix, nan for the empty cells
+    :param row_ids: the compound_id of each row, default the row number + 1
+    :return: the number of bytes of the matrix file
+    """
+    out = create_binary_matrix(fpath, col_labels, len(matrix), row_ids)
+    out[:] = matrix
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out.nbytes
+
+
+def open_binary_matrix(fpath, mode="r"):
+    """
+    open_binary_matrix: open a binary matrix zero-copy: nothing is read until
+    sliced, and matrix[:, j] reads column j only
+
+        matrix, compound_ids, col_labels = open_binary_matrix("wom_matrix.f32")
+        values = matrix[:, col_labels.index("eop_E1-O2-P3")]
+
+    :param fpath: the matrix filename with path
+    :param mode: the numpy.memmap mode, 'r' or 'r+'
+    :return: a tuple of (numpy.memmap, compound_ids of the rows, column labels)
+    """
+    sidecars = binary_matrix_fpaths(fpath)
+    with open(sidecars["meta"], "r") as file_obj:
+        meta = json.load(file_obj)
+    with open(sidecars["rows"], "r") as file_obj:
+        reader = csv.reader(file_obj, delimiter='\t')
+        next(reader, None)
+        compound_ids = [int(row[1]) for row in reader]
+    with open(sidecars["cols"], "r") as file_obj:
+        reader = csv.reader(file_obj, delimiter='\t')
+        next(reader, None)
+        col_labels = [row[1] for row in reader]
+    shape = tuple(meta["shape"])
+    if 0 in shape:
+        matrix = np.zeros(shape, dtype=meta["dtype"], order=meta["order"])
+    else:
+        matrix = np.memmap(fpath, dtype=meta["dtype"], mode=mode, shape=shape, order=meta["order"])
+    return (matrix, compound_ids, col_labels)
+
+
+class SparseWomMatrix(object):
+    """
+    SparseWomMatrix: the compound x env_org_proj_id matrix as COO triplets
+    (0-based row = compound_id - 1, column, value), holding only the cells with
+    a value, so its memory grows with the observations instead of compounds x
+    conditions. Empty cells (no observation, N or D) have no triplet.
+    """
+
+    def __init__(self, n_rows, col_labels, rows, cols, values):
+        self.n_rows = n_rows
+        self.col_labels = list(col_labels)
+        self.rows = rows
+        self.cols = cols
+        self.values = values
+
+    @property
+    def nnz(self):
+        return len(self.values)
+
+    def to_csr(self):
+        """
+        to_csr: the CSR arrays of the matrix, with the cells of each row in column order
+        :return: a tuple of (indptr, indices, data)
+        """
+        order = np.lexsort((self.cols, self.rows))
+        indptr = np.searchsorted(self.rows[order], np.arange(self.n_rows + 1))
+        return (indptr, self.cols[order], self.values[order])
+
+    def write_matrix_market(self, fpath, compression=None):
+        """
+        write_matrix_market: write the matrix in the MatrixMarket coordinate
+        format (1-based indices), with the column labels in <fpath>.cols.tsv
+        (column index, env_org_proj_id)
+        :param fpath: the .mtx filename with path
+        :param compression: None, 'gzip' or 'zstd' (see compressed_output)
+        :return: the number of entries written
+        """
+        with open_text_output(fpath, compression) as file_obj:
+            file_obj.write("%%MatrixMarket matrix coordinate real general\n")
+            file_obj.write("% rows: compound_id, columns: env_org_proj_id (see the .cols.tsv file)\n")
+            file_obj.write("{} {} {}\n".format(self.n_rows, len(self.col_labels), self.nnz))
+            file_obj.writelines("{} {} {!r}\n".format(r, c, v) for r, c, v in
+                                zip((self.rows + 1).tolist(), (self.cols + 1).tolist(), self.values.tolist()))
+        with open(fpath + ".cols.tsv", "w") as file_obj:
+            writer = csv.writer(file_obj, delimiter='\t', lineterminator='\n')
+            writer.writerow(["column", "env_org_proj_id"])
+            writer.writerows((k + 1, label) for k, label in enumerate(self.col_labels))
+        return self.nnz
+
+    def write_triplets(self, fpath, compression=None):
+        """
+        write_triplets: write the cells with a value as a (compound_id,
+        env_org_proj_id, value) TSV, in observation order
+        :param fpath: filename with path to write to
+        :param compression: None, 'gzip' or 'zstd'
+        :return: the number of rows written
+        """
+        labels = self.col_labels
+        with open_text_output(fpath, compression) as file_obj:
+            writer = csv.writer(file_obj, delimiter='\t', lineterminator='\n')
+            writer.writerow(["compound_id", "env_org_proj_id", "value"])
+            writer.writerows((r + 1, labels[c], v) for r, c, v in
+                             zip(self.rows.tolist(), self.cols.tolist(), self.values.tolist()))
+        return self.nnz
+
+    def write_binary(self, fpath):
+        """
+        write_binary: write the matrix as a binary matrix (see
+        create_binary_matrix), scattering the triplets into the mapped file
+        without building the dense array in memory
+        :param fpath: the matrix filename with path
+        :return: the number of bytes of the matrix file
+        """
+        out = create_binary_matrix(fpath, self.col_labels, self.n_rows)
+        out[self.rows, self.cols] = self.values
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out.nbytes
+
+    def iter_dense_rows(self):
+        """
+        iter_dense_rows: the rows of the dense matrix, one at a time: the
+        compound_id then the value or '' of every column
+        :return: a generator of lists
+        """
+        indptr, indices, data = self.to_csr()
+        n_cols = len(self.col_labels)
+        for r in range(self.n_rows):
+            row = [''] * n_cols
+            for c, v in zip(indices[indptr[r]:indptr[r + 1]].tolist(), data[indptr[r]:indptr[r + 1]].tolist()):
+                row[c] = str(v)
+            yield [r + 1] + row
+
+    def write_dense(self, fpath, compression=None):
+        """
+        write_dense: stream the dense matrix TSV row by row, the same file as
+        the DataFrame of wom.post_query_process written by pandas to_csv
+        :param fpath: filename with path to write to
+        :param compression: None, 'gzip' or 'zstd'
+        :return: the number of rows written
+        """
+        with open_text_output(fpath, compression) as file_obj:
+            writer = csv.writer(file_obj, delimiter='\t', lineterminator='\n')
+            writer.writerow(["compound_id"] + self.col_labels)
+            writer.writerows(self.iter_dense_rows())
+        return self.n_rows
+
+
+def build_sparse_matrix(conn, row_count, batch_size=OBSERVATION_BATCH_SIZE, eops=None, rowids=None):
+    """
+    build_sparse_matrix: build the compound x env_org_proj_id matrix straight
+    from the observations (see fetch_observations) without allocating the
+    dense columns
+    :param conn: the Connection object
+    :param row_count: the number of compounds (matrix rows)
+    :param batch_size: the width of the rowid ranges fetched at a time
+    :param eops: only the columns of these env_org_proj_ids, see fetch_observations
+    :param rowids: the observation rowid range to scan, see fetch_observations
+    :return: a SparseWomMatrix
+    """
+    col_labels, rows, cols, values = fetch_observations(conn, row_count, batch_size, eops, rowids)
+    keep = ~np.isnan(values)  # only the cells with a value
+    return SparseWomMatrix(row_count, col_labels, rows[keep], cols[keep], values[keep])
+
+
+def build_dense_matrix(conn, row_count, batch_size=OBSERVATION_BATCH_SIZE, eops=None, rowids=None,
+                       compound_ids=None):
+    """
+    build_dense_matrix: build the compound x env_org_proj_id matrix as a dense
+    float array, scattering the resolved cells of fetch_observations in one
+    step instead of packing them in group_concat strings and assigning them
+    one by one as wom.post_query_process does
+    :param conn: the Connection object
+    :param row_count: the number of compounds (matrix rows)
+    :param batch_size: the width of the rowid ranges fetched at a time
+    :param eops: only the columns of these env_org_proj_ids, see fetch_observations
+    :param rowids: the observation rowid range to scan, see fetch_observations
+    :param compound_ids: the compound_id of each row, see fetch_observations
+    :return: a tuple of (column labels, rows x columns float64 array with nan
+    for the empty cells); row k is compound_id k + 1, or compound_ids[k]
+    """
+    col_labels, rows, cols, values = fetch_observations(conn, row_count, batch_size, eops, rowids, compound_ids)
+    matrix = np.full((len(row_ids_of(row_count, compound_ids)), len(col_labels)), np.nan)
+    matrix[rows, cols] = values  # one entry per cell, so no assignment is lost
+    return (col_labels, matrix)
+
+
+def rowid_blocks(min_rowid, max_rowid, n_blocks):
+    """
+    rowid_blocks: split the observation rowids into n_blocks contiguous ranges
+    of about the same width, in rowid order
+    :return: a list of (first, last) rowids, empty if there is no observation
+    """
+    if min_rowid is None:
+        return []
+    n_blocks = min(n_blocks, max_rowid - min_rowid + 1)
+    bounds = [min_rowid + (max_rowid + 1 - min_rowid) * k // n_blocks for k in range(n_blocks + 1)]
+    return [(bounds[k], bounds[k + 1] - 1) for k in range(n_blocks)]
+
+
+def build_rowid_block(args):
+    """
+    build_rowid_block: the worker task, resolving the cells of the
+    observations of one rowid range on its own read-only connection; the
+    range is read through the rowid b-tree, so each worker reads its own
+    slice of matchmaker_observation only
+    :param args: a tuple of (db_file, compound_ids, (first, last) rowids, batch_size)
+    :return: the tuple of fetch_observations
+    """
+    db_file, compound_ids, rowids, batch_size = args
+    conn = create_connection(db_file, read_only=True, profile="fast_read")
+    if conn is None:
+        raise sqlite3.OperationalError("unable to open database file {}".format(db_file))
+    try:
+        return fetch_observations(conn, 0, batch_size, rowids=rowids, compound_ids=compound_ids)
+    finally:
+        conn.close()
+
+
+def build_dense_matrix_parallel(db_file, compound_ids=None, n_workers=None, n_blocks=None,
+                                batch_size=OBSERVATION_BATCH_SIZE):
+    """
+    build_dense_matrix_parallel: build the dense matrix of build_dense_matrix
+    with a process pool, one block of observation rowids per task. The blocks
+    hold the cells of every column observed in them and are merged in rowid
+    order, so a later observation of a cell overrides an earlier one as in the
+    serial build. The rows are mapped through the explicit compound_ids, so
+    gaps in matchmaker_compound (deleted compounds) leave no empty rows and
+    observations of unknown compounds are dropped.
+    :param db_file: database file
+    :param compound_ids: the compound_id of each row, default all the ids of
+    matchmaker_compound (compound_row_ids)
+    :param n_workers: number of worker processes, default the number of CPUs
+    :param n_blocks: number of rowid blocks, default n_workers
+    :param batch_size: the width of the rowid ranges fetched at a time per worker
+    :return: a tuple of (column labels, compound_ids of the rows, rows x
+    columns float64 array with nan for the empty cells)
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    n_blocks = n_blocks or n_workers
+    conn = create_connection(db_file, read_only=True, profile="fast_read")
+    if conn is None:
+        raise sqlite3.OperationalError("unable to open database file {}".format(db_file))
+    try:
+        if compound_ids is None:
+            compound_ids = compound_row_ids(conn)
+        min_rowid, max_rowid = conn.execute("select min(rowid), max(rowid) from matchmaker_observation").fetchone()
+    finally:
+        conn.close()
+    row_ids = row_ids_of(0, compound_ids)
+
+    tasks = [(db_file, row_ids, rowids, batch_size) for rowids in rowid_blocks(min_rowid, max_rowid, n_blocks)]
+    if len(tasks) > 1 and n_workers > 1:
+        with multiprocessing.Pool(min(n_workers, len(tasks))) as pool:
+            results = pool.map(build_rowid_block, tasks)
+    else:
+        results = [build_rowid_block(task) for task in tasks]
+
+    col_labels = sorted(set(label for result in results for label in result[0]))
+    col_index = dict((label, j) for j, label in enumerate(col_labels))
+    matrix = np.full((len(row_ids), len(col_labels)), np.nan)
+    for block_labels, rows, cols, values in results:  # in rowid order
+        block_cols = np.array([col_index[label] for label in block_labels], dtype=np.int64)
+        matrix[rows, block_cols[cols]] = values
+    return (col_labels, row_ids, matrix)